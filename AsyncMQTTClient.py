@@ -0,0 +1,97 @@
+import asyncio
+
+from MQTTClient import MQTTClient
+from ConnectionState.ConnectionState import CONNECTED
+from NetworkLoop.NetworkLoop import AsyncioNetworkLoop
+
+class AsyncMQTTClient(MQTTClient):
+    """
+    MQTTClient where the sockets of all the devices are driven from one asyncio event loop (AsyncioNetworkLoop).
+    No paho network thread per device, only the connect workers and the reconnect thread are threads.
+    Same surface as MQTTClient (publish, mqtt_connect, mqtt_disconnect, clients_info, on_message_cb, stop).
+    The *_async variants can be awaited. on_message_cb also accepts a coroutine function.
+    Must be created from the event loop (or pass the loop).
+    """
+    def __init__(self, mqtt_json_data, loop=None):
+        self._loop = loop if loop else asyncio.get_running_loop()
+        # dev_id -> [(condition, future)] of the mqtt_connect_async / mqtt_disconnect_async calls, resolved by on_state_change.
+        self._state_waiters = {}
+        super().__init__(mqtt_json_data, network_loop=AsyncioNetworkLoop(self._loop))
+        self.on_state_change(self.__state_changed)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop_async()
+
+    def on_message_cb(self, cb):
+        """
+        cb -> function or coroutine function (client, message)
+        The coroutine is scheduled on the event loop, the network loop is not blocked by it.
+        """
+        if asyncio.iscoroutinefunction(cb):
+            super().on_message_cb(lambda client, message: asyncio.run_coroutine_threadsafe(cb(client, message), self._loop))
+        else:
+            super().on_message_cb(cb)
+
+    async def publish_async(self, dev_id, message, topic=None, qos=0, retain=False, timeout=None, priority=None, content_type=None,
+                            user_properties=None):
+        """
+        dev_id -> string
+        message -> string or dictionary
+        Awaitable publish. Returns the mid once acknowledged (see publish), raises PublishError / TimeoutError.
+        """
+        return await asyncio.wrap_future(self.publish(dev_id, message, topic, qos, retain, timeout, priority, content_type, user_properties), loop=self._loop)
+
+    async def mqtt_connect_async(self, device, timeout=30):
+        """
+        device -> dictionary
+        Awaitable mqtt_connect. Returns True once the device is CONNECTED, False if not connected within timeout seconds.
+        """
+        self.mqtt_connect(device)
+        return await self.__wait_status(device.get("DEV_ID"), lambda status: status == CONNECTED, timeout)
+
+    async def mqtt_disconnect_async(self, dev_id, timeout=30):
+        """
+        dev_id -> string
+        Awaitable mqtt_disconnect. Returns True once the device is not CONNECTED, False on timeout.
+        """
+        self.mqtt_disconnect(dev_id)
+        return await self.__wait_status(dev_id, lambda status: status != CONNECTED, timeout)
+
+    async def stop_async(self):
+        """
+        Awaitable stop. Returns once all the clients are disconnected.
+        """
+        self.stop()
+        await self._loop.run_in_executor(None, self._disconnect_thread.join)
+
+    def __state_changed(self, dev_id, old, new):
+        if dev_id in self._state_waiters:
+            self._loop.call_soon_threadsafe(self.__resolve_waiters, dev_id, new)
+
+    def __resolve_waiters(self, dev_id, state):
+        for condition, future in self._state_waiters.get(dev_id, ()):
+            if not future.done() and condition(state):
+                future.set_result(True)
+
+    async def __wait_status(self, dev_id, condition, timeout):
+        if condition(self.clients_info().get(dev_id)):
+            return True
+        waiter = (condition, self._loop.create_future())
+        self._state_waiters.setdefault(dev_id, []).append(waiter)
+        try:
+            # Changed before the waiter was registered.
+            if condition(self.clients_info().get(dev_id)):
+                return True
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._state_waiters.get(dev_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._state_waiters.pop(dev_id, None)
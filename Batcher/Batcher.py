@@ -0,0 +1,198 @@
+import concurrent.futures
+import heapq
+import struct
+import threading
+import time
+
+THINGSBOARD = "thingsboard"
+ARRAY = "array"
+BINARY = "binary"
+FORMATS = (THINGSBOARD, ARRAY, BINARY)
+
+FRAME_HEADER = struct.Struct(">I")
+
+class BatchPolicy:
+    """
+    The BATCH_* options of a device.
+    interval -> seconds a batch collects messages, max_messages -> the batch is sent as soon as it has that many.
+    format: thingsboard -> [{"ts": ms, "values": message}] (v1/devices/me/telemetry), array -> [message, ...], both encoded with the serializer,
+    binary -> the encoded messages, each one prefixed with its length (4 bytes, big endian).
+    coalesce -> the dict messages of a batch are merged into one, the last value of each key wins.
+    """
+    __slots__ = ("interval", "max_messages", "format", "coalesce", "serializer")
+
+    def __init__(self, interval, max_messages=100, format=THINGSBOARD, coalesce=False, serializer=None):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown batch format: {format}")
+        self.interval = interval
+        self.max_messages = max(1, max_messages)
+        self.format = format
+        self.coalesce = coalesce
+        self.serializer = serializer
+
+    def accepts(self, message):
+        # The thingsboard / array batches hold objects, already encoded strings / bytes are published as they are.
+        return self.format == BINARY or not isinstance(message, (str, bytes, bytearray))
+
+    def encode(self, entries):
+        """
+        The payload of the batch entries [(ts in ms, message)].
+        """
+        if self.format == BINARY:
+            frames = []
+            for _, message in entries:
+                if not isinstance(message, (bytes, bytearray)):
+                    message = message if isinstance(message, str) else self.serializer.encode(message)
+                    message = message.encode() if isinstance(message, str) else message
+                frames.append(FRAME_HEADER.pack(len(message)))
+                frames.append(message)
+            return b"".join(frames)
+        if self.format == ARRAY:
+            return self.serializer.encode([message for _, message in entries])
+        telemetry = []
+        for ts, message in entries:
+            for values in message if isinstance(message, list) else (message,):
+                # Already {"ts", "values"}: keep its own timestamp.
+                if isinstance(values, dict) and values.keys() == {"ts", "values"}:
+                    telemetry.append(values)
+                else:
+                    telemetry.append({"ts": ts, "values": values})
+        return self.serializer.encode(telemetry)
+
+class Batch:
+    __slots__ = ("policy", "deadline", "entries", "coalesced", "count", "future")
+
+    def __init__(self, policy, deadline):
+        self.policy = policy
+        self.deadline = deadline
+        self.entries = []
+        # Index in entries of the merged dict messages (coalesce).
+        self.coalesced = None
+        self.count = 0
+        self.future = concurrent.futures.Future()
+
+    def add(self, message):
+        ts = int(time.time() * 1000)
+        self.count += 1
+        if self.policy.coalesce and type(message) is dict and message.keys() != {"ts", "values"}:
+            if self.coalesced is None:
+                self.coalesced = len(self.entries)
+                self.entries.append((ts, dict(message)))
+            else:
+                values = self.entries[self.coalesced][1]
+                values.update(message)
+                self.entries[self.coalesced] = (ts, values)
+            return
+        self.entries.append((ts, message))
+
+class Batcher:
+    """
+    Collects the messages published to the devices with BATCH_INTERVAL and publishes every batch as one message,
+    batches are per (dev_id, qos, retain, timeout). A batch is sent BATCH_INTERVAL seconds after its first message
+    (by the batcher thread) or as soon as it has BATCH_MAX_MESSAGES messages (by the publishing thread).
+    send(dev_id, payload, qos, retain, timeout) publishes a batch and returns its Future, the messages of a batch share that result.
+    """
+    def __init__(self, send, log=None):
+        self._send = send
+        self._log = log
+        # (dev_id, qos, retain, timeout) -> Batch being filled. _heap holds (deadline, seq, key), skipped if the batch was sent already.
+        self._batches = {}
+        self._heap = []
+        self._seq = 0
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def add(self, dev_id, policy, message, qos=0, retain=False, timeout=0):
+        """
+        Returns a Future resolved like the publish of the batch carrying the message.
+        """
+        key = (dev_id, qos, retain, timeout)
+        with self._condition:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = Batch(policy, time.monotonic() + policy.interval)
+                if not self._stopped:
+                    self._batches[key] = batch
+                    self._seq += 1
+                    heapq.heappush(self._heap, (batch.deadline, self._seq, key))
+                    if self._thread is None:
+                        self._thread = threading.Thread(target=self.__flush_expired, name="batcher", daemon=True)
+                        self._thread.start()
+                    self._condition.notify()
+            batch.add(message)
+            full = self._stopped or batch.count >= policy.max_messages
+            if full:
+                self._batches.pop(key, None)
+        if full:
+            self.__send(key, batch)
+        return batch.future
+
+    def pending(self):
+        """
+        Messages waiting in the batches.
+        """
+        with self._condition:
+            return sum(batch.count for batch in self._batches.values())
+
+    def flush(self, dev_id=None):
+        """
+        Send the batches of the dev_id (all the batches if None) now.
+        """
+        with self._condition:
+            keys = [key for key in self._batches if dev_id is None or key[0] == dev_id]
+            batches = [(key, self._batches.pop(key)) for key in keys]
+        for key, batch in batches:
+            self.__send(key, batch)
+
+    def stop(self):
+        """
+        Send all the batches, the messages added later are sent right away (one per batch).
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.flush()
+
+    def __send(self, key, batch):
+        dev_id, qos, retain, timeout = key
+        try:
+            payload = batch.policy.encode(batch.entries)
+            result = self._send(dev_id, payload, qos, retain, timeout)
+        except Exception as e:
+            if self._log:
+                self._log.error("Batch of %s messages not published, Device ID: %s, error: %s", batch.count, dev_id, e)
+            self.__resolve(batch.future, error=e)
+            return
+        if self._log:
+            self._log.debug("Batch of %s messages published, Device ID: %s", batch.count, dev_id)
+        result.add_done_callback(lambda result: self.__resolve(batch.future, result))
+
+    @staticmethod
+    def __resolve(future, result=None, error=None):
+        """
+        Resolve the future of the batch like the publish future (result) or with the error.
+        """
+        # The future is shared by the messages of the batch, one of them may have cancelled it.
+        if not future.set_running_or_notify_cancel():
+            return
+        if result is not None:
+            error = result.exception()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result.result())
+
+    def __flush_expired(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._stopped:
+                    return
+                deadline, _, key = heapq.heappop(self._heap)
+                batch = self._batches.get(key)
+                if batch is None or batch.deadline != deadline:
+                    continue
+                del self._batches[key]
+            self.__send(key, batch)
@@ -0,0 +1,534 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Benchmark.NetworkLoopBenchmark import make_devices, percentile, rss_kb
+
+'''
+Reproducible MQTTClient benchmarks against a local broker started by the suite.
+mosquitto is used if it's installed (--broker mosquitto / auto), otherwise Benchmark/FakeBroker.py.
+The broker runs in its own process, so it doesn't share the GIL with the client. Every scenario runs in its own process too.
+
+connect_storm -> time until all the devices are connected, connect latency.
+publish_throughput -> messages per second of one device alone and of all the devices together.
+fan_in -> messages per second delivered to on_message_cb, publish -> on_message_cb latency.
+reconnect_storm -> time until all the devices are connected again after a broker restart.
+memory -> RSS per device, connected and after some traffic.
+wire_bytes -> bytes on the wire per PUBLISH with MQTT 3.1.1 and with MQTT v5 (topic aliases), counted by an in-process FakeBroker.
+session_resume -> the connections are dropped and QoS 1 messages sent to the devices while they're away, with clean and with persistent sessions:
+                  reconnect time, messages received and SUBSCRIBE packets after the reconnect (in-process FakeBroker).
+dead_connection -> through Benchmark/FaultProxy.py: disconnections on a slow, jittery link (false positives), then the time to detect
+                   a half-open connection (blackhole), with the MQTT keepalive alone and with the liveness probes.
+
+python3 Benchmark/BenchmarkSuite.py --devices 500 --output results.json
+python3 Benchmark/BenchmarkSuite.py --scenarios connect_storm reconnect_storm --loop-threads 2
+python3 Benchmark/BenchmarkSuite.py --scenarios connect_storm memory --lazy 0.9 --connect-rate 200
+python3 Benchmark/BenchmarkSuite.py --scenarios wire_bytes --payload-size 20
+'''
+
+SCENARIOS = ("connect_storm", "publish_throughput", "fan_in", "reconnect_storm", "memory", "wire_bytes", "session_resume", "dead_connection")
+
+# Long topic of the wire_bytes scenario, sent once per device with MQTT v5 topic aliases.
+WIRE_TOPIC = "v1/devices/{dev_id}/telemetry/building_7/floor_3/room_12/sensors/temperature"
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+class Broker:
+    """
+    The local broker process. stop + start on the same port is a broker restart.
+    """
+    def __init__(self, kind, port):
+        self.kind = kind
+        self.port = port
+        self._process = None
+
+    def start(self):
+        if self.kind == "mosquitto":
+            command = [shutil.which("mosquitto"), "-p", str(self.port)]
+        else:
+            command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "FakeBroker.py"), "--port", str(self.port)]
+        self._process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not wait_port(self.port):
+            raise RuntimeError(f"{self.kind} broker did not start on port {self.port}")
+
+    def stop(self):
+        if self._process:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+def broker_kind(requested):
+    if requested == "auto":
+        return "mosquitto" if shutil.which("mosquitto") else "fake"
+    return requested
+
+def count_status(mqtt_client, status):
+    return sum(value == status for value in list(mqtt_client.clients_info().values()))
+
+def wait_status(mqtt_client, status, count, timeout):
+    """
+    Wait until count devices have the status. Returns the seconds waited (None on timeout).
+    """
+    start = time.monotonic()
+    while count_status(mqtt_client, status) < count:
+        if time.monotonic() - start > timeout:
+            return None
+        time.sleep(0.01)
+    return time.monotonic() - start
+
+def ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+def new_client(args, broker, **settings):
+    from MQTTClient import MQTTClient
+
+    devices = make_devices(args.devices, "127.0.0.1", broker.port)
+    for device in devices:
+        device["PUBLISH_TOPIC"] = device["PUBLISH_TOPIC"].replace("/LOOP", "/OUT")
+        device["SUBSCRIBE_TOPIC"] = device["SUBSCRIBE_TOPIC"].replace("/LOOP", "/IN")
+    for device in devices[:lazy_count(args)]:
+        device["LAZY"] = True
+    if args.batch_interval > 0:
+        for device in devices:
+            device["BATCH_INTERVAL"] = args.batch_interval
+            device["BATCH_MAX_MESSAGES"] = args.batch_max
+    if args.protocol == 5:
+        for device in devices:
+            device["PROTOCOL"] = 5
+    if args.persistent_session:
+        for device in devices:
+            device["PERSISTENT_SESSION"] = True
+    settings.setdefault("NETWORK_LOOP_THREADS", args.loop_threads)
+    settings.setdefault("CONNECT_RATE", args.connect_rate)
+    settings.setdefault("LOG_LEVEL", "WARNING")
+    return MQTTClient({"DEVICE": devices, "SETTINGS": settings})
+
+def lazy_count(args):
+    return int(args.devices * args.lazy)
+
+def stop_client(mqtt_client):
+    mqtt_client.stop()
+    mqtt_client._disconnect_thread.join()
+
+def connect_storm(args, broker):
+    start = time.monotonic()
+    mqtt_client = new_client(args, broker, CONNECT_WORKERS=args.connect_workers, CONNECT_PER_ENDPOINT=args.connect_workers)
+    elapsed = wait_status(mqtt_client, "CONNECTED", args.devices - lazy_count(args), args.timeout)
+    elapsed = time.monotonic() - start if elapsed is not None else None
+    connect = mqtt_client.metrics_snapshot()["connect_seconds"]
+    result = {
+        "connected": count_status(mqtt_client, "CONNECTED"),
+        "connect_time_s": round(elapsed, 3) if elapsed is not None else None,
+        "devices_per_s": round(args.devices / elapsed, 1) if elapsed else None,
+        "connect_p50_ms": ms(connect["p50"]),
+        "connect_p99_ms": ms(connect["p99"]),
+    }
+    start = time.monotonic()
+    stop_client(mqtt_client)
+    result["stop_time_s"] = round(time.monotonic() - start, 3)
+    return result
+
+def publish_phase(mqtt_client, dev_ids, payload, args):
+    """
+    Publish round robin from the dev_ids for --duration seconds, then wait for the acknowledgements.
+    Returns the published / acknowledged messages per second.
+    """
+    futures = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    while time.perf_counter() < deadline:
+        for dev_id in dev_ids:
+            futures.append(mqtt_client.publish(dev_id, payload, qos=args.qos))
+    elapsed = time.perf_counter() - start
+    concurrent.futures.wait(futures, timeout=args.timeout)
+    acked_elapsed = time.perf_counter() - start
+    acked = sum(future.done() and future.exception() is None for future in futures)
+    return round(len(futures) / elapsed, 1), acked, round(acked / acked_elapsed, 1)
+
+def publish_throughput(args, broker):
+    mqtt_client = new_client(args, broker, MAX_IN_FLIGHT=args.max_in_flight)
+    wait_status(mqtt_client, "CONNECTED", args.devices, args.timeout)
+    # The batches (thingsboard format) hold objects, strings are published as they are.
+    payload = {"value": "x" * args.payload_size} if args.batch_interval > 0 else "x" * args.payload_size
+
+    single_rate, single_acked, single_acked_rate = publish_phase(mqtt_client, ["BENCH_0"], payload, args)
+    aggregate_rate, aggregate_acked, aggregate_acked_rate = publish_phase(mqtt_client, [f"BENCH_{i}" for i in range(args.devices)], payload, args)
+
+    snapshot = mqtt_client.metrics_snapshot()
+    # messages_out counts the MQTT messages, a batch is one.
+    packets = sum(device["messages_out"] for device in snapshot["devices"].values())
+    messages = sum(device["messages_batched"] for device in snapshot["devices"].values()) if args.batch_interval > 0 else packets
+    result = {
+        "payload_bytes": args.payload_size,
+        "qos": args.qos,
+        "max_in_flight": args.max_in_flight,
+        "single_device_messages_per_s": single_rate,
+        "single_device_acked_per_s": single_acked_rate,
+        "aggregate_messages_per_s": aggregate_rate,
+        "aggregate_acked_per_s": aggregate_acked_rate,
+        "per_device_acked_per_s": round(aggregate_acked_rate / args.devices, 1),
+        "acked": single_acked + aggregate_acked,
+        "publish_failures": sum(device["publish_failures"] for device in snapshot["devices"].values()),
+        "batch_interval_s": args.batch_interval,
+        "packets_out": packets,
+        "messages_per_packet": round(messages / packets, 1) if packets else None,
+        "publish_ack_p50_ms": ms(snapshot["publish_ack_seconds"]["p50"]),
+        "publish_ack_p99_ms": ms(snapshot["publish_ack_seconds"]["p99"]),
+    }
+    stop_client(mqtt_client)
+    return result
+
+def publisher(args):
+    '''
+    Runs in a child process for fan_in, publishes --messages messages to the IN topic of every device.
+    '''
+    from paho.mqtt import client as mqtt_client
+
+    client = mqtt_client.Client(client_id=f"BENCH_PUBLISHER_{os.getpid()}")
+    client.connect("127.0.0.1", args.port)
+    client.loop_start()
+    message_info = None
+    for _ in range(args.messages):
+        for i in range(args.devices):
+            message_info = client.publish(f"BENCH/DEV_{i}/IN", str(time.time()))
+        # Don't let the paho out queue grow without limit.
+        message_info.wait_for_publish()
+    client.disconnect()
+    client.loop_stop()
+
+def fan_in(args, broker):
+    mqtt_client = new_client(args, broker)
+    wait_status(mqtt_client, "CONNECTED", args.devices, args.timeout)
+    # Let the subscriptions settle.
+    time.sleep(1)
+
+    latencies = []
+    expected = args.devices * args.messages
+    received = threading.Event()
+
+    def on_message(client, message):
+        latencies.append(time.time() - float(message))
+        if len(latencies) >= expected:
+            received.set()
+
+    mqtt_client.on_message_cb(on_message)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--publisher", "--port", str(broker.port), "--devices", str(args.devices), "--messages", str(args.messages)])
+    received.wait(args.timeout)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "expected": expected,
+        "received": len(latencies),
+        "messages_per_s": round(len(latencies) / elapsed, 1),
+        "latency_p50_ms": ms(percentile(latencies, 50)),
+        "latency_p99_ms": ms(percentile(latencies, 99)),
+        "dispatcher": mqtt_client.dispatcher_metrics(),
+    }
+    stop_client(mqtt_client)
+    return result
+
+def reconnect_storm(args, broker):
+    mqtt_client = new_client(args, broker, RECONNECT_BASE_DELAY=args.reconnect_base_delay, RECONNECT_MAX_DELAY=args.reconnect_max_delay)
+    wait_status(mqtt_client, "CONNECTED", args.devices, args.timeout)
+
+    broker.stop()
+    start = time.monotonic()
+    while count_status(mqtt_client, "CONNECTED") and time.monotonic() - start < args.timeout:
+        time.sleep(0.01)
+    down = time.monotonic() - start
+    time.sleep(args.broker_downtime)
+    broker.start()
+    start = time.monotonic()
+    while count_status(mqtt_client, "CONNECTED") < args.devices and time.monotonic() - start < args.timeout:
+        time.sleep(0.01)
+    recovered = time.monotonic() - start
+
+    snapshot = mqtt_client.metrics_snapshot()
+    result = {
+        "disconnect_detected_s": round(down, 3),
+        "broker_downtime_s": args.broker_downtime,
+        "recovery_time_s": round(recovered, 3),
+        "reconnected": count_status(mqtt_client, "CONNECTED"),
+        "connect_attempts": sum(device["connect_attempts"] for device in snapshot["devices"].values()),
+        "reconnects": sum(device["reconnects"] for device in snapshot["devices"].values()),
+        "base_delay_s": args.reconnect_base_delay,
+        "max_delay_s": args.reconnect_max_delay,
+    }
+    stop_client(mqtt_client)
+    return result
+
+def memory(args, broker):
+    rss_before = rss_kb()
+    mqtt_client = new_client(args, broker)
+    wait_status(mqtt_client, "CONNECTED", args.devices - lazy_count(args), args.timeout)
+    time.sleep(1)
+    rss_connected = rss_kb()
+    threads = threading.active_count()
+    for _ in range(10):
+        for i in range(args.devices):
+            mqtt_client.publish(f"BENCH_{i}", "x" * args.payload_size)
+    time.sleep(1)
+    rss_traffic = rss_kb()
+    result = {
+        "threads": threads,
+        "rss_before_kb": rss_before,
+        "rss_connected_kb": rss_connected,
+        "rss_per_device_kb": round((rss_connected - rss_before) / args.devices, 2),
+        "rss_per_device_after_traffic_kb": round((rss_traffic - rss_before) / args.devices, 2),
+    }
+    stop_client(mqtt_client)
+    return result
+
+def wire_bytes(args, broker):
+    '''
+    The same QoS 0 messages on a long topic published with MQTT 3.1.1 and with MQTT v5, the FakeBroker counts the PUBLISH bytes.
+    The broker of the suite is not used: mosquitto doesn't report the bytes per connection.
+    '''
+    from Benchmark.FakeBroker import FakeBroker
+
+    expected = args.devices * args.messages
+    result = {"payload_bytes": args.payload_size, "messages": expected}
+    for name, protocol in (("v311", 4), ("v5", 5)):
+        fake_broker = FakeBroker().start()
+        broker_args = argparse.Namespace(**dict(vars(args), protocol=protocol))
+        mqtt_client = new_client(broker_args, fake_broker)
+        wait_status(mqtt_client, "CONNECTED", args.devices - lazy_count(args), args.timeout)
+        topics = {f"BENCH_{i}": WIRE_TOPIC.format(dev_id=f"BENCH_{i}") for i in range(args.devices)}
+        futures = []
+        for _ in range(args.messages):
+            for dev_id, topic in topics.items():
+                futures.append(mqtt_client.publish(dev_id, "x" * args.payload_size, topic=topic))
+        concurrent.futures.wait(futures, timeout=args.timeout)
+        deadline = time.monotonic() + args.timeout
+        while fake_broker.messages_in < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        stop_client(mqtt_client)
+        fake_broker.stop()
+        result[f"{name}_bytes_per_message"] = round(fake_broker.bytes_in / max(1, fake_broker.messages_in), 2)
+        result[f"{name}_messages_received"] = fake_broker.messages_in
+    result["topic_bytes"] = len(WIRE_TOPIC.format(dev_id="BENCH_0"))
+    result["v5_saving_percent"] = round(100 * (1 - result["v5_bytes_per_message"] / result["v311_bytes_per_message"]), 1)
+    return result
+
+def session_resume(args, broker):
+    '''
+    Drop all the connections, publish --messages QoS 1 messages to every device while they're reconnecting.
+    A clean session loses them and subscribes again, a persistent session gets them on the reconnect without SUBSCRIBE.
+    The broker of the suite is not used: the sessions must survive the dropped connections, not a broker restart.
+    '''
+    from paho.mqtt import client as paho_client
+    from Benchmark.FakeBroker import FakeBroker
+
+    expected = args.devices * args.messages
+    result = {"messages": expected}
+    for name, persistent_session in (("clean", False), ("persistent", True)):
+        fake_broker = FakeBroker().start()
+        session_args = argparse.Namespace(**dict(vars(args), persistent_session=persistent_session, lazy=0))
+        mqtt_client = new_client(session_args, fake_broker, RECONNECT_BASE_DELAY=args.reconnect_base_delay, RECONNECT_MAX_DELAY=args.reconnect_max_delay)
+        wait_status(mqtt_client, "CONNECTED", args.devices, args.timeout)
+        received = []
+        mqtt_client.on_message_cb(lambda client, message: received.append(message))
+        time.sleep(0.5)
+
+        fake_broker.drop_connections()
+        dropped = time.monotonic()
+        wait_status(mqtt_client, "BACKOFF", args.devices, args.timeout)
+        subscribe_packets = fake_broker.subscribe_packets
+        publisher = paho_client.Client(client_id=f"BENCH_PUBLISHER_{os.getpid()}")
+        publisher.connect("127.0.0.1", fake_broker.port)
+        publisher.loop_start()
+        message_info = None
+        for i in range(args.devices):
+            for _ in range(args.messages):
+                message_info = publisher.publish(f"BENCH/DEV_{i}/IN", "x", qos=1)
+        message_info.wait_for_publish(args.timeout)
+        publisher.disconnect()
+        publisher.loop_stop()
+
+        reconnect = wait_status(mqtt_client, "CONNECTED", args.devices, args.timeout)
+        deadline = time.monotonic() + 2
+        while len(received) < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        snapshot = mqtt_client.metrics_snapshot()
+        result.update({
+            f"{name}_reconnect_ms": ms(time.monotonic() - dropped if reconnect is not None else None),
+            f"{name}_messages_received": len(received),
+            f"{name}_subscribe_packets_after_reconnect": fake_broker.subscribe_packets - subscribe_packets,
+            f"{name}_sessions_resumed": sum(device["sessions_resumed"] for device in snapshot["devices"].values()),
+        })
+        stop_client(mqtt_client)
+        fake_broker.stop()
+    return result
+
+def dead_connection(args, broker):
+    '''
+    The devices connect through a FaultProxy. First --latency +- --jitter seconds per chunk with --spike-rate spikes of --spike seconds
+    for 2 x --duration seconds: every disconnection is a false positive. Then the proxy swallows everything (half-open connections):
+    time until the devices leave CONNECTED. Once with KEEPALIVE alone, once with LIVENESS_PROBE.
+    '''
+    from Benchmark.FakeBroker import FakeBroker
+    from Benchmark.FaultProxy import FaultProxy
+
+    result = {"keepalive_s": args.keepalive, "probe_min_interval_s": args.probe_interval, "latency_s": args.latency, "jitter_s": args.jitter,
+              "spike_s": args.spike, "spike_rate": args.spike_rate}
+    modes = (("keepalive", {}), ("probe", {"LIVENESS_PROBE": True, "LIVENESS_MIN_INTERVAL": args.probe_interval,
+                                           "LIVENESS_MAX_INTERVAL": max(args.probe_interval, args.keepalive / 2)}))
+    for name, settings in modes:
+        fake_broker = FakeBroker().start()
+        proxy = FaultProxy(fake_broker.port).start()
+        mqtt_client = new_client(argparse.Namespace(**dict(vars(args), lazy=0)), proxy, KEEPALIVE=args.keepalive, **settings)
+        wait_status(mqtt_client, "CONNECTED", args.devices, args.timeout)
+        # dev_id -> time it left CONNECTED.
+        left = {}
+
+        def on_state_change(dev_id, old_state, new_state):
+            if old_state == "CONNECTED":
+                left.setdefault(dev_id, time.monotonic())
+
+        mqtt_client.on_state_change(on_state_change)
+
+        proxy.latency, proxy.jitter, proxy.spike, proxy.spike_rate = args.latency, args.jitter, args.spike, args.spike_rate
+        time.sleep(2 * args.duration)
+        false_positives = len(left)
+        left.clear()
+        wait_status(mqtt_client, "CONNECTED", args.devices, args.timeout)
+
+        proxy.blackhole = True
+        start = time.monotonic()
+        while len(left) < args.devices and time.monotonic() - start < args.timeout:
+            time.sleep(0.05)
+        detection = sorted(when - start for when in left.values())
+        result.update({
+            f"{name}_false_positives": false_positives,
+            f"{name}_detected": len(detection),
+            f"{name}_detection_p50_s": round(percentile(detection, 50), 3) if detection else None,
+            f"{name}_detection_max_s": round(detection[-1], 3) if detection else None,
+        })
+        if settings:
+            liveness = mqtt_client.liveness_metrics()
+            result["probe_dead_connections"] = liveness["dead_connections"]
+        stop_client(mqtt_client)
+        proxy.stop()
+        fake_broker.stop()
+    return result
+
+def run_scenario(args):
+    '''
+    Runs in a child process with its own broker, prints the result as one json line.
+    '''
+    kind = broker_kind(args.broker)
+    broker = Broker(kind, free_port())
+    broker.start()
+    try:
+        result = globals()[args.scenario](args, broker)
+    finally:
+        broker.stop()
+    result.update({"scenario": args.scenario, "broker": kind, "devices": args.devices, "network_loop_threads": args.loop_threads,
+                   "connect_rate": args.connect_rate, "lazy_devices": lazy_count(args), "protocol": args.protocol})
+    print(json.dumps(result))
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MQTTClient benchmark suite")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=50, help="fan_in messages per device")
+    parser.add_argument("--duration", type=float, default=5, help="publish_throughput seconds per phase")
+    parser.add_argument("--payload-size", type=int, default=100)
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=0, help="publish_throughput QoS")
+    parser.add_argument("--max-in-flight", type=int, default=20, help="publish_throughput MAX_IN_FLIGHT")
+    parser.add_argument("--loop-threads", type=int, default=0, help="NETWORK_LOOP_THREADS, 0 -> one paho thread per device")
+    parser.add_argument("--connect-workers", type=int, default=8, help="CONNECT_WORKERS and CONNECT_PER_ENDPOINT of connect_storm")
+    parser.add_argument("--connect-rate", type=float, default=0, help="CONNECT_RATE, connects per second, 0 -> no limit")
+    parser.add_argument("--lazy", type=float, default=0, help="fraction of the devices with LAZY (connected by their first publish)")
+    parser.add_argument("--batch-interval", type=float, default=0, help="publish_throughput BATCH_INTERVAL seconds, 0 -> no batching")
+    parser.add_argument("--batch-max", type=int, default=100, help="publish_throughput BATCH_MAX_MESSAGES")
+    parser.add_argument("--protocol", type=int, choices=[4, 5], default=4, help="PROTOCOL of the devices, 4 -> MQTT 3.1.1, 5 -> MQTT v5")
+    parser.add_argument("--persistent-session", action="store_true", help="PERSISTENT_SESSION of the devices")
+    parser.add_argument("--keepalive", type=int, default=60, help="dead_connection KEEPALIVE seconds")
+    parser.add_argument("--probe-interval", type=float, default=2, help="dead_connection LIVENESS_MIN_INTERVAL seconds")
+    parser.add_argument("--latency", type=float, default=0.05, help="dead_connection FaultProxy latency seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="dead_connection FaultProxy jitter seconds")
+    parser.add_argument("--spike", type=float, default=1, help="dead_connection FaultProxy latency spike seconds")
+    parser.add_argument("--spike-rate", type=float, default=0.02, help="dead_connection fraction of the chunks delayed by --spike")
+    parser.add_argument("--reconnect-base-delay", type=float, default=1)
+    parser.add_argument("--reconnect-max-delay", type=float, default=10)
+    parser.add_argument("--broker-downtime", type=float, default=2, help="reconnect_storm seconds between the broker stop and start")
+    parser.add_argument("--broker", choices=["auto", "mosquitto", "fake"], default="auto")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--scenario", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--publisher", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.publisher:
+        publisher(args)
+        sys.exit(0)
+    if args.scenario:
+        run_scenario(args)
+        sys.exit(0)
+
+    results = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "broker": broker_kind(args.broker),
+        "scenarios": {},
+    }
+    child_args = sys.argv[1:]
+    if "--scenarios" in child_args:
+        # The child runs one scenario.
+        i = child_args.index("--scenarios")
+        j = i + 1
+        while j < len(child_args) and not child_args[j].startswith("--"):
+            j += 1
+        del child_args[i:j]
+    for scenario in args.scenarios:
+        # Each scenario in its own process (clean RSS / thread count), in the Logs dir of the current directory.
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--scenario", scenario] + child_args,
+            capture_output=True, text=True
+        )
+        lines = [line for line in child.stdout.splitlines() if line.startswith("{")]
+        if child.returncode != 0 or not lines:
+            print(f"{scenario} failed:\n{child.stderr}")
+            results["scenarios"][scenario] = None
+            continue
+        results["scenarios"][scenario] = json.loads(lines[-1])
+        print(json.dumps(results["scenarios"][scenario]))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
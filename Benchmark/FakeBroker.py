@@ -0,0 +1,438 @@
+import argparse
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TopicRouter.TopicRouter import TopicRouter
+
+'''
+Minimal MQTT 3.1.1 / 5 broker for the benchmarks, one selector thread.
+CONNECT, SUBSCRIBE / UNSUBSCRIBE (+ and # wildcards), PUBLISH QoS 0 / 1 / 2, PINGREQ, DISCONNECT.
+MQTT v5: the CONNACK sets Topic Alias Maximum / Receive Maximum, the topic aliases of the clients are resolved,
+the PUBLISH properties (but the topic alias) are forwarded to the v5 subscribers.
+Persistent sessions (clean session / clean start off) keep the subscriptions of the client id and queue its QoS 1 / 2 messages
+while it's disconnected, in memory: they're lost with a restart (stop / start), not with drop_connections.
+No authentication, no retained messages, the messages are forwarded to the subscribers with QoS 0.
+Good enough to measure the client, use mosquitto for anything else.
+
+python3 Benchmark/FakeBroker.py --port 1883
+'''
+
+CONNECT = 1
+PUBLISH = 3
+PUBREL = 6
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+MQTT_V5 = 5
+TOPIC_ALIAS = 0x23
+# Size of the MQTT v5 property values by id, None -> variable byte integer, "s" -> 2 bytes length + data, "p" -> string pair.
+PROPERTY_SIZES = {0x01: 1, 0x17: 1, 0x19: 1, 0x24: 1, 0x25: 1, 0x28: 1, 0x29: 1, 0x2A: 1,
+                  0x13: 2, 0x21: 2, 0x22: 2, 0x23: 2, 0x02: 4, 0x11: 4, 0x18: 4, 0x27: 4, 0x0B: None,
+                  0x03: "s", 0x08: "s", 0x09: "s", 0x12: "s", 0x15: "s", 0x16: "s", 0x1A: "s", 0x1C: "s", 0x1F: "s", 0x26: "p"}
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        if length:
+            digit |= 0x80
+        encoded.append(digit)
+        if not length:
+            return bytes(encoded)
+
+def decode_length(data, offset):
+    """
+    (variable byte integer at offset, offset after it)
+    """
+    multiplier, value = 1, 0
+    while True:
+        digit = data[offset]
+        offset += 1
+        value += (digit & 0x7F) * multiplier
+        multiplier *= 128
+        if not digit & 0x80:
+            return value, offset
+
+def strip_topic_alias(properties):
+    """
+    (the properties without the topic alias, the topic alias or None)
+    """
+    offset, alias, kept = 0, None, bytearray()
+    while offset < len(properties):
+        start = offset
+        property_id = properties[offset]
+        offset += 1
+        size = PROPERTY_SIZES[property_id]
+        if size is None:
+            _, offset = decode_length(properties, offset)
+        elif size == "s":
+            offset += 2 + struct.unpack_from("!H", properties, offset)[0]
+        elif size == "p":
+            offset += 2 + struct.unpack_from("!H", properties, offset)[0]
+            offset += 2 + struct.unpack_from("!H", properties, offset)[0]
+        else:
+            offset += size
+        if property_id == TOPIC_ALIAS:
+            alias = struct.unpack_from("!H", properties, start + 1)[0]
+        else:
+            kept += properties[start:offset]
+    return bytes(kept), alias
+
+class Session:
+    """
+    Persistent session of a client id. It's the subscriber in the router, connection is None while the client is away.
+    """
+    __slots__ = ("client_id", "filters", "connection", "version", "queue")
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.filters = set()
+        self.connection = None
+        self.version = 4
+        # PUBLISH packets received for the session while it had no connection.
+        self.queue = []
+
+class Connection:
+    __slots__ = ("sock", "inbound", "outbound", "filters", "writing", "version", "aliases", "session")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbound = bytearray()
+        self.outbound = bytearray()
+        self.filters = set()
+        self.writing = False
+        self.version = 4
+        # MQTT v5: alias -> topic set by the client.
+        self.aliases = {}
+        self.session = None
+
+class FakeBroker:
+    """
+    start binds host:port (port 0 picks a free port, see port) and serves from a background thread.
+    stop closes the listening socket and all the connections, start can be called again (broker restart).
+    topic_alias_maximum / receive_maximum -> the CONNACK properties of the MQTT v5 clients (0 -> not sent).
+    bytes_in counts the bytes of the PUBLISH packets received, subscribe_packets the SUBSCRIBE packets, messages_queued the messages
+    kept for the persistent sessions. drop_connections closes all the client connections (network failure), the sessions are kept.
+    """
+    def __init__(self, host="127.0.0.1", port=0, topic_alias_maximum=10, receive_maximum=0):
+        self.host = host
+        self.port = port
+        self.topic_alias_maximum = topic_alias_maximum
+        self.receive_maximum = receive_maximum
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.subscribe_packets = 0
+        self.messages_queued = 0
+        self._router = TopicRouter()
+        self._sessions = {}
+        self._drop_connections = False
+        self._connections = {}
+        self._selector = None
+        self._server = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._router = TopicRouter()
+        self._sessions = {}
+        self._selector = selectors.DefaultSelector()
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((self.host, self.port))
+        self._server.listen(4096)
+        self._server.setblocking(False)
+        self.port = self._server.getsockname()[1]
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._running = True
+        self._thread = threading.Thread(target=self.__serve, name="fake_broker", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def drop_connections(self):
+        """
+        Close all the client connections from the broker thread (within 0.2 seconds).
+        """
+        self._drop_connections = True
+
+    def __serve(self):
+        try:
+            while self._running:
+                if self._drop_connections:
+                    self._drop_connections = False
+                    for connection in list(self._connections.values()):
+                        self.__close(connection)
+                for key, events in self._selector.select(0.2):
+                    if key.fileobj is self._server:
+                        self.__accept()
+                        continue
+                    connection = key.data
+                    if events & selectors.EVENT_READ:
+                        self.__read(connection)
+                    if events & selectors.EVENT_WRITE and connection.sock.fileno() != -1:
+                        self.__write(connection)
+        finally:
+            for connection in list(self._connections.values()):
+                self.__close(connection)
+            self._selector.unregister(self._server)
+            self._server.close()
+            self._selector.close()
+
+    def __accept(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except (BlockingIOError, OSError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(sock)
+            self._connections[sock.fileno()] = connection
+            self._selector.register(sock, selectors.EVENT_READ, connection)
+
+    def __close(self, connection):
+        if connection.sock.fileno() == -1:
+            return
+        self._connections.pop(connection.sock.fileno(), None)
+        if connection.session is not None:
+            # The session keeps its subscriptions for the next connection.
+            connection.session.connection = None
+        for topic_filter in connection.filters:
+            self._router.remove(topic_filter, connection)
+        self._selector.unregister(connection.sock)
+        connection.sock.close()
+
+    def __read(self, connection):
+        try:
+            data = connection.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.__close(connection)
+            return
+        connection.inbound += data
+        buffer = connection.inbound
+        offset = 0
+        while len(buffer) - offset >= 2:
+            # Fixed header: type / flags, remaining length (1 to 4 bytes).
+            multiplier, length, i = 1, 0, offset + 1
+            while True:
+                if i >= len(buffer):
+                    length = None
+                    break
+                length += (buffer[i] & 0x7F) * multiplier
+                multiplier *= 128
+                i += 1
+                if not buffer[i - 1] & 0x80:
+                    break
+            if length is None or len(buffer) - i < length:
+                break
+            header = buffer[offset]
+            body = bytes(buffer[i:i + length])
+            offset = i + length
+            if not self.__handle(connection, header, body):
+                self.__close(connection)
+                return
+        del buffer[:offset]
+        if connection.outbound:
+            self.__write(connection)
+
+    def __handle(self, connection, header, body):
+        packet_type = header >> 4
+        if packet_type == PUBLISH:
+            self.messages_in += 1
+            self.bytes_in += 1 + len(encode_length(len(body))) + len(body)
+            qos = (header >> 1) & 0x03
+            topic_length = struct.unpack_from("!H", body)[0]
+            topic = body[2:2 + topic_length].decode()
+            offset = 2 + topic_length
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                # PUBACK for QoS 1, PUBREC for QoS 2.
+                connection.outbound += (b"\x40\x02" if qos == 1 else b"\x50\x02") + packet_id
+            properties = b""
+            if connection.version == MQTT_V5:
+                properties_length, properties_offset = decode_length(body, offset)
+                offset = properties_offset + properties_length
+                properties, alias = strip_topic_alias(body[properties_offset:offset])
+                if alias is not None:
+                    if topic:
+                        connection.aliases[alias] = topic
+                    else:
+                        topic = connection.aliases.get(alias)
+                        if topic is None:
+                            # DISCONNECT, Topic Alias invalid.
+                            connection.outbound += b"\xe0\x01\x94"
+                            return False
+            subscribers = self._router.match(topic)
+            if subscribers:
+                topic_bytes = struct.pack("!H", len(topic.encode())) + topic.encode()
+                payload = body[offset:]
+                packets = {}
+                for subscriber in subscribers:
+                    target = subscriber.connection if isinstance(subscriber, Session) else subscriber
+                    if target is None and not qos:
+                        continue
+                    packet = packets.get(subscriber.version)
+                    if packet is None:
+                        variable = topic_bytes + (encode_length(len(properties)) + properties if subscriber.version == MQTT_V5 else b"")
+                        packet = packets[subscriber.version] = b"\x30" + encode_length(len(variable) + len(payload)) + variable + payload
+                    if target is None:
+                        subscriber.queue.append(packet)
+                        self.messages_queued += 1
+                        continue
+                    target.outbound += packet
+                    self.messages_out += 1
+                    if target is not connection:
+                        self.__write(target)
+        elif packet_type == CONNECT:
+            # Protocol name (2 + 4 bytes), then the protocol level, the flags and the keepalive.
+            connection.version = body[6]
+            session_present = self.__connect_session(connection, body)
+            if connection.version == MQTT_V5:
+                properties = bytearray()
+                if self.topic_alias_maximum:
+                    properties += b"\x22" + struct.pack("!H", self.topic_alias_maximum)
+                if self.receive_maximum:
+                    properties += b"\x21" + struct.pack("!H", self.receive_maximum)
+                variable = bytes((session_present, 0)) + encode_length(len(properties)) + properties
+                connection.outbound += b"\x20" + encode_length(len(variable)) + variable
+            else:
+                connection.outbound += b"\x20\x02" + bytes((session_present, 0))
+            if connection.session is not None and connection.session.queue:
+                for packet in connection.session.queue:
+                    connection.outbound += packet
+                    self.messages_out += 1
+                connection.session.queue = []
+        elif packet_type == SUBSCRIBE:
+            self.subscribe_packets += 1
+            subscriber = connection.session or connection
+            packet_id, offset, granted = body[:2], 2, bytearray()
+            if connection.version == MQTT_V5:
+                properties_length, offset = decode_length(body, offset)
+                offset += properties_length
+            while offset < len(body):
+                filter_length = struct.unpack_from("!H", body, offset)[0]
+                topic_filter = body[offset + 2:offset + 2 + filter_length].decode()
+                granted.append(min(body[offset + 2 + filter_length] & 0x03, 1))
+                offset += 3 + filter_length
+                if topic_filter not in subscriber.filters:
+                    subscriber.filters.add(topic_filter)
+                    self._router.add(topic_filter, subscriber)
+            if connection.version == MQTT_V5:
+                # No properties.
+                granted = b"\x00" + granted
+            connection.outbound += b"\x90" + encode_length(2 + len(granted)) + packet_id + granted
+        elif packet_type == UNSUBSCRIBE:
+            subscriber = connection.session or connection
+            packet_id, offset, unsubscribed = body[:2], 2, 0
+            if connection.version == MQTT_V5:
+                properties_length, offset = decode_length(body, offset)
+                offset += properties_length
+            while offset < len(body):
+                filter_length = struct.unpack_from("!H", body, offset)[0]
+                topic_filter = body[offset + 2:offset + 2 + filter_length].decode()
+                offset += 2 + filter_length
+                unsubscribed += 1
+                if topic_filter in subscriber.filters:
+                    subscriber.filters.discard(topic_filter)
+                    self._router.remove(topic_filter, subscriber)
+            if connection.version == MQTT_V5:
+                # No properties, a Success reason code per filter.
+                connection.outbound += b"\xb0" + encode_length(3 + unsubscribed) + packet_id + b"\x00" * (1 + unsubscribed)
+            else:
+                connection.outbound += b"\xb0\x02" + packet_id
+        elif packet_type == PUBREL:
+            connection.outbound += b"\x70\x02" + body[:2]
+        elif packet_type == PINGREQ:
+            connection.outbound += b"\xd0\x00"
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def __connect_session(self, connection, body):
+        """
+        Attach the persistent session of the client id to the connection (clean session off), drop it on a clean connect.
+        Returns the session present flag of the CONNACK.
+        """
+        offset = 10
+        if connection.version == MQTT_V5:
+            properties_length, offset = decode_length(body, offset)
+            offset += properties_length
+        client_id_length = struct.unpack_from("!H", body, offset)[0]
+        client_id = body[offset + 2:offset + 2 + client_id_length].decode()
+        if body[7] & 0x02:
+            # Clean session / clean start.
+            session = self._sessions.pop(client_id, None)
+            if session is not None:
+                self.__end_session(session)
+            return 0
+        session = self._sessions.get(client_id)
+        session_present = 1 if session is not None else 0
+        if session is None:
+            session = self._sessions[client_id] = Session(client_id)
+        elif session.connection is not None:
+            # Session taken over by the new connection.
+            self.__close(session.connection)
+        session.connection = connection
+        session.version = connection.version
+        connection.session = session
+        return session_present
+
+    def __end_session(self, session):
+        for topic_filter in session.filters:
+            self._router.remove(topic_filter, session)
+        if session.connection is not None:
+            session.connection.session = None
+            self.__close(session.connection)
+
+    def __write(self, connection):
+        if connection.sock.fileno() == -1:
+            connection.outbound.clear()
+            return
+        try:
+            sent = connection.sock.send(connection.outbound)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.__close(connection)
+            return
+        del connection.outbound[:sent]
+        # Wait for the socket to be writable only while there's something left.
+        if connection.outbound and not connection.writing:
+            connection.writing = True
+            self._selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+        elif not connection.outbound and connection.writing:
+            connection.writing = False
+            self._selector.modify(connection.sock, selectors.EVENT_READ, connection)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Minimal MQTT 3.1.1 / 5 broker for the MQTTClient benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = FakeBroker(args.host, args.port).start()
+    print(f"Fake broker listening on {broker.host}:{broker.port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        broker.stop()
@@ -0,0 +1,137 @@
+import argparse
+import random
+import socket
+import threading
+import time
+
+'''
+TCP proxy between the clients and a broker injecting network faults, for the dead connection benchmarks.
+blackhole -> the bytes are swallowed in both directions and the sockets stay open: a half-open connection as seen by the client
+(its writes still succeed, nothing comes back), like a cellular link gone silent. The proxy's kernel still acknowledges the TCP segments,
+so TCP_USER_TIMEOUT / TCP keepalive can't see it, only the MQTT keepalive and the liveness probes do.
+latency / jitter -> every chunk is forwarded after latency +- jitter seconds, spike_rate of them after spike seconds instead (slow link, no loss).
+drop_connections closes all the proxied connections.
+
+python3 Benchmark/FaultProxy.py --port 1884 --upstream-port 1883 --latency 0.2 --jitter 0.1
+'''
+
+class FaultProxy:
+    """
+    start listens on host:port (port 0 picks a free port, see port) and forwards every connection to upstream_host:upstream_port,
+    two threads per connection. The faults can be changed at any time.
+    """
+    def __init__(self, upstream_port, upstream_host="127.0.0.1", host="127.0.0.1", port=0):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.host = host
+        self.port = port
+        self.blackhole = False
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.spike = 0.0
+        self.spike_rate = 0.0
+        self.connections = 0
+        self._sockets = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self._running = False
+
+    def start(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((self.host, self.port))
+        self._server.listen(4096)
+        self.port = self._server.getsockname()[1]
+        self._running = True
+        threading.Thread(target=self.__accept, name="fault_proxy", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._server.close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        with self._lock:
+            sockets, self._sockets = self._sockets, set()
+        for sock in sockets:
+            self.__close(sock)
+
+    def __accept(self):
+        while self._running:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+            try:
+                upstream = socket.create_connection((self.upstream_host, self.upstream_port))
+            except OSError:
+                client.close()
+                continue
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self._sockets.update((client, upstream))
+                self.connections += 1
+            threading.Thread(target=self.__pump, args=(client, upstream), name="fault_proxy_up", daemon=True).start()
+            threading.Thread(target=self.__pump, args=(upstream, client), name="fault_proxy_down", daemon=True).start()
+
+    def __pump(self, source, target):
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            if self.blackhole:
+                continue
+            delay = self.__delay()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                target.sendall(data)
+            except OSError:
+                break
+        with self._lock:
+            self._sockets.discard(source)
+            self._sockets.discard(target)
+        self.__close(source)
+        self.__close(target)
+
+    def __delay(self):
+        if self.spike_rate and random.random() < self.spike_rate:
+            return self.spike
+        if self.latency or self.jitter:
+            return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        return 0.0
+
+    @staticmethod
+    def __close(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fault injecting TCP proxy for the MQTTClient benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1884)
+    parser.add_argument("--upstream-host", default="127.0.0.1")
+    parser.add_argument("--upstream-port", type=int, default=1883)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--blackhole", action="store_true")
+    args = parser.parse_args()
+
+    proxy = FaultProxy(args.upstream_port, args.upstream_host, args.host, args.port)
+    proxy.latency = args.latency
+    proxy.jitter = args.jitter
+    proxy.blackhole = args.blackhole
+    proxy.start()
+    print(f"Fault proxy listening on {proxy.host}:{proxy.port} -> {proxy.upstream_host}:{proxy.upstream_port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        proxy.stop()
@@ -0,0 +1,75 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Logger.Logger import Logger
+
+'''
+Cost of the log calls on the publish path, per call as seen by the publishing thread.
+sync_fstring -> the old way, f-string message and the file written by the caller.
+async_lazy -> %-style arguments and the file written by the Logger background thread.
+Both at INFO (the debug line is disabled) and DEBUG (the debug line is written).
+The logs are written to a temporary directory.
+
+python3 Benchmark/LoggingBenchmark.py --iterations 100000
+'''
+
+DEV_ID = "DEV_0"
+TOPIC = "DEV/DEV_0/FROM"
+MESSAGE = json.dumps({"ts": 1718290000000, "values": {"temperature": 34.5, "humidity": 61.2, "battery": 87}})
+
+def publish_fstring(log, iterations):
+    for _ in range(iterations):
+        log.debug(f"External Message published successfully: Device ID: {DEV_ID} topic: {TOPIC} \n{MESSAGE}")
+
+def publish_lazy(log, iterations):
+    for _ in range(iterations):
+        log.debug("External Message published successfully: Device ID: %s topic: %s \n%s", DEV_ID, TOPIC, MESSAGE)
+
+CASES = [
+    ("sync_fstring", False, publish_fstring),
+    ("async_lazy", True, publish_lazy),
+]
+
+def measure(name, async_logging, publish, level, iterations):
+    log = Logger(name=name, module_name=f"{name}_{logging.getLevelName(level)}", level=level, async_logging=async_logging)
+    start = time.perf_counter()
+    publish(log, iterations)
+    call_us = (time.perf_counter() - start) / iterations * 1e6
+    # Time until the background thread has written everything.
+    log.stop()
+    total_us = (time.perf_counter() - start) / iterations * 1e6
+    return {
+        "case": name,
+        "level": logging.getLevelName(level),
+        "call_us": round(call_us, 3),
+        "written_us": round(total_us, 3),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MQTTClient logging benchmark")
+    parser.add_argument("--iterations", type=int, default=50000)
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    results = []
+    with tempfile.TemporaryDirectory() as log_root:
+        os.chdir(log_root)
+        for level in (logging.INFO, logging.DEBUG):
+            for name, async_logging, publish in CASES:
+                results.append(measure(name, async_logging, publish, level, args.iterations))
+
+    print("case", "level", "call us", "written us", sep="\t")
+    for result in results:
+        print(f"{result['case']:<12}", result["level"], result["call_us"], result["written_us"], sep="\t")
+
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
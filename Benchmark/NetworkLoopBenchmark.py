@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+'''
+Compares the network loop modes of MQTTClient: thread count, RSS and publish latency.
+threaded -> one paho network thread per device (default).
+selector -> NETWORK_LOOP_THREADS selector threads shared by all the devices.
+Needs a broker, every device subscribes to its own publish topic and the round trip is measured.
+
+python3 Benchmark/NetworkLoopBenchmark.py --devices 500 --endpoint localhost --port 1883
+'''
+
+def rss_kb():
+    '''
+    Current resident set size in kB.
+    '''
+    try:
+        with open("/proc/self/status", 'r') as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def make_devices(count, endpoint, port, prefix="BENCH"):
+    devices = []
+    for i in range(count):
+        topic = f"{prefix}/DEV_{i}/LOOP"
+        devices.append({
+            "DEV_TYPE": "DEV",
+            "IS_SERVER": False,
+            "DEV_ID": f"{prefix}_{i}",
+            "MAPPED_TO_DEV_OR_SERVER": "",
+            "CLIENT_ID": f"{prefix}_CLIENT_{os.getpid()}_{i}",
+            "ENDPOINT": endpoint,
+            "PORT": port,
+            "CONNECTION_METHOD": 0,
+            "PUBLISH_TOPIC": topic,
+            "SUBSCRIBE_TOPIC": topic,
+            "USERNAME": "",
+            "PASSWORD": "",
+            "CERT_DIR": "",
+            "CA_CERT": "",
+            "CLIENT_CERT": "",
+            "CLIENT_KEY": "",
+            "ACCESS_TOKEN": "",
+            "STATUS": True
+        })
+    return devices
+
+def run_mode(args):
+    '''
+    Runs in a child process, so the thread count and RSS only belong to one mode.
+    '''
+    from MQTTClient import MQTTClient
+
+    rss_before = rss_kb()
+    settings = {"NETWORK_LOOP_THREADS": args.loop_threads if args.mode == "selector" else 0}
+    start = time.monotonic()
+    mqtt_client = MQTTClient({"DEVICE": make_devices(args.devices, args.endpoint, args.port), "SETTINGS": settings})
+
+    latencies = []
+    received = threading.Event()
+    expected = args.devices * args.messages
+
+    def on_message(client, message):
+        latencies.append(time.perf_counter() - float(message))
+        if len(latencies) >= expected:
+            received.set()
+
+    mqtt_client.on_message_cb(on_message)
+
+    while sum(status == "CONNECTED" for status in mqtt_client.clients_info().values()) < args.devices:
+        if time.monotonic() - start > args.timeout:
+            break
+        time.sleep(0.05)
+    connect_time = time.monotonic() - start
+    # Let the subscriptions settle.
+    time.sleep(1)
+
+    threads = threading.active_count()
+    rss = rss_kb()
+    for _ in range(args.messages):
+        for i in range(args.devices):
+            mqtt_client.publish(f"BENCH_{i}", str(time.perf_counter()))
+        time.sleep(args.interval)
+    received.wait(args.timeout)
+
+    mqtt_client.stop()
+    mqtt_client._disconnect_thread.join()
+
+    result = {
+        "mode": args.mode,
+        "devices": args.devices,
+        "connected": sum(status == "CONNECTED" for status in mqtt_client.clients_info().values()),
+        "connect_time_s": round(connect_time, 3),
+        "threads": threads,
+        "rss_kb": rss,
+        "rss_per_device_kb": round((rss - rss_before) / max(1, args.devices), 2),
+        "messages_received": len(latencies),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+    print(json.dumps(result))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MQTTClient network loop benchmark")
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=20, help="messages per device")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between the publish rounds")
+    parser.add_argument("--loop-threads", type=int, default=2, help="NETWORK_LOOP_THREADS for the selector mode")
+    parser.add_argument("--endpoint", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--mode", choices=["threaded", "selector"], help="run only this mode (in this process)")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        sys.exit(0)
+
+    results = []
+    for mode in ("threaded", "selector"):
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode] + sys.argv[1:],
+            capture_output=True, text=True
+        )
+        lines = [line for line in child.stdout.splitlines() if line.startswith("{")]
+        if child.returncode != 0 or not lines:
+            print(f"{mode} failed:\n{child.stderr}")
+            continue
+        results.append(json.loads(lines[-1]))
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
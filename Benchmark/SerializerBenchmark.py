@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Serializer.Serializer import available_serializers, get_serializer
+
+'''
+Bytes on the wire, encode and decode time per SERIALIZER.
+The payloads are the PUBLISH node of MQTTClient.json and a telemetry sample.
+
+python3 Benchmark/SerializerBenchmark.py --iterations 100000
+'''
+
+TELEMETRY = {
+    "ts": 1718290000000,
+    "values": {
+        "temperature": 34.5,
+        "humidity": 61.2,
+        "pressure": 1013.25,
+        "battery": 87,
+        "rssi": -71,
+        "door_open": False,
+        "location": {"LAT": 123.4, "LONG": 567.8},
+        "firmware": "1.4.2"
+    }
+}
+
+def load_payloads():
+    payloads = {"telemetry": TELEMETRY}
+    json_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "MQTTClient.json")
+    try:
+        with open(json_path, 'r') as conf_file:
+            payloads["publish_node"] = json.load(conf_file).get("PUBLISH", {})
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    return payloads
+
+def measure(serializer, payload, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        encoded = serializer.encode(payload)
+    encode_us = (time.perf_counter() - start) / iterations * 1e6
+
+    if isinstance(encoded, str):
+        encoded = encoded.encode()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        serializer.decode(encoded)
+    decode_us = (time.perf_counter() - start) / iterations * 1e6
+
+    return {
+        "serializer": serializer.name,
+        "bytes": len(encoded),
+        "encode_us": round(encode_us, 3),
+        "decode_us": round(decode_us, 3),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MQTTClient serializer benchmark")
+    parser.add_argument("--iterations", type=int, default=50000)
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for payload_name, payload in load_payloads().items():
+        results[payload_name] = [measure(get_serializer(name), payload, args.iterations) for name in available_serializers()]
+        baseline = next(result["bytes"] for result in results[payload_name] if result["serializer"] == "json_pretty")
+        print(f"\n{payload_name}")
+        print("serializer", "bytes", "vs json_pretty", "encode us", "decode us", sep="\t")
+        for result in results[payload_name]:
+            print(f"{result['serializer']:<12}", result["bytes"], f"{result['bytes'] / baseline:.0%}", result["encode_us"], result["decode_us"], sep="\t")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
@@ -0,0 +1,109 @@
+import json
+import os
+import re
+import threading
+import time
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def load_config(path, chunk=1000):
+    """
+    json.load of the MQTTClient json. The DEVICE list is decoded one device at a time, the thread sleeps(0) every chunk devices
+    so the network threads keep running while a large file (100k devices) is parsed.
+    Raises json.JSONDecodeError like json.load.
+    """
+    with open(path, "r") as conf_file:
+        text = conf_file.read()
+    decoder = json.JSONDecoder()
+    index = WHITESPACE.match(text, 0).end()
+    if not text.startswith("{", index):
+        return decoder.decode(text)
+    try:
+        data = {}
+        index = WHITESPACE.match(text, index + 1).end()
+        if text[index] == "}":
+            return data
+        while True:
+            key, index = decoder.raw_decode(text, index)
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("Expecting property name enclosed in double quotes", text, index)
+            index = WHITESPACE.match(text, index).end()
+            if text[index] != ":":
+                raise json.JSONDecodeError("Expecting ':' delimiter", text, index)
+            index = WHITESPACE.match(text, index + 1).end()
+            if key == "DEVICE" and text.startswith("[", index):
+                value, index = _decode_list(decoder, text, index, chunk)
+            else:
+                value, index = decoder.raw_decode(text, index)
+            data[key] = value
+            index = WHITESPACE.match(text, index).end()
+            if text[index] == "}":
+                break
+            if text[index] != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", text, index)
+            index = WHITESPACE.match(text, index + 1).end()
+    except IndexError:
+        raise json.JSONDecodeError("Unexpected end of file", text, len(text)) from None
+    if WHITESPACE.match(text, index + 1).end() != len(text):
+        raise json.JSONDecodeError("Extra data", text, index + 1)
+    return data
+
+def _decode_list(decoder, text, index, chunk):
+    items = []
+    index = WHITESPACE.match(text, index + 1).end()
+    if text[index] == "]":
+        return items, index + 1
+    while True:
+        item, index = decoder.raw_decode(text, index)
+        items.append(item)
+        if len(items) % chunk == 0:
+            time.sleep(0)
+        index = WHITESPACE.match(text, index).end()
+        if text[index] == "]":
+            return items, index + 1
+        if text[index] != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, index)
+        index = WHITESPACE.match(text, index + 1).end()
+
+class ConfigWatcher:
+    """
+    Polls the mtime / size of the json file every interval seconds and calls on_change(json_data) when it changed.
+    A file which is not valid json (ex: still being written) is logged and loaded again on its next change.
+    """
+    def __init__(self, path, on_change, interval=1.0, log=None):
+        self._path = path
+        self._on_change = on_change
+        self._interval = interval
+        self._log = log
+        self._signature = self.__stat()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self.__watch, name="config_watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def __stat(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def __watch(self):
+        while not self._stop_event.wait(self._interval):
+            signature = self.__stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                json_data = load_config(self._path)
+            except (OSError, ValueError) as e:
+                if self._log:
+                    self._log.error("Config file %s not loaded: %s", self._path, e)
+                continue
+            try:
+                self._on_change(json_data)
+            except Exception as e:
+                if self._log:
+                    self._log.exception("Config reload of %s failed: %s", self._path, e)
@@ -0,0 +1,106 @@
+import queue
+import threading
+import types
+
+IDLE = "IDLE"
+CONNECTING = "CONNECTING"
+CONNECTED = "CONNECTED"
+BACKOFF = "BACKOFF"
+DISABLED = "DISABLED"
+
+class DeviceStates:
+    """
+    The connection state of every device:
+    IDLE -> registered, not connected until needed (LAZY).
+    CONNECTING -> queued for / in a connect attempt, CONNACK not received yet.
+    CONNECTED -> CONNACK received.
+    BACKOFF -> connection lost or all the attempts failed, the reconnect is scheduled.
+    DISABLED -> STATUS false, not connected.
+    The transitions are made under one lock, optionally only from the expected states (compare and set).
+    snapshot returns a read only copy, copied again only after a change, so polling it is cheap and the caller can't change the states.
+    The listeners get (dev_id, old state, new state) in the order of the transitions, from one background thread,
+    so a slow listener doesn't hold the network / connect threads. old / new state is None when the device is added / removed.
+    """
+    def __init__(self, log=None):
+        self._states = {}
+        self._lock = threading.Lock()
+        self._snapshot = types.MappingProxyType({})
+        self._changed = False
+        self._listeners = []
+        self._events = None
+        self._log = log
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, dev_id, default=None):
+        return self._states.get(dev_id, default)
+
+    def set(self, dev_id, state, expected=None):
+        """
+        Returns False (nothing changed) if expected is given and the current state is not in it.
+        """
+        with self._lock:
+            old = self._states.get(dev_id)
+            if expected is not None and old not in expected:
+                return False
+            if old != state:
+                self._states[dev_id] = state
+                self.__changed(dev_id, old, state)
+        return True
+
+    def remove(self, dev_id, expected=None):
+        with self._lock:
+            if dev_id not in self._states:
+                return False
+            old = self._states[dev_id]
+            if expected is not None and old not in expected:
+                return False
+            del self._states[dev_id]
+            self.__changed(dev_id, old, None)
+        return True
+
+    def snapshot(self):
+        if self._changed:
+            with self._lock:
+                if self._changed:
+                    self._snapshot = types.MappingProxyType(dict(self._states))
+                    self._changed = False
+        return self._snapshot
+
+    def subscribe(self, listener):
+        """
+        listener(dev_id, old, new) is called for every transition from now on.
+        """
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+            if self._events is None:
+                self._events = queue.SimpleQueue()
+                threading.Thread(target=self.__notify, name="state_events", daemon=True).start()
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners = [registered for registered in self._listeners if registered != listener]
+
+    def stop(self):
+        with self._lock:
+            if self._events is not None:
+                self._events.put(None)
+
+    def __changed(self, dev_id, old, new):
+        # Called with the lock held, the events are queued in the order of the transitions.
+        self._changed = True
+        if self._events is not None:
+            self._events.put((dev_id, old, new))
+
+    def __notify(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            for listener in self._listeners:
+                try:
+                    listener(*event)
+                except Exception as e:
+                    if self._log:
+                        self._log.exception("on_state_change listener error, Device ID: %s, error: %s", event[0], e)
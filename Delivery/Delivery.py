@@ -0,0 +1,113 @@
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+class PublishError(Exception):
+    """
+    The message was not sent. rc -> paho return code (MQTT_ERR_*), None if it didn't get to paho.
+    """
+    def __init__(self, message, rc=None):
+        super().__init__(message)
+        self.rc = rc
+
+# Left in the mid map by on_publish when it comes before publish returned.
+ACKED = object()
+
+class DeliveryTracker:
+    """
+    Futures of the published messages, resolved with the mid by on_publish (PUBACK for QoS 1, PUBCOMP for QoS 2, written to the socket for QoS 0).
+    Every client has its own mid map (client.deliveries, mid -> (future, qos)), so both the publish and the ack are O(1).
+    publish and on_publish run on different threads in any order and paho calls on_publish holding its own locks,
+    so the map is only touched with dict pop / setdefault (atomic), no lock.
+    The futures with a timeout are failed with TimeoutError by one background thread, started on the first timeout.
+    """
+    def __init__(self):
+        self._timeouts = []
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def track(self, deliveries, mid, qos, timeout=None):
+        """
+        Return the future of the mid returned by paho publish.
+        """
+        future = concurrent.futures.Future()
+        entry = (future, qos)
+        acked = deliveries.pop(mid, None)
+        if acked is not None and acked is not ACKED:
+            # A message of a lost connection never acknowledged, paho reused the mid.
+            self.__resolve(acked[0], exception=PublishError(f"No acknowledgement for mid {mid}"))
+            acked = None
+        if acked is None:
+            acked = deliveries.setdefault(mid, entry)
+            if acked is entry:
+                if timeout:
+                    self.__add_timeout(deliveries, mid, entry, timeout)
+                return future
+            deliveries.pop(mid, None)
+        # on_publish was called before publish returned.
+        future.set_result(mid)
+        return future
+
+    def acked(self, deliveries, mid):
+        entry = deliveries.pop(mid, None)
+        if entry is None:
+            entry = deliveries.setdefault(mid, ACKED)
+            if entry is ACKED:
+                return
+            deliveries.pop(mid, None)
+        if entry is not ACKED:
+            self.__resolve(entry[0], result=mid)
+
+    def disconnected(self, deliveries, final=False):
+        """
+        The QoS 0 messages not yet written are lost with the connection. QoS 1 / 2 are sent again by paho after the reconnect.
+        final -> the client won't reconnect (mqtt_disconnect, stop, reload, lazy idle), the QoS 1 / 2 messages fail too.
+        """
+        for mid, entry in list(deliveries.items()):
+            if entry is ACKED:
+                deliveries.pop(mid, None)
+            elif (final or entry[1] == 0) and deliveries.get(mid) is entry and deliveries.pop(mid, None) is entry:
+                reason = "Disconnected before the message was acknowledged" if entry[1] else "Disconnected before the message was sent"
+                self.__resolve(entry[0], exception=PublishError(reason))
+
+    def stop(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def __add_timeout(self, deliveries, mid, entry, timeout):
+        seq = next(self._seq)
+        with self._condition:
+            heapq.heappush(self._timeouts, (time.monotonic() + timeout, seq, deliveries, mid, entry))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.__expire, name="publish_timeouts", daemon=True)
+                self._thread.start()
+            elif self._timeouts[0][1] == seq:
+                # Earlier than the deadline the thread is waiting for.
+                self._condition.notify()
+
+    def __expire(self):
+        while True:
+            with self._condition:
+                while not self._closed and (not self._timeouts or self._timeouts[0][0] > time.monotonic()):
+                    self._condition.wait(self._timeouts[0][0] - time.monotonic() if self._timeouts else None)
+                if self._closed:
+                    return
+                _, _, deliveries, mid, entry = heapq.heappop(self._timeouts)
+            if deliveries.get(mid) is entry and deliveries.pop(mid, None) is entry:
+                self.__resolve(entry[0], exception=TimeoutError(f"No acknowledgement for mid {mid}"))
+
+    @staticmethod
+    def __resolve(future, result=None, exception=None):
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            # Cancelled by the caller.
+            pass
@@ -0,0 +1,135 @@
+import threading
+
+class DeviceRegistry:
+    """
+    Holds the device information (the DEVICE node of the json) indexed by DEV_ID.
+    Secondary indexes by (ENDPOINT, PORT), CLIENT_ID and topic (PUBLISH_TOPIC / SUBSCRIBE_TOPIC).
+    All the lookups are O(1), to_json exports the devices back to the DEVICE list.
+    Thread safe, the devices are added / removed from the caller's thread and read from the connect / reconnect threads.
+    """
+    def __init__(self, devices=None):
+        self._lock = threading.RLock()
+        self._devices = {}
+        self._by_endpoint = {}
+        self._by_client_id = {}
+        self._by_topic = {}
+        if devices:
+            self.add_many(devices)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, dev_id):
+        return dev_id in self._devices
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._devices.values()))
+
+    def get(self, dev_id):
+        return self._devices.get(dev_id)
+
+    def add(self, device):
+        """
+        device -> dictionary
+        Add the device, or overwrite the device with the same DEV_ID.
+        Returns the overwritten device or None.
+        """
+        dev_id = device.get("DEV_ID")
+        if dev_id is None:
+            raise ValueError("device does not contain DEV_ID")
+        with self._lock:
+            previous = self._devices.get(dev_id)
+            if previous is not None:
+                self.__unindex(previous)
+            self._devices[dev_id] = device
+            self.__index(device)
+        return previous
+
+    def add_many(self, devices):
+        """
+        devices -> list of dictionary
+        Add / overwrite all the devices under one lock. Devices without DEV_ID are skipped.
+        Returns the list of the added devices.
+        """
+        added = []
+        with self._lock:
+            for device in devices:
+                if device.get("DEV_ID") is None:
+                    continue
+                self.add(device)
+                added.append(device)
+        return added
+
+    def remove(self, dev_id):
+        """
+        Remove the device. Returns the removed device or None.
+        """
+        with self._lock:
+            device = self._devices.pop(dev_id, None)
+            if device is not None:
+                self.__unindex(device)
+        return device
+
+    def by_endpoint(self, endpoint, port=None):
+        """
+        Devices connecting to the broker. All the ports of the ENDPOINT if port is None.
+        """
+        with self._lock:
+            if port is not None:
+                return list(self._by_endpoint.get((endpoint, port), {}).values())
+            return [device for (device_endpoint, _), devices in self._by_endpoint.items() if device_endpoint == endpoint for device in devices.values()]
+
+    def by_client_id(self, client_id):
+        dev_id = self._by_client_id.get(client_id)
+        return self._devices.get(dev_id) if dev_id is not None else None
+
+    def by_topic(self, topic):
+        """
+        Devices publishing or subscribing the topic (exact match).
+        """
+        with self._lock:
+            return list(self._by_topic.get(topic, {}).values())
+
+    def to_json(self):
+        """
+        Export the devices as the DEVICE list of the json.
+        """
+        with self._lock:
+            return list(self._devices.values())
+
+    @staticmethod
+    def topics(device):
+        """
+        The topics of the device used by the topic index. SUBSCRIBE_TOPIC may be a list of topics / {"FILTER": "", "QOS": 0}.
+        """
+        sub_topic = device.get("SUBSCRIBE_TOPIC")
+        entries = sub_topic if isinstance(sub_topic, list) else [sub_topic]
+        topics = {entry.get("FILTER") if isinstance(entry, dict) else entry for entry in entries}
+        topics.add(device.get("PUBLISH_TOPIC"))
+        return {topic for topic in topics if topic}
+
+    def __index(self, device):
+        dev_id = device.get("DEV_ID")
+        self._by_endpoint.setdefault((device.get("ENDPOINT"), device.get("PORT")), {})[dev_id] = device
+        if device.get("CLIENT_ID"):
+            self._by_client_id[device.get("CLIENT_ID")] = dev_id
+        for topic in self.topics(device):
+            self._by_topic.setdefault(topic, {})[dev_id] = device
+
+    def __unindex(self, device):
+        dev_id = device.get("DEV_ID")
+        key = (device.get("ENDPOINT"), device.get("PORT"))
+        devices = self._by_endpoint.get(key)
+        if devices is not None:
+            devices.pop(dev_id, None)
+            if not devices:
+                del self._by_endpoint[key]
+        if self._by_client_id.get(device.get("CLIENT_ID")) == dev_id:
+            del self._by_client_id[device.get("CLIENT_ID")]
+        for topic in self.topics(device):
+            devices = self._by_topic.get(topic)
+            if devices is not None:
+                devices.pop(dev_id, None)
+                if not devices:
+                    del self._by_topic[topic]
@@ -0,0 +1,122 @@
+import collections
+import threading
+import zlib
+
+class DispatchPolicy:
+    """
+    What dispatch does when the worker queue is full.
+    BLOCK -> wait for a free slot (the network thread stops reading, backpressure to the broker).
+    DROP_OLDEST -> drop the oldest queued message.
+    DROP_NEWEST -> drop the new message.
+    """
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+
+POLICIES = (DispatchPolicy.BLOCK, DispatchPolicy.DROP_OLDEST, DispatchPolicy.DROP_NEWEST)
+
+class Dispatcher:
+    """
+    Runs the inbound message handling on a pool of worker threads instead of the paho network thread.
+    Every key (dev_id) always goes to the same worker, so the messages of a device are handled in order.
+    Each worker has a bounded queue (queue_size), the policy decides what happens when it's full.
+    metrics returns the queue depths and the dispatched / dropped counters. dropped(key, *args) is called with the message dropped by
+    the policy (the oldest queued one for DROP_OLDEST, the new one for DROP_NEWEST).
+    Worker threads only, on_message_cb gets the paho client object and it can't be passed to another process.
+    """
+    def __init__(self, workers=4, queue_size=10000, policy=DispatchPolicy.BLOCK, log=None, dropped=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown dispatch policy: {policy}")
+        self._queue_size = max(1, queue_size)
+        self._policy = policy
+        self._log = log
+        self._on_dropped = dropped
+        self._closed = False
+        self._queues = [collections.deque() for _ in range(max(1, workers))]
+        self._conditions = [threading.Condition() for _ in self._queues]
+        self._max_depths = [0] * len(self._queues)
+        self._dispatched = 0
+        self._dropped = 0
+        self._threads = []
+        for i in range(len(self._queues)):
+            thread = threading.Thread(target=self.__work, args=(i,), name=f"dispatcher_{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def dispatch(self, key, method, *args):
+        """
+        Queue method(*args) to the worker of the key. Returns False if this message is dropped (DROP_NEWEST),
+        True once queued, also when DROP_OLDEST made room for it.
+        """
+        i = zlib.crc32(str(key).encode()) % len(self._queues)
+        work_queue = self._queues[i]
+        condition = self._conditions[i]
+        entry = (key, method, args)
+        dropped = None
+        with condition:
+            if len(work_queue) >= self._queue_size:
+                if self._policy == DispatchPolicy.BLOCK:
+                    while len(work_queue) >= self._queue_size and not self._closed:
+                        condition.wait(1)
+                elif self._policy == DispatchPolicy.DROP_OLDEST:
+                    dropped = work_queue.popleft()
+                    self._dropped += 1
+                else:
+                    dropped = entry
+                    self._dropped += 1
+            if dropped is not entry:
+                work_queue.append(entry)
+                self._dispatched += 1
+                if len(work_queue) > self._max_depths[i]:
+                    self._max_depths[i] = len(work_queue)
+                condition.notify_all()
+        if dropped is not None:
+            self.__dropped(dropped)
+        return dropped is not entry
+
+    def metrics(self):
+        """
+        Queue depth (current and max) per worker, dispatched and dropped messages.
+        """
+        return {
+            "queue_depth": [len(work_queue) for work_queue in self._queues],
+            "max_queue_depth": list(self._max_depths),
+            "queue_size": self._queue_size,
+            "policy": self._policy,
+            "dispatched": self._dispatched,
+            "dropped": self._dropped,
+        }
+
+    def stop(self):
+        self._closed = True
+        for condition in self._conditions:
+            with condition:
+                condition.notify_all()
+
+    def __work(self, i):
+        work_queue = self._queues[i]
+        condition = self._conditions[i]
+        while True:
+            with condition:
+                while not work_queue and not self._closed:
+                    condition.wait()
+                if not work_queue:
+                    return
+                _, method, args = work_queue.popleft()
+                # Wake up a blocked dispatch.
+                condition.notify_all()
+            try:
+                method(*args)
+            except Exception as e:
+                if self._log:
+                    self._log.exception("Dispatcher worker %s error: %s", i, e)
+
+    def __dropped(self, entry):
+        key, _, args = entry
+        if self._on_dropped is None:
+            return
+        try:
+            self._on_dropped(key, *args)
+        except Exception as e:
+            if self._log:
+                self._log.exception("Dispatcher dropped callback error: %s", e)
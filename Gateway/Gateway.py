@@ -0,0 +1,163 @@
+import json
+import threading
+import types
+
+from TopicRouter.TopicRouter import TopicRouter
+
+THINGSBOARD = "thingsboard"
+TOPIC = "topic"
+
+TB_CONNECT = "v1/gateway/connect"
+TB_DISCONNECT = "v1/gateway/disconnect"
+TB_TELEMETRY = "v1/gateway/telemetry"
+TB_ATTRIBUTES = "v1/gateway/attributes"
+TB_RPC = "v1/gateway/rpc"
+TB_RPC_RESPONSE = "v1/devices/me/rpc/response/"
+
+class GatewayDevice:
+    """
+    A device carried over the connection of its gateway (DEVICE entry with "GATEWAY": gateway DEV_ID), it has no paho client / socket.
+    Has the client attributes used by the message handling, on_message_cb gets it as the client.
+    """
+    __slots__ = ("dev_id", "dev_type", "is_server", "name", "gateway_id", "gateway", "pub_topic", "sub_topic", "subscriptions",
+                 "serializer", "deserialize", "raw_message", "rate_limit_policy", "priority_topics")
+
+    def __init__(self, device, subscriptions, serializer):
+        self.dev_id = device.get("DEV_ID")
+        self.dev_type = device.get("DEV_TYPE")
+        self.is_server = device.get("IS_SERVER")
+        self.name = device.get("GATEWAY_DEVICE_NAME") or self.dev_id
+        self.gateway_id = device.get("GATEWAY")
+        # Not a gateway itself.
+        self.gateway = None
+        self.pub_topic = device.get("PUBLISH_TOPIC")
+        self.sub_topic = device.get("SUBSCRIBE_TOPIC")
+        self.subscriptions = subscriptions
+        self.serializer = serializer
+        self.deserialize = device.get("DESERIALIZE", False)
+        self.raw_message = device.get("RAW_MESSAGE", False)
+        # Set with its RATE_LIMIT bucket by MQTTClient.
+        self.rate_limit_policy = None
+        self.priority_topics = []
+
+class Gateway:
+    """
+    The devices multiplexed on the connection of one gateway device.
+    thingsboard -> ThingsBoard gateway API: the devices are announced on v1/gateway/connect, their telemetry / attributes / rpc responses
+    are wrapped into the v1/gateway/* messages, the rpc requests / attribute updates are given back to the device as v1/devices/me/* messages.
+    topic -> the devices keep their own topics, their SUBSCRIBE_TOPIC filters are subscribed on the gateway connection
+    and the received messages go to the devices whose filters match.
+    """
+    def __init__(self, dev_id, kind=TOPIC):
+        self.dev_id = dev_id
+        self.kind = kind
+        self._devices = {}
+        self._by_name = {}
+        self._router = TopicRouter()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def devices(self):
+        return list(self._devices.values())
+
+    def attach(self, device):
+        with self._lock:
+            self._devices[device.dev_id] = device
+            self._by_name[device.name] = device
+            for topic_filter, _ in device.subscriptions:
+                self._router.add(topic_filter, device)
+
+    def detach(self, dev_id):
+        """
+        Returns the removed GatewayDevice and the topic filters no other device of the gateway needs.
+        """
+        with self._lock:
+            device = self._devices.pop(dev_id, None)
+            if device is None:
+                return None, []
+            if self._by_name.get(device.name) is device:
+                del self._by_name[device.name]
+            unused = []
+            for topic_filter, _ in device.subscriptions:
+                self._router.remove(topic_filter, device)
+                if not any(topic_filter == other_filter for other in self._devices.values() for other_filter, _ in other.subscriptions):
+                    unused.append(topic_filter)
+        return device, unused
+
+    def subscriptions(self, devices=None):
+        """
+        [(filter, qos)] to subscribe on the gateway connection for the devices (all the devices if None).
+        """
+        if self.kind == THINGSBOARD:
+            return [(TB_ATTRIBUTES, 1), (TB_RPC, 1)]
+        subscriptions = {}
+        for device in self.devices() if devices is None else devices:
+            for topic_filter, qos in device.subscriptions:
+                subscriptions[topic_filter] = max(qos, subscriptions.get(topic_filter, 0))
+        return list(subscriptions.items())
+
+    def announce(self, device):
+        """
+        (topic, payload) to publish when the device joins the connected gateway, None if nothing is needed.
+        """
+        if self.kind == THINGSBOARD:
+            return TB_CONNECT, json.dumps({"device": device.name, "type": device.dev_type}, separators=(",", ":"))
+        return None
+
+    def farewell(self, device):
+        if self.kind == THINGSBOARD:
+            return TB_DISCONNECT, json.dumps({"device": device.name}, separators=(",", ":"))
+        return None
+
+    def outbound(self, device, topic, message):
+        """
+        (topic, payload) published on the gateway connection for the message of the device. message is already encoded for the topic gateway.
+        Raises ValueError if a ThingsBoard message is not json.
+        """
+        if self.kind != THINGSBOARD:
+            return topic, message
+        if isinstance(message, (str, bytes, bytearray)):
+            message = json.loads(message)
+        if topic.startswith(TB_RPC_RESPONSE):
+            payload = {"device": device.name, "id": int(topic[len(TB_RPC_RESPONSE):]), "data": message}
+            topic = TB_RPC
+        elif "rpc" in topic:
+            payload = dict(message, device=device.name)
+            topic = TB_RPC
+        elif "attributes" in topic:
+            payload = {device.name: message}
+            topic = TB_ATTRIBUTES
+        else:
+            payload = {device.name: message if isinstance(message, list) else [message]}
+            topic = TB_TELEMETRY
+        return topic, json.dumps(payload, separators=(",", ":"))
+
+    def demux(self, msg):
+        """
+        [(GatewayDevice, message)] for a message received on the gateway connection, empty if it's not for the devices (the gateway's own message).
+        """
+        if self.kind != THINGSBOARD:
+            return [(device, msg) for device in dict.fromkeys(self._router.match(msg.topic))] if len(self._router) else []
+        if msg.topic not in (TB_ATTRIBUTES, TB_RPC):
+            return []
+        try:
+            payload = json.loads(msg.payload)
+        except ValueError:
+            return []
+        device = self._by_name.get(payload.get("device")) if isinstance(payload, dict) else None
+        if device is None:
+            return []
+        data = payload.get("data")
+        if msg.topic == TB_RPC:
+            if not isinstance(data, dict) or "method" not in data:
+                # Not a request (ex: a response echoed by a broker other than ThingsBoard).
+                return []
+            topic = f"v1/devices/me/rpc/request/{data.get('id')}"
+            data = {"method": data.get("method"), "params": data.get("params")}
+        else:
+            topic = "v1/devices/me/attributes"
+        device_msg = types.SimpleNamespace(topic=topic, payload=json.dumps(data, separators=(",", ":")).encode(),
+                                           qos=msg.qos, retain=msg.retain, dup=False, mid=msg.mid)
+        return [(device, device_msg)]
@@ -0,0 +1,254 @@
+import heapq
+import itertools
+import socket
+import threading
+import time
+
+def set_socket_options(sock, tcp_keepalive=0, tcp_user_timeout=0):
+    """
+    tcp_keepalive -> seconds idle before the kernel probes the connection (then every tcp_keepalive / 3 seconds, 3 probes), 0 -> off.
+    tcp_user_timeout -> seconds the sent data may stay unacknowledged before the kernel drops the connection (linux), 0 -> off.
+    The options missing on the platform are skipped.
+    """
+    if tcp_keepalive > 0:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        idle = max(1, int(tcp_keepalive))
+        # TCP_KEEPALIVE is the idle time on macOS.
+        idle_option = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+        if idle_option is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, idle_option, idle)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, idle // 3))
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    if tcp_user_timeout > 0 and hasattr(socket, "TCP_USER_TIMEOUT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(tcp_user_timeout * 1000))
+
+class ProbePolicy:
+    """
+    The LIVENESS_* options of a device.
+    min_interval / max_interval -> seconds without inbound traffic before a probe, the interval adapts in between.
+    misses -> probes in a row without an answer before the connection is dead.
+    min_timeout -> the shortest wait for an answer, the timeout is srtt + 4 x rttvar (RFC 6298) above it, max_interval at most.
+    """
+    __slots__ = ("min_interval", "max_interval", "misses", "min_timeout", "topic")
+
+    def __init__(self, min_interval=5, max_interval=30, misses=2, min_timeout=1, topic=None):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.misses = max(1, misses)
+        self.min_timeout = min_timeout
+        self.topic = topic
+
+class ProbeState:
+    """
+    Round trip time estimate and probe interval of one connection.
+    A stable answer (rtt within srtt + 2 x rttvar) grows the interval by half up to max_interval,
+    a slow one halves it and a missed one sets it back to min_interval: the flaky links are probed more often.
+    """
+    __slots__ = ("policy", "srtt", "rttvar", "interval", "last_inbound", "deadline", "probe_mid", "probe_sent", "early_answer", "missed",
+                 "probes", "answers", "timeouts", "last_rtt")
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.srtt = None
+        self.rttvar = 0.0
+        self.interval = policy.min_interval
+        self.last_inbound = time.monotonic()
+        # The next check, the older heap entries of the state are skipped.
+        self.deadline = None
+        # mid / send time of the probe waiting for its answer, early_answer -> (mid, time) of an answer before the mid was known.
+        self.probe_mid = None
+        self.probe_sent = None
+        self.early_answer = None
+        self.missed = 0
+        self.probes = 0
+        self.answers = 0
+        self.timeouts = 0
+        self.last_rtt = None
+
+    def timeout(self):
+        if self.srtt is None:
+            return max(self.policy.min_timeout, self.policy.min_interval)
+        return min(max(self.policy.min_timeout, self.srtt + 4 * self.rttvar), self.policy.max_interval)
+
+    def answered(self, now):
+        rtt = now - self.probe_sent
+        self.probe_mid = None
+        self.probe_sent = None
+        self.missed = 0
+        self.answers += 1
+        self.last_rtt = rtt
+        stable = self.srtt is None or rtt <= self.srtt + 2 * self.rttvar
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        if stable:
+            self.interval = min(self.policy.max_interval, self.interval * 1.5)
+        else:
+            self.interval = max(self.policy.min_interval, self.interval / 2)
+        return rtt
+
+    def timed_out(self):
+        self.probe_mid = None
+        self.probe_sent = None
+        self.missed += 1
+        self.timeouts += 1
+        self.interval = self.policy.min_interval
+
+    def to_dict(self):
+        return {"srtt_ms": round(self.srtt * 1000, 3) if self.srtt is not None else None,
+                "rttvar_ms": round(self.rttvar * 1000, 3), "last_rtt_ms": round(self.last_rtt * 1000, 3) if self.last_rtt is not None else None,
+                "interval_s": round(self.interval, 3), "timeout_s": round(self.timeout(), 3),
+                "probes": self.probes, "answers": self.answers, "timeouts": self.timeouts}
+
+class LivenessMonitor:
+    """
+    Probes the connected clients with LIVENESS_PROBE from one thread, in the order of their deadlines.
+    A client with inbound traffic in the last interval is not probed, the traffic shows the connection is alive.
+    probe(client) sends the probe and returns its mid (None if it couldn't be sent), answered(dev_id, mid) must be called with the mid of
+    every answer and inbound(dev_id) on the received messages. dead(client, state) is called when policy.misses probes in a row
+    got no answer in time, the client is not probed anymore then.
+    """
+    def __init__(self, probe, dead, log=None):
+        self._probe = probe
+        self._dead = dead
+        self._log = log
+        # dev_id -> (client, ProbeState), _heap holds (deadline, seq, dev_id, state), skipped if the state was replaced / removed.
+        self._clients = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self.dead_connections = 0
+
+    def add(self, client, policy):
+        """
+        Start probing the client (on connect), the estimate starts over with the new connection.
+        """
+        state = ProbeState(policy)
+        with self._condition:
+            if self._stopped:
+                return
+            self._clients[client.dev_id] = (client, state)
+            self.__schedule(client.dev_id, state, state.last_inbound + state.interval)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.__run, name="liveness", daemon=True)
+                self._thread.start()
+
+    def remove(self, dev_id):
+        with self._condition:
+            self._clients.pop(dev_id, None)
+
+    def inbound(self, dev_id):
+        """
+        Traffic received on the connection, no lock: a single attribute write on the hot path.
+        """
+        entry = self._clients.get(dev_id)
+        if entry is not None:
+            entry[1].last_inbound = time.monotonic()
+
+    def answered(self, dev_id, mid):
+        entry = self._clients.get(dev_id)
+        if entry is None:
+            return
+        now = time.monotonic()
+        with self._condition:
+            state = entry[1]
+            if state.probe_sent is None:
+                return
+            if state.probe_mid is None:
+                # Answered before probe returned the mid.
+                state.early_answer = (mid, now)
+            elif state.probe_mid == mid:
+                self.__answered(dev_id, state, now)
+
+    def state(self):
+        with self._condition:
+            return {dev_id: state.to_dict() for dev_id, (_, state) in self._clients.items()}
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._clients.clear()
+            self._condition.notify()
+
+    def __schedule(self, dev_id, state, deadline):
+        state.deadline = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), dev_id, state))
+        self._condition.notify()
+
+    def __answered(self, dev_id, state, now):
+        state.last_inbound = now
+        rtt = state.answered(now)
+        self.__schedule(dev_id, state, now + state.interval)
+        if self._log:
+            self._log.debug("Dev ID: %s, liveness probe answered in %.1f ms, next in %.1f s", dev_id, rtt * 1000, state.interval)
+
+    def __run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._stopped:
+                    return
+                deadline, _, dev_id, state = heapq.heappop(self._heap)
+                entry = self._clients.get(dev_id)
+                if entry is None or entry[1] is not state or state.deadline != deadline:
+                    continue
+                client = entry[0]
+                now = time.monotonic()
+                dead = False
+                if state.probe_sent is not None and state.last_inbound > state.probe_sent:
+                    # No answer yet, but the connection received something since the probe.
+                    state.probe_mid = None
+                    state.probe_sent = None
+                    state.missed = 0
+                    self.__schedule(dev_id, state, state.last_inbound + state.interval)
+                    continue
+                if state.probe_sent is not None:
+                    # No answer in time.
+                    state.timed_out()
+                    if state.missed >= state.policy.misses:
+                        del self._clients[dev_id]
+                        self.dead_connections += 1
+                        dead = True
+                elif now < state.last_inbound + state.interval:
+                    # Traffic since the last check.
+                    self.__schedule(dev_id, state, state.last_inbound + state.interval)
+                    continue
+                if not dead:
+                    state.probes += 1
+                    state.probe_sent = now
+                    state.early_answer = None
+            if dead:
+                if self._log:
+                    self._log.warning("Dev ID: %s, no answer to %s liveness probes, the connection is dead", dev_id, state.missed)
+                self.__call(self._dead, client, state)
+                continue
+            mid = self.__call(self._probe, client)
+            with self._condition:
+                if self._clients.get(dev_id, (None, None))[1] is not state:
+                    continue
+                if mid is None:
+                    # Not sent, checked again after the interval.
+                    state.probe_sent = None
+                    self.__schedule(dev_id, state, time.monotonic() + state.interval)
+                    continue
+                state.probe_mid = mid
+                if state.early_answer is not None and state.early_answer[0] == mid:
+                    self.__answered(dev_id, state, state.early_answer[1])
+                else:
+                    self.__schedule(dev_id, state, state.probe_sent + state.timeout())
+
+    def __call(self, fn, *args):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if self._log:
+                self._log.exception("Liveness callback failed: %s", e)
+            return None
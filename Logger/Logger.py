@@ -1,9 +1,42 @@
 import os
 from datetime import datetime
 import logging
+import logging.handlers
+import queue
+import atexit
+
+def log_level(name, default=logging.INFO):
+    """
+    The logging level of a LOG_LEVEL name ("debug", "INFO", ...), default if it's not a level.
+    """
+    level = logging.getLevelName(str(name).upper())
+    return level if isinstance(level, int) else default
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which leaves the formatting (msg % args) to the listener thread.
+    The records with exception info or a mutable argument (dict, list, set, bytearray) are formatted in the caller:
+    the traceback can't wait and the container may change (or be resized while formatted) before the listener gets to it.
+    """
+    def prepare(self, record):
+        if record.exc_info or (isinstance(record.args, tuple) and any(isinstance(arg, (dict, list, set, bytearray)) for arg in record.args)):
+            return super().prepare(record)
+        return record
 
 class Logger(logging.Logger):
-    def __init__(self, name="General", module_name="General", level=logging.DEBUG):
+    """
+    Logger writing to Logs/<date>/<module_name>/<time>.log (log.log links to the latest).
+    async_logging -> the records are queued and written by a background thread (QueueListener), the caller never waits for the disk.
+    max_bytes / backup_count -> size based rotation. when (ex: midnight, H) -> time based rotation, takes precedence over max_bytes.
+    Use the lazy %-style arguments (self._log.debug("x: %s", x)), the message is built only if the level is enabled.
+    level -> logging level or its name (LOG_LEVEL), an unknown name is logged as an error and INFO is used.
+    """
+    def __init__(self, name="General", module_name="General", level=logging.DEBUG, max_bytes=0, backup_count=0, when=None, async_logging=True):
+        unknown_level = None
+        if not isinstance(level, int):
+            if log_level(level, None) is None:
+                unknown_level = level
+            level = log_level(level)
         super().__init__(module_name, level)
 
         current_date = datetime.now().strftime("%Y-%m-%d")
@@ -13,16 +46,39 @@ class Logger(logging.Logger):
         log_filename = datetime.now().strftime("%H.%M.%S.log")
         log_path = os.path.join(log_dir, log_filename)
 
-        file_handler = logging.FileHandler(log_path)
+        if when:
+            file_handler = logging.handlers.TimedRotatingFileHandler(log_path, when=when, backupCount=backup_count)
+        elif max_bytes:
+            file_handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+        else:
+            file_handler = logging.FileHandler(log_path)
         file_handler.setLevel(level)
 
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s - %(funcName)s - %(lineno)d : %(message)s')
         file_handler.setFormatter(formatter)
 
         # Add handler to logger instance
-        self.addHandler(file_handler)
+        self._listener = None
+        if async_logging:
+            log_queue = queue.SimpleQueue()
+            self.addHandler(DeferredQueueHandler(log_queue))
+            self._listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+            self._listener.start()
+            atexit.register(self.stop)
+        else:
+            self.addHandler(file_handler)
 
         self.create_symlink(log_path, os.path.join(log_dir, "log.log"))
+        if unknown_level is not None:
+            self.error("Log level %s is not one of DEBUG, INFO, WARNING, ERROR, CRITICAL, using INFO", unknown_level)
+
+    def stop(self):
+        """
+        Write the queued records and stop the background thread.
+        """
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
 
     def create_symlink(self, target, link_name):
         try:
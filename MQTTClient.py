@@ -8,8 +8,32 @@ import ssl
 import time
 import threading
 import queue
+import heapq
+import random
+import concurrent.futures
+import copy
+import socket
+import collections
 
 from Logger.Logger import Logger
+from NetworkLoop.NetworkLoop import ThreadedNetworkLoop, SelectorNetworkLoop
+from DeviceRegistry.DeviceRegistry import DeviceRegistry
+from Serializer.Serializer import get_serializer, serializer_for_content_type
+from OutboundQueue.OutboundQueue import OutboundStore
+from Dispatcher.Dispatcher import Dispatcher, DispatchPolicy, POLICIES as DISPATCH_POLICIES
+from TopicRouter.TopicRouter import TopicRouter
+from MessageView.MessageView import MessageView
+from Metrics.Metrics import Metrics
+from Delivery.Delivery import DeliveryTracker, PublishError
+from TLSContext.TLSContext import TLSContextCache
+from ConfigWatcher.ConfigWatcher import ConfigWatcher
+from Gateway.Gateway import Gateway, GatewayDevice, THINGSBOARD, TOPIC
+from ConnectionState.ConnectionState import DeviceStates, IDLE, CONNECTING, CONNECTED, BACKOFF, DISABLED
+from Batcher.Batcher import Batcher, BatchPolicy, FORMATS as BATCH_FORMATS
+from MQTTv5.MQTTv5 import (TopicAliases, MQTT_V5, user_property_pairs, publish_properties, with_topic_alias, connect_properties,
+                           property_value, reason_text)
+from Liveness.Liveness import LivenessMonitor, ProbePolicy, set_socket_options
+from RateLimit.RateLimit import RateLimiter, HIGH, NORMAL, DELAY, SPOOL, POLICIES as RATE_LIMIT_POLICIES
 
 class ConnectionMethod(Enum):
     """
@@ -30,30 +54,189 @@ class MQTTClient:
     Provides external callback for on_message (on_message_cb).
     clients_info can be accessed externally.
     connect, disconnect, publish externally.
-    _mqtt_json_data holds all the device information.
-    _clients_status holds the current client statis (connected/disconnected to the broker).
+    _mqtt_json_data holds the json, _devices (DeviceRegistry) holds all the device information indexed by DEV_ID.
+    _states (DeviceStates) holds the connection state of every device (IDLE, CONNECTING, CONNECTED, BACKOFF, DISABLED).
+    _network_loop drives the client sockets, ThreadedNetworkLoop (one paho thread per client) by default.
+    SETTINGS NETWORK_LOOP_THREADS > 0 shares that many selector threads between all the clients (SelectorNetworkLoop).
     """
-    def __init__(self, mqtt_json_data):
-        self._log = Logger(name="MQTT Client", module_name="MQTTClient", level=logging.INFO)
+    # Device fields applied to the connected client by reload, a change of any other field reconnects the device.
+    RELOAD_IN_PLACE = frozenset(("PUBLISH_TOPIC", "SUBSCRIBE_TOPIC", "SERIALIZER", "DESERIALIZE", "RAW_MESSAGE",
+                                 "BATCH_INTERVAL", "BATCH_MAX_MESSAGES", "BATCH_FORMAT", "BATCH_COALESCE",
+                                 "RATE_LIMIT", "RATE_LIMIT_BURST", "RATE_LIMIT_POLICY", "PRIORITY_TOPICS", "USER_PROPERTIES"))
+    RELOAD_CHUNK = 1000
+    # SETTINGS defaults of the device LIVENESS_* options.
+    LIVENESS_KEYS = ("LIVENESS_PROBE", "LIVENESS_MIN_INTERVAL", "LIVENESS_MAX_INTERVAL", "LIVENESS_MISSES", "LIVENESS_MIN_TIMEOUT")
+
+    def __init__(self, mqtt_json_data, network_loop=None):
+        settings = mqtt_json_data.get("SETTINGS", {})
+        self._log = Logger(
+            name="MQTT Client",
+            module_name=settings.get("LOG_MODULE_NAME", "MQTTClient"),
+            level=str(settings.get("LOG_LEVEL", "INFO")),
+            max_bytes=settings.get("LOG_MAX_BYTES", 0),
+            backup_count=settings.get("LOG_BACKUP_COUNT", 0),
+            when=settings.get("LOG_ROTATE_WHEN"),
+            async_logging=settings.get("LOG_ASYNC", True),
+        )
 
         self._on_message_cb = None
+        self._router = TopicRouter()
         self._client_list_connected = {}
         self._client_list_disconnected = {}
-        self._clients_status = {}
+        self._states = DeviceStates(log=self._log)
         self._mqtt_json_data = mqtt_json_data
-        devices = mqtt_json_data.get("DEVICE", [])
+        self._devices = DeviceRegistry(mqtt_json_data.get("DEVICE", []))
+
+        if network_loop:
+            self._network_loop = network_loop
+        elif settings.get("NETWORK_LOOP_THREADS", 0) > 0:
+            self._network_loop = SelectorNetworkLoop(settings.get("NETWORK_LOOP_THREADS"), log=self._log)
+        else:
+            self._network_loop = ThreadedNetworkLoop()
 
         self._stop_event = threading.Event()
 
+        # Number of parallel connects, parallel connects to the same broker (ENDPOINT, PORT) and seconds per connect attempt.
+        self._connect_workers = settings.get("CONNECT_WORKERS", 8)
+        self._connect_per_endpoint = settings.get("CONNECT_PER_ENDPOINT", 4)
+        self._connect_timeout = settings.get("CONNECT_TIMEOUT", 5)
+        if not isinstance(self._connect_timeout, (int, float)) or self._connect_timeout <= 0:
+            self._log.error("CONNECT_TIMEOUT must be > 0, got %s, using 5", self._connect_timeout)
+            self._connect_timeout = 5
+        self._connect_retry_delay = settings.get("CONNECT_RETRY_DELAY", 3)
+        # (ENDPOINT, PORT) -> connects in progress, and the clients parked until one of them is done (handed its slot in order).
+        self._endpoint_active = {}
+        self._endpoint_pending = {}
+        self._endpoint_lock = threading.Lock()
+        # Startup ramp: CONNECT_RATE > 0 spaces the connects of all the workers to that many per second, +-CONNECT_RATE_JITTER randomly.
+        self._connect_rate = settings.get("CONNECT_RATE", 0)
+        self._connect_rate_jitter = settings.get("CONNECT_RATE_JITTER", 0.5)
+        self._connect_next_slot = 0
+        self._connect_rate_lock = threading.Lock()
+        # LAZY devices are connected by their first publish (or wake) and disconnected again after IDLE_TIMEOUT seconds without traffic.
+        self._lazy_idle_timeout = settings.get("LAZY_IDLE_TIMEOUT", 300)
+        self._lazy_clients = {}
+        self._lazy_lock = threading.RLock()
+        self._lazy_thread = None
+
         self._safe_connect_queue = queue.Queue()
-        self._safe_connect_thread = threading.Thread(target=self.__safe_connect)
-        self._safe_connect_thread.start()
+        self._safe_connect_threads = []
+        for i in range(max(1, self._connect_workers)):
+            safe_connect_thread = threading.Thread(target=self.__safe_connect, name=f"safe_connect_{i}")
+            safe_connect_thread.start()
+            self._safe_connect_threads.append(safe_connect_thread)
+
+        # Reconnect backoff: decorrelated jitter between RECONNECT_BASE_DELAY and RECONNECT_MAX_DELAY seconds.
+        # After RECONNECT_MAX_FAILURES failures in a row the circuit opens and the device is retried only every RECONNECT_CIRCUIT_OPEN_TIME seconds.
+        self._reconnect_base_delay = settings.get("RECONNECT_BASE_DELAY", 1)
+        self._reconnect_max_delay = settings.get("RECONNECT_MAX_DELAY", 60)
+        self._reconnect_max_failures = settings.get("RECONNECT_MAX_FAILURES", 10)
+        self._reconnect_circuit_open_time = settings.get("RECONNECT_CIRCUIT_OPEN_TIME", 300)
+        # _reconnect_heap holds (deadline, seq, dev_id), _reconnect_deadlines the valid deadline of each scheduled dev_id.
+        self._reconnect_heap = []
+        self._reconnect_deadlines = {}
+        self._reconnect_seq = 0
+        self._reconnect_condition = threading.Condition()
+
+        # Store and forward (devices with STORE_AND_FORWARD). The messages published while the device is not connected are kept on disk
+        # under STORE_DIR and drained in order at STORE_DRAIN_RATE messages per second once connected.
+        self._store_dir = settings.get("STORE_DIR", os.path.join(os.getcwd(), "Store"))
+        self._store_max_bytes = settings.get("STORE_MAX_BYTES", 64 * 1024 * 1024)
+        self._store_segment_bytes = settings.get("STORE_SEGMENT_BYTES", 4 * 1024 * 1024)
+        self._store_fsync_interval = settings.get("STORE_FSYNC_INTERVAL", 0.2)
+        self._store_drain_rate = settings.get("STORE_DRAIN_RATE", 100)
+        self._outbound_store = None
+        self._outbound_store_lock = threading.Lock()
+        self._outbound_backlog = set()
+        self._drain_event = threading.Event()
+        self._drain_thread = None
+
+        # The incoming messages are handled (decode, on_message_cb) by DISPATCH_WORKERS threads instead of the network thread.
+        # DISPATCH_WORKERS 0 handles them on the network thread.
+        dispatch_workers = settings.get("DISPATCH_WORKERS", 4)
+        dispatch_policy = settings.get("DISPATCH_POLICY", DispatchPolicy.BLOCK)
+        if dispatch_policy not in DISPATCH_POLICIES:
+            self._log.error("DISPATCH_POLICY %s is not one of %s, using block", dispatch_policy, DISPATCH_POLICIES)
+            dispatch_policy = DispatchPolicy.BLOCK
+        if dispatch_workers > 0:
+            self._dispatcher = Dispatcher(
+                workers=dispatch_workers,
+                queue_size=settings.get("DISPATCH_QUEUE_SIZE", 10000),
+                policy=dispatch_policy,
+                log=self._log,
+                dropped=self.__dispatch_dropped
+            )
+        else:
+            self._dispatcher = None
+
+        # Per device counters and latency histograms (metrics_snapshot). METRICS_PORT > 0 also serves them on /metrics (Prometheus).
+        self._metrics = Metrics(slow_callback=settings.get("METRICS_SLOW_CALLBACK", 0.5), log=self._log)
+        if settings.get("METRICS_PORT", 0) > 0:
+            try:
+                self._metrics.serve(settings.get("METRICS_PORT"), settings.get("METRICS_HOST", "0.0.0.0"))
+            except OSError as e:
+                # Ex: port in use. The worker threads are running already, raising would leave them behind.
+                self._log.error("Metrics endpoint %s:%s not started: %s", settings.get("METRICS_HOST", "0.0.0.0"), settings.get("METRICS_PORT"), e)
+
+        # publish returns a future resolved by on_publish. MAX_IN_FLIGHT QoS 1 / 2 messages per device wait for the acknowledgement,
+        # the next ones are queued by paho (at most MAX_QUEUED, 0 -> no limit). PUBLISH_TIMEOUT (seconds, 0 -> none) fails the future.
+        self._deliveries = DeliveryTracker()
+        self._publish_timeout = settings.get("PUBLISH_TIMEOUT", 0)
+        self._max_in_flight = settings.get("MAX_IN_FLIGHT", 20)
+        # (endpoint, port) -> Receive Maximum of the broker's last MQTT v5 CONNACK.
+        self._receive_maximums = {}
+        self._max_queued = settings.get("MAX_QUEUED", 0)
+        # Devices with BATCH_INTERVAL > 0 publish the messages of their PUBLISH_TOPIC in batches (one MQTT message per batch).
+        self._batcher = Batcher(self.__send_batch, log=self._log)
+        # Publish rate limits, token buckets in messages per second (0 -> no limit): GLOBAL_RATE_LIMIT for all the devices,
+        # ENDPOINT_RATE_LIMIT per broker, DEVICE_RATE_LIMIT per device (the device RATE_LIMIT overrides it). *_BURST messages may go at once.
+        # Over the limit (RATE_LIMIT_POLICY): delay -> sent later in order, dropped if it would wait more than RATE_LIMIT_MAX_DELAY seconds,
+        # drop -> the publish fails, spool -> kept by STORE_AND_FORWARD and drained within the limits. High priority messages are never delayed.
+        self._rate_limiter = RateLimiter(
+            settings.get("GLOBAL_RATE_LIMIT", 0),
+            settings.get("GLOBAL_RATE_LIMIT_BURST"),
+            settings.get("ENDPOINT_RATE_LIMIT", 0),
+            settings.get("ENDPOINT_RATE_LIMIT_BURST"),
+            log=self._log
+        )
+        self._device_rate_limit = settings.get("DEVICE_RATE_LIMIT", 0)
+        self._device_rate_limit_burst = settings.get("DEVICE_RATE_LIMIT_BURST")
+        self._rate_limit_policy = settings.get("RATE_LIMIT_POLICY", DELAY)
+        self._rate_limit_max_delay = settings.get("RATE_LIMIT_MAX_DELAY", 10)
+
+        # The devices with the same CA / cert / key share one SSLContext, reloaded when the files change.
+        # TLS_SESSION_REUSE resumes the last TLS session of the broker on the next connects (abbreviated handshake).
+        self._tls_contexts = TLSContextCache(settings.get("TLS_SESSION_REUSE", True))
+
+        # Dead connection detection: the MQTT keepalive, the kernel TCP keepalive / TCP_USER_TIMEOUT and, for the devices with
+        # LIVENESS_PROBE, the probes adapting to the round trip time of the link.
+        self._keepalive = settings.get("KEEPALIVE", 60)
+        self._tcp_keepalive = settings.get("TCP_KEEPALIVE", 0)
+        self._tcp_user_timeout = settings.get("TCP_USER_TIMEOUT", 0)
+        self._liveness_settings = {key: settings[key] for key in self.LIVENESS_KEYS if key in settings}
+        self._liveness = LivenessMonitor(self.__send_probe, self.__connection_dead, log=self._log)
+
+        self._reload_lock = threading.Lock()
+        self._config_watcher = None
+
+        # Gateway mode: the devices with GATEWAY share the connection of the gateway device instead of their own.
+        # _gateways -> gateway DEV_ID: Gateway, _gateway_devices -> DEV_ID: GatewayDevice.
+        self._gateways = {}
+        self._gateway_devices = {}
+        self._gateway_lock = threading.Lock()
 
         self._reconnect_thread = threading.Thread(target=self.__reconnect)
         self._reconnect_thread.start()
 
-        for device in devices:
+        for device in self._devices:
             if not device.get("STATUS"):
+                self._states.set(device.get("DEV_ID"), DISABLED)
+                continue
+            if device.get("GATEWAY"):
+                self.__attach_gateway_device(device)
+                continue
+            if device.get("LAZY"):
+                self._states.set(device.get("DEV_ID"), IDLE)
                 continue
             self._mqtt_conn = self.__mqtt_connect(device)
 
@@ -76,28 +259,108 @@ class MQTTClient:
         client_key = certs_dir + device.get("CLIENT_KEY")
         ca_cert = certs_dir + device.get("CA_CERT")
         access_token = device.get("ACCESS_TOKEN")
+        serializer = self.__serializer(device)
 
-        client = mqtt_client.Client(client_id=client_id)
+        protocol_v5 = device.get("PROTOCOL") == MQTT_V5
+        # Persistent session: the broker keeps the subscriptions and the QoS 1 / 2 messages of the client id between the connections.
+        persistent_session = device.get("PERSISTENT_SESSION", False) or (protocol_v5 and device.get("SESSION_EXPIRY", 0) > 0)
+        if persistent_session and not client_id:
+            # The session belongs to the client id, a random one would start a new session on every connect.
+            client_id = dev_id
+            self._log.info("Dev ID: %s, no CLIENT_ID for the persistent session, using the DEV_ID", dev_id)
+        if protocol_v5:
+            client = mqtt_client.Client(client_id=client_id, protocol=mqtt_client.MQTTv5)
+        else:
+            client = mqtt_client.Client(client_id=client_id, clean_session=not persistent_session)
         # client = mqtt_client.Client()
         client.connection_flag = False
         client.manual_disconnect = False
+        client.reconnect_delay = self._reconnect_base_delay
+        client.reconnect_failures = 0
+        client.circuit_open = False
         client.is_server = is_server
         client.dev_id = dev_id
         client.dev_type = dev_type
         client.endpoint = endpoint
         client.port = port
         client.sub_topic = sub_topic
+        client.subscriptions = self.__subscriptions(dev_id, sub_topic)
+        client.metrics = self._metrics.device(dev_id)
+        client.deliveries = {}
+        client.max_in_flight = device.get("MAX_IN_FLIGHT", self._max_in_flight)
+        # paho can't change the messages in flight once it connected: the broker's Receive Maximum (MQTT v5) is applied
+        # to the clients created after the first CONNACK of the endpoint.
+        receive_maximum = self._receive_maximums.get((endpoint, port)) if protocol_v5 else None
+        if receive_maximum is not None:
+            client.max_inflight_messages_set(min(client.max_in_flight, receive_maximum) if client.max_in_flight else receive_maximum)
+        else:
+            client.max_inflight_messages_set(client.max_in_flight)
+        client.max_queued_messages_set(device.get("MAX_QUEUED", self._max_queued))
+        client.connect_started = None
+        client.tls_context = None
+        # (ca_cert, client_cert, client_key, tls_version) of the TLS methods, the context is looked up again before every connect.
+        client.tls_files = None
+        client.keepalive = int(device.get("KEEPALIVE", self._keepalive))
+        client.tcp_keepalive = device.get("TCP_KEEPALIVE", self._tcp_keepalive)
+        client.tcp_user_timeout = device.get("TCP_USER_TIMEOUT", self._tcp_user_timeout)
+        client.liveness = self.__probe_policy(device)
+        # MQTT v5 (PROTOCOL 5): the topic aliases of the connection (TopicAliases, set on CONNACK) and the CONNECT / PUBLISH properties.
+        client.protocol_v5 = protocol_v5
+        client.topic_aliases = None
+        client.topic_alias_maximum = device.get("TOPIC_ALIAS_MAXIMUM", 10)
+        client.alias_lock = threading.Lock() if protocol_v5 else None
+        client.receive_maximum = device.get("RECEIVE_MAXIMUM", 0)
+        client.session_expiry = device.get("SESSION_EXPIRY", 3600 if persistent_session else 0)
+        client.persistent_session = persistent_session
+        # topic filter -> QoS subscribed on the broker, kept by the persistent session between the connections.
+        client.session_subscriptions = {}
+        client.user_properties = user_property_pairs(device.get("USER_PROPERTIES"))
+        client.lazy = device.get("LAZY", False)
+        client.idle = False
+        client.idle_timeout = device.get("IDLE_TIMEOUT", self._lazy_idle_timeout)
+        client.last_activity = time.monotonic()
+        # Messages published while a lazy client connects, sent by on_connect. None once connected.
+        client.lazy_pending = [] if client.lazy else None
+        client.lazy_pending_lock = threading.Lock()
+        client.gateway = self._gateways.get(dev_id)
+        if client.gateway is not None:
+            client.gateway.kind = self.__gateway_kind(device)
         client.pub_topic = pub_topic
+        client.serializer = serializer
+        client.batch = self.__batch_policy(device, serializer)
+        self.__apply_rate_limit(client, device)
+        client.deserialize = device.get("DESERIALIZE", False)
+        client.raw_message = device.get("RAW_MESSAGE", False)
+        client.outbound_queue = self.__outbound_queue(dev_id) if device.get("STORE_AND_FORWARD") else None
+        client.connect_timeout = self._connect_timeout
+        # Holds a connect slot of its broker (__acquire_endpoint), set when a parked client is handed one.
+        client.endpoint_slot = False
         client.on_connect = self.__on_connect
         client.on_message = self.__on_message
         client.on_publish = self.__on_publish
         client.on_disconnect = self.__on_disconnect
         client.on_subscribe = self.__on_subscribe
+        client.on_unsubscribe = self.__on_unsubscribe
+        if not self.__apply_connection_method(client, connection_method, username, password, ca_cert, client_cert, client_key, access_token):
+            # Not registered anywhere, publish can't pick the client up.
+            self._states.set(dev_id, DISABLED)
+            return None
+
+        self._network_loop.register(client)
 
         # Have all the clients with the status of False in this list. The status will be changed to true once the connection estabilished.
         self._client_list_connected[dev_id] = client
-        self._clients_status[dev_id] = "DISCONNECTED"
+        self._states.set(dev_id, CONNECTING)
 
+        if client.lazy:
+            self.__track_lazy(client)
+        self._safe_connect_queue.put(client)
+        return client
+
+    def __apply_connection_method(self, client, connection_method, username, password, ca_cert, client_cert, client_key, access_token):
+        """
+        Credentials / TLS of the CONNECTION_METHOD. False if they're missing or invalid, or the method is unknown.
+        """
         # Method 0
         if connection_method == ConnectionMethod.BASIC.value:
             self._log.info("ConnectionMethod is BASIC")
@@ -116,28 +379,22 @@ class MQTTClient:
                 )
             else:
                 self._log.error("ConnectionMethod BASIC_WITH_USER_CREDENTIAL is selected but no usernmae and password is provided")
-                client = None
-                return None
+                return False
 
         # Method 2
         elif connection_method == ConnectionMethod.BASIC_TLS.value:
             self._log.info("ConnectionMethod is BASIC_TLS")
             if ca_cert and os.path.isfile(ca_cert):
                 try:
-                    client.tls_set(
-                        ca_certs=ca_cert,
-                        cert_reqs=ssl.CERT_REQUIRED,
-                        tls_version=ssl.PROTOCOL_TLSv1_2
-                    )
-                    client.tls_insecure_set(False)
+                    client.tls_files = (ca_cert, None, None, ssl.PROTOCOL_TLSv1_2)
+                    client.tls_context = self._tls_contexts.get(*client.tls_files)
+                    client.tls_set_context(client.tls_context)
                 except Exception as e:
-                    self._log.error(f"{e}")
-                    client = None
-                    return None
+                    self._log.error("%s", e)
+                    return False
             else:
                 self._log.error("ConnectionMethod BASIC_TLS is selected but no ca_cert is provided")
-                client = None
-                return None
+                return False
 
         # Method 3
         elif connection_method == ConnectionMethod.BASIC_TLS_WITH_USER_CREDENTIAL.value:
@@ -149,44 +406,34 @@ class MQTTClient:
                 )
             else:
                 self._log.error("ConnectionMethod BASIC_WITH_USER_CREDENTIAL is selected but no usernmae and password is provided")
-                client = None
-                return None
+                return False
 
             if ca_cert and os.path.isfile(ca_cert):
                 try:
-                    client.tls_set(
-                        ca_certs=ca_cert,
-                        cert_reqs=ssl.CERT_REQUIRED,
-                        tls_version=ssl.PROTOCOL_TLSv1_2
-                    )
-                    client.tls_insecure_set(False)
+                    client.tls_files = (ca_cert, None, None, ssl.PROTOCOL_TLSv1_2)
+                    client.tls_context = self._tls_contexts.get(*client.tls_files)
+                    client.tls_set_context(client.tls_context)
                 except Exception as e:
-                    self._log.error(f"{e}")
-                    client = None
-                    return None
+                    self._log.error("%s", e)
+                    return False
             else:
                 self._log.error("ConnectionMethod BASIC_TLS is selected but no ca_cert is provided")
-                client = None
-                return None
+                return False
 
         # Method 4
         elif connection_method == ConnectionMethod.MTLS.value:
             self._log.info("ConnectionMethod is MTLS")
             if ca_cert and client_cert and client_key and os.path.isfile(ca_cert) and os.path.isfile(client_cert) and os.path.isfile(client_key):
                 try:
-                    client.tls_set(
-                        ca_certs=ca_cert,
-                        certfile=client_cert,
-                        keyfile=client_key
-                    )
+                    client.tls_files = (ca_cert, client_cert, client_key, ssl.PROTOCOL_TLS_CLIENT)
+                    client.tls_context = self._tls_contexts.get(*client.tls_files)
+                    client.tls_set_context(client.tls_context)
                 except Exception as e:
-                    self._log.error(f"{e}")
-                    client = None
-                    return None
+                    self._log.error("%s", e)
+                    return False
             else:
                 self._log.error("ConnectionMethod MTLS is selected but missing certificates")
-                client = None
-                return None
+                return False
 
         # Method 5
         elif connection_method == ConnectionMethod.MTLS_WITH_USER_CRDENTIAL.value:
@@ -198,24 +445,19 @@ class MQTTClient:
                 )
             else:
                 self._log.error("ConnectionMethod BASIC_WITH_USER_CREDENTIAL is selected but no usernmae and password is provided")
-                client = None
-                return None
+                return False
 
             if ca_cert and client_cert and client_key and os.path.isfile(ca_cert):
                 try:
-                    client.tls_set(
-                        ca_certs=ca_cert,
-                        certfile=client_cert,
-                        keyfile=client_key
-                    )
+                    client.tls_files = (ca_cert, client_cert, client_key, ssl.PROTOCOL_TLS_CLIENT)
+                    client.tls_context = self._tls_contexts.get(*client.tls_files)
+                    client.tls_set_context(client.tls_context)
                 except Exception as e:
-                    self._log.error(f"{e}")
-                    client = None
-                    return None
+                    self._log.error("%s", e)
+                    return False
             else:
                 self._log.error("ConnectionMethod MTLS is selected but missing certificates")
-                client = None
-                return None
+                return False
 
         # Method 6
         elif connection_method == ConnectionMethod.THINGSBOARD.value:
@@ -224,48 +466,400 @@ class MQTTClient:
                 client.username_pw_set(access_token)
             else:
                 self._log.error("ConnectionMethod THINGSBOARD is selected but no access_token is provided")
-                client = None
-                return None
+                return False
         else:
             self._log.error("No ConnectionMethod is providec... Exiting")
+            return False
+        return True
+
+    def __serializer(self, device):
+        serializer_name = device.get("SERIALIZER", "json")
+        serializer = get_serializer(serializer_name)
+        if serializer is None:
+            self._log.error("SERIALIZER %s is not available (unknown or the package is not installed), using json", serializer_name)
+            serializer = get_serializer("json")
+        return serializer
+
+    def __batch_policy(self, device, serializer):
+        """
+        The BatchPolicy of the device, None if it doesn't batch (BATCH_INTERVAL 0).
+        """
+        interval = device.get("BATCH_INTERVAL", 0)
+        if not interval or interval <= 0:
             return None
+        batch_format = device.get("BATCH_FORMAT", "thingsboard")
+        if batch_format not in BATCH_FORMATS:
+            self._log.error("Dev ID: %s, BATCH_FORMAT %s is not one of %s, using thingsboard", device.get("DEV_ID"), batch_format, BATCH_FORMATS)
+            batch_format = "thingsboard"
+        return BatchPolicy(interval, device.get("BATCH_MAX_MESSAGES", 100), batch_format, device.get("BATCH_COALESCE", False), serializer)
 
-        self._safe_connect_queue.put(client)
+    def __probe_policy(self, device):
+        """
+        The ProbePolicy of the device, None without LIVENESS_PROBE.
+        """
+        options = dict(self._liveness_settings)
+        options.update((key, device[key]) for key in self.LIVENESS_KEYS if key in device)
+        if not options.get("LIVENESS_PROBE", False):
+            return None
+        return ProbePolicy(options.get("LIVENESS_MIN_INTERVAL", 5), options.get("LIVENESS_MAX_INTERVAL", 30), options.get("LIVENESS_MISSES", 2),
+                           options.get("LIVENESS_MIN_TIMEOUT", 1), device.get("LIVENESS_TOPIC", f"{device.get('DEV_ID')}/liveness"))
+
+    def __send_probe(self, client):
+        """
+        The liveness probe: UNSUBSCRIBE of a filter the client never subscribed, the broker answers UNSUBACK.
+        paho answers the PINGREQ itself and doesn't report the PINGRESP, the UNSUBACK is the same tiny round trip seen by on_unsubscribe.
+        """
+        if not client.connection_flag:
+            return None
+        result, mid = client.unsubscribe(client.liveness.topic)
+        return mid if result == mqtt_client.MQTT_ERR_SUCCESS else None
+
+    def __connection_dead(self, client, state):
+        """
+        The probes got no answer: shut the socket down, paho sees the connection lost and the client reconnects.
+        """
+        self._log.warning("Dev ID: %s, connection dead (liveness probes: %s sent, %s missed, srtt %s ms), reconnecting",
+                          client.dev_id, state.probes, state.missed, round(state.srtt * 1000, 1) if state.srtt is not None else None)
+        sock = client.socket()
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __apply_rate_limit(self, client, device):
+        """
+        The RATE_LIMIT bucket, RATE_LIMIT_POLICY and PRIORITY_TOPICS of the device.
+        """
+        self._rate_limiter.set_device(client.dev_id, device.get("RATE_LIMIT", self._device_rate_limit),
+                                      device.get("RATE_LIMIT_BURST", self._device_rate_limit_burst))
+        policy = device.get("RATE_LIMIT_POLICY", self._rate_limit_policy)
+        if policy not in RATE_LIMIT_POLICIES:
+            self._log.error("Dev ID: %s, RATE_LIMIT_POLICY %s is not one of %s, using delay", client.dev_id, policy, RATE_LIMIT_POLICIES)
+            policy = DELAY
+        client.rate_limit_policy = policy
+        client.priority_topics = device.get("PRIORITY_TOPICS", [])
+
+    @staticmethod
+    def __gateway_kind(device):
+        """
+        GATEWAY_PROTOCOL of the gateway device, ThingsBoard gateway API by default for CONNECTION_METHOD 6, the devices' own topics otherwise.
+        """
+        if device is None:
+            return TOPIC
+        return device.get("GATEWAY_PROTOCOL") or (THINGSBOARD if device.get("CONNECTION_METHOD") == ConnectionMethod.THINGSBOARD.value else TOPIC)
+
+    def __attach_gateway_device(self, device):
+        """
+        Add the device to the connection of its gateway (GATEWAY -> DEV_ID of the gateway device). Joins right away if the gateway is connected.
+        """
+        dev_id = device.get("DEV_ID")
+        gateway_device = GatewayDevice(device, self.__subscriptions(dev_id, device.get("SUBSCRIBE_TOPIC")), self.__serializer(device))
+        with self._gateway_lock:
+            if dev_id in self._gateway_devices:
+                self._log.info("dev_id %s is already attached to a gateway, Not doing anything", dev_id)
+                return
+            gateway = self._gateways.get(gateway_device.gateway_id)
+            if gateway is None:
+                gateway = Gateway(gateway_device.gateway_id, self.__gateway_kind(self._devices.get(gateway_device.gateway_id)))
+                self._gateways[gateway_device.gateway_id] = gateway
+            self._gateway_devices[dev_id] = gateway_device
+        self.__apply_rate_limit(gateway_device, device)
+        gateway.attach(gateway_device)
+        gateway_state = self._states.get(gateway_device.gateway_id)
+        self._states.set(dev_id, gateway_state if gateway_state in (BACKOFF, DISABLED) else CONNECTING)
+        self._log.info("Dev ID: %s attached to the gateway %s", dev_id, gateway_device.gateway_id)
+
+        client = self._client_list_connected.get(gateway_device.gateway_id) or self._client_list_disconnected.get(gateway_device.gateway_id)
+        if client is not None:
+            client.gateway = gateway
+            if client.connection_flag:
+                if gateway.kind == TOPIC and gateway_device.subscriptions:
+                    self.__client_subscribe(client, gateway_device.subscriptions)
+                self.__gateway_announce(client, gateway_device)
+
+    def __detach_gateway_device(self, dev_id):
+        """
+        Remove the device from its gateway. Returns False if the device is not a gateway device.
+        """
+        with self._gateway_lock:
+            gateway_device = self._gateway_devices.pop(dev_id, None)
+        if gateway_device is None:
+            return False
+        self._rate_limiter.remove_device(dev_id)
+        gateway = self._gateways[gateway_device.gateway_id]
+        _, unused = gateway.detach(dev_id)
+        self._states.remove(dev_id)
+        client = self._client_list_connected.get(gateway_device.gateway_id)
+        if client is not None and client.connection_flag:
+            farewell = gateway.farewell(gateway_device)
+            if farewell:
+                client.publish(*farewell, qos=1)
+            if gateway.kind == TOPIC and unused:
+                self.__client_unsubscribe(client, unused)
+        self._log.info("Dev ID: %s detached from the gateway %s", dev_id, gateway_device.gateway_id)
+        return True
+
+    def __gateway_connected(self, client):
+        """
+        on_connect of a gateway client: announce its devices (their topics are subscribed by __subscribe).
+        """
+        for gateway_device in client.gateway.devices():
+            self.__gateway_announce(client, gateway_device)
+
+    def __gateway_announce(self, client, gateway_device):
+        announce = client.gateway.announce(gateway_device)
+        if announce:
+            client.publish(*announce, qos=1)
+        self._states.set(gateway_device.dev_id, CONNECTED)
+
+    def __publish_gateway(self, gateway_device, message, topic, qos, retain, timeout, priority, content_type=None, user_properties=None):
+        """
+        Publish the message of the device on the connection of its gateway, within its own rate limits and the gateway's.
+        """
+        if priority is None:
+            priority = self.__priority(gateway_device, topic or gateway_device.pub_topic)
+        gateway_id = gateway_device.gateway_id
+        client = self._client_list_connected.get(gateway_id) or self._client_list_disconnected.get(gateway_id)
+        if not client or client.gateway is None:
+            return self.__publish_failed(f"No client available for the gateway {gateway_id} of dev_id: {gateway_device.dev_id}")
+        if client.outbound_queue is None and gateway_id not in self._client_list_connected:
+            return self.__publish_failed(f"The gateway {gateway_id} of dev_id: {gateway_device.dev_id} is not connected")
+        try:
+            if not isinstance(message, (str, bytes, bytearray)) and client.gateway.kind == TOPIC:
+                message = gateway_device.serializer.encode(message)
+            topic, message_str = client.gateway.outbound(gateway_device, topic or gateway_device.pub_topic, message)
+        except (TypeError, ValueError) as e:
+            return self.__publish_failed(f"Invalid message for the gateway {gateway_id}, dev_id: {gateway_device.dev_id}, error: {e}")
+        return self.__send(client, topic, message_str, qos, retain, self._publish_timeout if timeout is None else timeout, priority,
+                           self.__publish_properties(client, content_type, user_properties), gateway_device)
+
+    def __wait_connect_slot(self):
+        """
+        CONNECT_RATE > 0: wait for the next connect slot. The slots are 1 / CONNECT_RATE seconds apart (+-CONNECT_RATE_JITTER), shared by all the workers,
+        so a large fleet ramps up at the configured rate instead of hitting the broker all at once.
+        """
+        if self._connect_rate <= 0:
+            return
+        with self._connect_rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._connect_next_slot)
+            self._connect_next_slot = slot + random.uniform(1 - self._connect_rate_jitter, 1 + self._connect_rate_jitter) / self._connect_rate
+        if slot > now:
+            self._stop_event.wait(slot - now)
+
+    def __track_lazy(self, client):
+        """
+        Watch the idle time of the lazy client, the idle thread is started with the first lazy client.
+        """
+        with self._lazy_lock:
+            self._lazy_clients[client.dev_id] = client
+            if self._lazy_thread is None:
+                self._lazy_thread = threading.Thread(target=self.__lazy_idle, name="lazy_idle", daemon=True)
+                self._lazy_thread.start()
+
+    def __lazy_idle(self):
+        """
+        Disconnect the lazy clients without publish / received message for their IDLE_TIMEOUT. The device stays registered, status IDLE.
+        """
+        while not self._stop_event.wait(1):
+            now = time.monotonic()
+            with self._lazy_lock:
+                clients = list(self._lazy_clients.values())
+            for client in clients:
+                if self._client_list_connected.get(client.dev_id) is not client and self._client_list_disconnected.get(client.dev_id) is not client:
+                    # Removed, or replaced by reload.
+                    with self._lazy_lock:
+                        if self._lazy_clients.get(client.dev_id) is client:
+                            del self._lazy_clients[client.dev_id]
+                    continue
+                # Checked and marked idle under lazy_pending_lock, held by __send_now: a publish either came first (last_activity)
+                # or sees client.idle and wakes a new client, it never sends on the socket being closed.
+                with client.lazy_pending_lock:
+                    if now - client.last_activity < client.idle_timeout or client.deliveries or client.lazy_pending:
+                        continue
+                    client.idle = True
+                    client.manual_disconnect = True
+                    client.connection_flag = False
+                    self._client_list_connected.pop(client.dev_id, None)
+                self._log.info("Dev ID: %s, idle for %s seconds, disconnecting", client.dev_id, client.idle_timeout)
+                with self._lazy_lock:
+                    self._lazy_clients.pop(client.dev_id, None)
+                self.__cancel_reconnect(client.dev_id)
+                self._states.set(client.dev_id, IDLE)
+                try:
+                    client.disconnect()
+                    self._network_loop.stop(client)
+                except Exception as error:
+                    self._log.error("Error disconnecting dev_id: %s, type: %s error: %s", client.dev_id, client.dev_type, error)
+
+    def __wake(self, dev_id):
+        """
+        Connect the idle lazy device. Returns its new client, None if the device is not a lazy device.
+        """
+        device = self._devices.get(dev_id)
+        if not device or not device.get("LAZY") or not device.get("STATUS"):
+            return None
+        with self._lazy_lock:
+            client = self._client_list_connected.get(dev_id) or self._client_list_disconnected.get(dev_id)
+            if client is None:
+                self._log.info("Dev ID: %s, waking up the lazy device", dev_id)
+                client = self.__mqtt_connect(device)
+        return client
+
+    def __flush_lazy(self, client):
+        """
+        on_connect of a lazy client, publish the messages kept while connecting, in order.
+        """
+        with client.lazy_pending_lock:
+            pending, client.lazy_pending = client.lazy_pending, None
+            for topic, message_str, qos, retain, timeout, properties, future in pending:
+                self.__chain(self.__publish(client, topic, message_str, qos, retain, timeout, properties), future)
+
+    def __fail_lazy_pending(self, client, reason):
+        if not client.lazy:
+            return
+        with client.lazy_pending_lock:
+            pending = client.lazy_pending or []
+            if client.lazy_pending is not None:
+                client.lazy_pending = []
+        for *_, future in pending:
+            if not future.done():
+                future.set_exception(PublishError(reason))
+
+    @staticmethod
+    def __chain(source, target):
+        def done(source):
+            if target.done():
+                return
+            if source.exception() is not None:
+                target.set_exception(source.exception())
+            else:
+                target.set_result(source.result())
+        source.add_done_callback(done)
+
+    def __acquire_endpoint(self, client):
+        """
+        Take a connect slot of the client's broker (ENDPOINT, PORT), at most CONNECT_PER_ENDPOINT.
+        False if they're all taken: the client is parked and put back on _safe_connect_queue by __release_endpoint with the slot.
+        """
+        key = (client.endpoint, client.port)
+        with self._endpoint_lock:
+            active = self._endpoint_active.get(key, 0)
+            if active < max(1, self._connect_per_endpoint):
+                self._endpoint_active[key] = active + 1
+                client.endpoint_slot = True
+                return True
+            self._endpoint_pending.setdefault(key, collections.deque()).append(client)
+            return False
+
+    def __release_endpoint(self, client):
+        """
+        Give the slot to the next parked client of the broker, or free it.
+        """
+        key = (client.endpoint, client.port)
+        client.endpoint_slot = False
+        with self._endpoint_lock:
+            pending = self._endpoint_pending.get(key)
+            if pending:
+                parked = pending.popleft()
+                parked.endpoint_slot = True
+                self._safe_connect_queue.put(parked)
+                return
+            self._endpoint_pending.pop(key, None)
+            self._endpoint_active[key] -= 1
 
     def __safe_connect(self):
         """
-        Connecting the clients to mqtt brokers from _safe_connect_queue.
-        Update _client_list_connected, _client_list_disconnected, _clients_status.
+        Connect worker. CONNECT_WORKERS of these take the clients from _safe_connect_queue and connect them to the mqtt brokers in parallel.
+        At most CONNECT_PER_ENDPOINT clients are connecting to the same broker at a time, so an unreachable broker only holds its own devices.
+        Update _client_list_connected, _client_list_disconnected, _states.
         """
         while not self._stop_event.is_set():
             try:
                 client = self._safe_connect_queue.get(timeout=1)
-                self._log.info(f"From queue dev_id: {client.dev_id} retrived")
+                self._log.info("From queue dev_id: %s retrived", client.dev_id)
             except queue.Empty:
-                time.sleep(3)
                 continue
-            self._log.info(f"Safe Connecting: Dev ID: {client.dev_id}, Dev Type: {client.dev_type}")
-            for attempt in range(0, 3):
-                if not self._stop_event.is_set():
-                    try:
-                        if not client.connection_flag:
-                            client.connect(client.endpoint, client.port, keepalive=60)
-                            client.loop_start()
-                            self._log.info(f"Dev ID: {client.dev_id}, Dev Type: {client.dev_type}, Attempt:{attempt} Success...")
-                            self._client_list_connected[client.dev_id] = client
-                            self._client_list_disconnected.pop(client.dev_id, None)
-                            self._clients_status[client.dev_id] = "CONNECTED"
-                            break
-                    except Exception as e:
-                        self._log.error(f"Dev ID: {client.dev_id}, Dev Type: {client.dev_type}, Attempt:{attempt} Failed... error: {e}")
-                        if not self._stop_event.is_set():
-                            time.sleep(3)
-            else:
-                if self._stop_event.is_set():
-                    self._log.error(f"stop_event is set, skipping remaining tries for Dev ID: {client.dev_id}, Dev Type: {client.dev_type}")
-                self._log.error(f"Dev ID: {client.dev_id}, Dev Type: {client.dev_type}, All Attempts Failed...")
-                self._client_list_disconnected[client.dev_id] = client
-                self._clients_status[client.dev_id] = "DISCONNECTED"
+            if client.manual_disconnect:
+                # Removed by mqtt_disconnect while waiting in the queue.
+                if client.endpoint_slot:
+                    self.__release_endpoint(client)
+                continue
+
+            if not client.endpoint_slot and not self.__acquire_endpoint(client):
+                # The broker is busy with other connects: parked until a slot is free, the workers go on with the other brokers.
+                continue
+
+            try:
+                self._log.info("Safe Connecting: Dev ID: %s, Dev Type: %s", client.dev_id, client.dev_type)
+                for attempt in range(0, 3):
+                    if not self._stop_event.is_set():
+                        try:
+                            if not client.connection_flag:
+                                self.__wait_connect_slot()
+                                client.metrics.connect_attempts += 1
+                                client.connect_started = time.perf_counter()
+                                self.__refresh_tls_context(client)
+                                self.__connect_client(client)
+                                self._network_loop.start(client)
+                                self._log.info("Dev ID: %s, Dev Type: %s, Attempt:%s Success...", client.dev_id, client.dev_type, attempt)
+                                self._client_list_connected[client.dev_id] = client
+                                self._client_list_disconnected.pop(client.dev_id, None)
+                                # CONNECTING until the CONNACK (on_connect).
+                                break
+                        except Exception as e:
+                            self._log.error("Dev ID: %s, Dev Type: %s, Attempt:%s Failed... error: %s", client.dev_id, client.dev_type, attempt, e)
+                            self._stop_event.wait(self._connect_retry_delay)
+                else:
+                    if self._stop_event.is_set():
+                        self._log.error("stop_event is set, skipping remaining tries for Dev ID: %s, Dev Type: %s", client.dev_id, client.dev_type)
+                    self._log.error("Dev ID: %s, Dev Type: %s, All Attempts Failed...", client.dev_id, client.dev_type)
+                    self.__fail_lazy_pending(client, f"Dev ID: {client.dev_id} could not connect")
+                    self._client_list_disconnected[client.dev_id] = client
+                    self._states.set(client.dev_id, BACKOFF)
+                    self.__schedule_reconnect(client)
+            finally:
+                self.__release_endpoint(client)
+
+    def __refresh_tls_context(self, client):
+        """
+        The same client is reused by the reconnects: take the current context of its TLS files from the cache,
+        a CA / cert / key rotated on disk since the last connect is used by this one.
+        """
+        if client.tls_files is None:
+            return
+        context = self._tls_contexts.get(*client.tls_files)
+        if context is client.tls_context:
+            return
+        # paho refuses a second tls_set_context, its context is dropped first.
+        client._ssl_context = None
+        client.tls_set_context(context)
+        client.tls_context = context
+        self._log.info("Dev ID: %s, TLS files changed on disk, new TLS context", client.dev_id)
+
+    def __connect_client(self, client):
+        if not client.protocol_v5:
+            client.connect(client.endpoint, client.port, keepalive=client.keepalive)
+            return
+        with client.alias_lock:
+            # The aliases of the old connection are not set on the new one.
+            client.topic_aliases = None
+        client.connect(client.endpoint, client.port, keepalive=client.keepalive, clean_start=not client.persistent_session,
+                       properties=connect_properties(client.receive_maximum, client.session_expiry))
+
+    def __connected_v5(self, client, properties):
+        """
+        CONNACK of a MQTT v5 client: the topic aliases and the QoS 1 / 2 messages in flight (Receive Maximum) allowed by the broker.
+        """
+        alias_maximum = min(client.topic_alias_maximum, property_value(properties, "TopicAliasMaximum", 0))
+        client.topic_aliases = TopicAliases(alias_maximum) if alias_maximum > 0 else None
+        receive_maximum = property_value(properties, "ReceiveMaximum", 65535)
+        self._receive_maximums[(client.endpoint, client.port)] = receive_maximum
+        if not 0 < client.max_inflight_messages <= receive_maximum:
+            self._log.warning("Dev ID: %s, MAX_IN_FLIGHT %s is over the broker's Receive Maximum %s, lowered for the next clients of the endpoint",
+                              client.dev_id, client.max_inflight_messages, receive_maximum)
+        self._log.debug("Dev ID: %s, MQTT v5 connected, topic aliases: %s, receive maximum: %s", client.dev_id, alias_maximum, receive_maximum)
 
     def __disconnect(self):
         self._disconnect_thread = threading.Thread(target=self.__disconnect_thread)
@@ -276,126 +870,429 @@ class MQTTClient:
         Disconnect the clients frm _client_list_connected.
         """
         self._log.critical("Disconnecting All clients from MQTT broker...")
+        if self._config_watcher:
+            self._config_watcher.stop()
         for client in self._client_list_connected.values():
             try:
                 client.manual_disconnect = True
                 client.connection_flag = False
                 # self._client_list_connected[client.dev_id] = client
-                client.loop_stop()
+                # disconnect first, it wakes up the network thread which then exits right away (loop_stop alone waits up to 1 second).
                 client.disconnect()
+                self._network_loop.stop(client)
             except Exception as error:
-                self._log.error(f"Error disconnecting {client.dev_type} client: {error}")
+                self._log.error("Error disconnecting %s client: %s", client.dev_type, error)
 
+        self._network_loop.shutdown()
+        if self._outbound_store:
+            self._outbound_store.close()
+        if self._dispatcher:
+            self._dispatcher.stop()
+        self._metrics.stop()
+        for client in list(self._client_list_connected.values()) + list(self._client_list_disconnected.values()):
+            self._deliveries.disconnected(client.deliveries, final=True)
+        self._deliveries.stop()
+        self._states.stop()
         print("All disconnection done...")
         self._log.critical("All disconnection done...")
 
+    def __outbound_queue(self, dev_id):
+        """
+        Return the store and forward queue of the device. The store and the drain thread are created on the first use.
+        The queue already holds the messages left from the last run.
+        """
+        with self._outbound_store_lock:
+            if self._outbound_store is None:
+                self._outbound_store = OutboundStore(self._store_dir, self._store_max_bytes, self._store_segment_bytes, self._store_fsync_interval)
+                self._drain_thread = threading.Thread(target=self.__drain, name="outbound_drain")
+                self._drain_thread.start()
+        return self._outbound_store.queue(dev_id)
+
+    def __drain(self):
+        """
+        Publish the stored messages of the connected devices in order, at most STORE_DRAIN_RATE messages per second per device.
+        A message is removed from the queue only after paho accepted it.
+        """
+        drain_tick = 0.1
+        budget = max(1, int(self._store_drain_rate * drain_tick))
+        while not self._stop_event.is_set():
+            self._drain_event.wait(drain_tick)
+            self._drain_event.clear()
+            for dev_id in list(self._outbound_backlog):
+                client = self._client_list_connected.get(dev_id)
+                if not client or not client.connection_flag:
+                    continue
+                outbound_queue = client.outbound_queue
+                with outbound_queue.lock:
+                    last_position = None
+                    for topic, payload, qos, retain, position in outbound_queue.peek(budget):
+                        if self._rate_limiter.enabled and self._rate_limiter.acquire(dev_id, (client.endpoint, client.port), max_delay=0, retry=True) is None:
+                            # Over the rate limits, the next tick.
+                            break
+                        start = time.perf_counter()
+                        # The stored messages keep only the device USER_PROPERTIES (MQTT v5).
+                        result = self.__client_publish(client, topic, payload, qos, retain, self.__publish_properties(client))
+                        if result.rc != mqtt_client.MQTT_ERR_SUCCESS:
+                            break
+                        self._metrics.published(client.metrics, result.mid, len(payload), start)
+                        self._deliveries.track(client.deliveries, result.mid, qos)
+                        last_position = position
+                    if last_position:
+                        outbound_queue.commit(last_position)
+                    if outbound_queue.empty():
+                        self._outbound_backlog.discard(dev_id)
+                        self._log.info("Dev ID: %s, Stored messages are drained", dev_id)
+
+    def __schedule_reconnect(self, client):
+        """
+        Push the client to _reconnect_heap with the next backoff deadline. Nothing is done if it's already scheduled.
+        The delay is decorrelated jitter: random between RECONNECT_BASE_DELAY and 3 x the previous delay, capped at RECONNECT_MAX_DELAY.
+        """
+        if self._stop_event.is_set() or client.manual_disconnect:
+            return
+        with self._reconnect_condition:
+            if client.dev_id in self._reconnect_deadlines:
+                return
+            client.reconnect_failures += 1
+            if client.reconnect_failures > self._reconnect_max_failures:
+                # Circuit open. Keep trying, but rarely, and let the owner know the device is keep failing.
+                delay = self._reconnect_circuit_open_time
+                if not client.circuit_open:
+                    self._log.warning("Dev ID: %s, %s reconnects failed in a row. Retrying only every %s seconds", client.dev_id, client.reconnect_failures - 1, delay)
+                client.circuit_open = True
+            else:
+                delay = min(self._reconnect_max_delay, random.uniform(self._reconnect_base_delay, client.reconnect_delay * 3))
+                client.reconnect_delay = delay
+
+            deadline = time.monotonic() + delay
+            self._reconnect_seq += 1
+            self._reconnect_deadlines[client.dev_id] = deadline
+            heapq.heappush(self._reconnect_heap, (deadline, self._reconnect_seq, client.dev_id))
+            self._reconnect_condition.notify()
+        self._log.info("Dev ID: %s, Reconnect scheduled in %.2f seconds, failures: %s", client.dev_id, delay, client.reconnect_failures)
+
+    def __cancel_reconnect(self, dev_id):
+        """
+        Drop the scheduled reconnect of the dev_id. The heap entry is skipped when it's popped.
+        """
+        with self._reconnect_condition:
+            self._reconnect_deadlines.pop(dev_id, None)
+        client = self._client_list_disconnected.pop(dev_id, None)
+        if client:
+            client.manual_disconnect = True
+
+    def __reset_reconnect(self, client):
+        """
+        The client is connected, start the backoff from the beginning next time.
+        """
+        if client.circuit_open:
+            self._log.info("Dev ID: %s, Connected again, circuit closed", client.dev_id)
+        client.reconnect_delay = self._reconnect_base_delay
+        client.reconnect_failures = 0
+        client.circuit_open = False
+
     def __reconnect(self):
         """
-        Attempt to reconnect the clients in _client_list_disconnected.
+        Reconnect scheduler. Sleeps until the earliest deadline in _reconnect_heap, then hands the same client object to the connect workers.
         """
         while not self._stop_event.is_set():
-            if not self._client_list_disconnected:
-                # Check the _client_list_disconnected for every 2 seconds.
-                time.sleep(2)
+            with self._reconnect_condition:
+                if not self._reconnect_heap:
+                    self._reconnect_condition.wait(1)
+                    continue
+                deadline, _, dev_id = self._reconnect_heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._reconnect_condition.wait(min(delay, 1))
+                    continue
+                heapq.heappop(self._reconnect_heap)
+                if self._reconnect_deadlines.get(dev_id) != deadline:
+                    # Cancelled or rescheduled.
+                    continue
+                del self._reconnect_deadlines[dev_id]
+
+            client = self._client_list_disconnected.get(dev_id)
+            if not client or client.manual_disconnect:
                 continue
-            for dev_id, client in list(self._client_list_disconnected.items()):
-                if not self._stop_event.is_set():
-                    self._log.warning(f"Reconnecting to dev_id: {dev_id}")
-                    matched_device = next(
-                        (device for device in self._mqtt_json_data.get("DEVICE", []) if device.get("DEV_ID") == dev_id),
-                        None
-                    )
-                    if matched_device:
-                        if matched_device.get("STATUS"):
-                            try:
-                                self.__mqtt_connect(matched_device)
-                                del self._client_list_disconnected[dev_id]
-                            except:
-                                self._log.info(f"Reconnection failed dev_id: {dev_id}")
-                        else:
-                            self._log.warning("matched_device status set to FALSE. Not trying to reconnect")
-                    else:
-                        self._log.error(f"No matched_device found for dev_id: {dev_id}")
-
-            # Wait for some more time.
-            if not self._stop_event.is_set():
-                time.sleep(5)
-
-            #TODO !!!. If the device is keep failing. Don't connect it to the broker. Instead send some warning.
-
-    def __on_connect(self, client, userdata, flags, rc):
+
+            matched_device = self._devices.get(dev_id)
+            if not matched_device:
+                self._log.error("No matched_device found for dev_id: %s", dev_id)
+                self._client_list_disconnected.pop(dev_id, None)
+                self._states.remove(dev_id)
+            elif not matched_device.get("STATUS"):
+                self._log.warning("matched_device status set to FALSE. Not trying to reconnect")
+                self._client_list_disconnected.pop(dev_id, None)
+                self._states.set(dev_id, DISABLED)
+            else:
+                self._log.warning("Reconnecting to dev_id: %s", dev_id)
+                client.metrics.reconnects += 1
+                self._states.set(dev_id, CONNECTING)
+                self._safe_connect_queue.put(client)
+
+    def __on_connect(self, client, userdata, flags, rc, properties=None):
         """
         On connect subscribe to the topic.
-        Update _client_list_connected, _client_list_disconnected, _clients_status.
+        Update _client_list_connected, _client_list_disconnected, _states.
+        rc is a ReasonCode and properties the CONNACK properties for MQTT v5, properties is None for MQTT 3.1.1.
         """
         if rc == 0:
-            self._log.info(f"Dev ID: {client.dev_id}, Dev Type: {client.dev_type}, Connected to MQTT Broker Successfully!")
+            self._log.info("Dev ID: %s, Dev Type: %s, Connected to MQTT Broker Successfully!", client.dev_id, client.dev_type)
             client.connection_flag = True
+            if client.connect_started is not None:
+                self._metrics.connect_seconds.observe(time.perf_counter() - client.connect_started)
+                client.connect_started = None
+            if client.tls_context is not None and client.tls_context.save_session(client.endpoint, client.socket()):
+                self._log.debug("Dev ID: %s, TLS session resumed", client.dev_id)
+            if client.tcp_keepalive or client.tcp_user_timeout:
+                try:
+                    set_socket_options(client.socket(), client.tcp_keepalive, client.tcp_user_timeout)
+                except OSError as e:
+                    self._log.error("Dev ID: %s, failed to set TCP_KEEPALIVE / TCP_USER_TIMEOUT: %s", client.dev_id, e)
+            if client.liveness is not None:
+                self._liveness.add(client, client.liveness)
+            self.__reset_reconnect(client)
+            if client.protocol_v5:
+                self.__connected_v5(client, properties)
             self._client_list_connected[client.dev_id] = client
             self._client_list_disconnected.pop(client.dev_id, None)
-            self._clients_status[client.dev_id] = "CONNECTED"
-            self.__subscribe(client)
-            self._log.debug(f"__on_connect: rc==0, self._client_list_connected is: {self._client_list_connected}")
-            self._log.debug(f"__on_connect: rc==0, self._client_list_disconnected is: {self._client_list_disconnected}")
+            self._states.set(client.dev_id, CONNECTED)
+            self.__subscribe(client, self.__session_present(client, flags))
+            if client.gateway is not None:
+                self.__gateway_connected(client)
+            if client.lazy_pending is not None:
+                self.__flush_lazy(client)
+            if client.outbound_queue is not None and not client.outbound_queue.empty():
+                self._outbound_backlog.add(client.dev_id)
+                self._drain_event.set()
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("__on_connect: rc==0, self._client_list_connected is: %s", list(self._client_list_connected))
+                self._log.debug("__on_connect: rc==0, self._client_list_disconnected is: %s", list(self._client_list_disconnected))
         else:
-            self._log.error(f"Dev ID: {client.dev_id}, Dev Type: {client.dev_type}, Failed to connect to MQTT Broker, return code {rc}")
+            self._log.error("Dev ID: %s, Dev Type: %s, Failed to connect to MQTT Broker, return code %s", client.dev_id, client.dev_type, reason_text(rc, properties))
             client.connection_flag = False
             self._client_list_connected.pop(client.dev_id, None)
             self._client_list_disconnected[client.dev_id] = client
-            self._clients_status[client.dev_id] = "DISCONNECTED"
-            self._log.debug(f"__on_connect: rc!=0, rc: {rc}, self._client_list_connected is: {self._client_list_connected}")
-            self._log.debug(f"__on_connect: rc!=0, rc: {rc}, self._client_list_disconnected is: {self._client_list_disconnected}")
+            self._states.set(client.dev_id, BACKOFF)
+            self.__schedule_reconnect(client)
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("__on_connect: rc!=0, rc: %s, self._client_list_connected is: %s", rc, list(self._client_list_connected))
+                self._log.debug("__on_connect: rc!=0, rc: %s, self._client_list_disconnected is: %s", rc, list(self._client_list_disconnected))
+
+    def __session_present(self, client, flags):
+        """
+        True if the broker resumed the persistent session of the client (CONNACK session present).
+        """
+        if not client.persistent_session:
+            return False
+        if flags.get("session present"):
+            client.metrics.sessions_resumed += 1
+            self._log.info("Dev ID: %s, persistent session resumed", client.dev_id)
+            return True
+        # A new session (first connect, expired, other broker): nothing is subscribed.
+        client.session_subscriptions.clear()
+        return False
 
     def __on_message(self, client, userdata, msg):
+        """
+        Hand the message to the dispatcher, the device's messages are handled in order by one worker.
+        """
+        client.metrics.messages_in += 1
+        client.metrics.bytes_in += len(msg.payload)
+        if client.liveness is not None:
+            self._liveness.inbound(client.dev_id)
+        if client.lazy:
+            client.last_activity = time.monotonic()
+        if self._dispatcher:
+            self._dispatcher.dispatch(client.dev_id, self.__handle_message, client, msg)
+        else:
+            self.__handle_message(client, msg)
+
+    def __dispatch_dropped(self, dev_id, client, msg):
+        """
+        The message dropped by DISPATCH_POLICY (the oldest queued one or the new one).
+        """
+        self._log.warning("Inbound queue is full, message dropped: Device ID: %s, Topic: %s", dev_id, msg.topic)
+
+    def __handle_message(self, client, msg):
         """
         If the callback is registered, call it with client and message.
+        The messages of a gateway connection are given to the devices of the gateway they're for.
         """
-        msg_decoded = msg.payload.decode()
-        self._log.debug(f"Message has been received: Device ID: {client.dev_id}, Topic: {client.sub_topic} \n{msg_decoded.replace('\r\n', '\n')}")
-        if self._on_message_cb:
+        if client.gateway is not None:
+            targets = client.gateway.demux(msg)
+            if targets:
+                for gateway_device, gateway_msg in targets:
+                    self.__handle_message(gateway_device, gateway_msg)
+                return
+        if client.raw_message:
+            # on_message_cb gets a MessageView, the payload bytes are not copied or decoded.
+            msg_decoded = MessageView(msg)
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("Message has been received: Device ID: %s, Topic: %s, %s bytes", client.dev_id, msg.topic, len(msg.payload))
+        elif client.deserialize:
+            # on_message_cb gets the decoded object (dict, list, ...) from the device's SERIALIZER.
+            # MQTT v5: the message's content type selects the codec if it's not the device's.
+            serializer = client.serializer
+            content_type = property_value(getattr(msg, "properties", None), "ContentType")
+            if content_type and content_type != serializer.content_type:
+                serializer = serializer_for_content_type(content_type) or serializer
+            try:
+                msg_decoded = serializer.decode(msg.payload)
+            except Exception as e:
+                self._log.error("Failed to decode the message with %s: Device ID: %s, Topic: %s, error: %s", serializer.name, client.dev_id, msg.topic, e)
+                return
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("Message has been received: Device ID: %s, Topic: %s \n%s", client.dev_id, msg.topic, msg_decoded)
+        else:
+            msg_decoded = msg.payload.decode()
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("Message has been received: Device ID: %s, Topic: %s \n%s", client.dev_id, msg.topic, msg_decoded.replace('\r\n', '\n'))
+        # The handlers of the matching routes, on_message_cb if no route matches.
+        handlers = self._router.match(msg.topic) if len(self._router) else None
+        if handlers:
+            start = time.perf_counter()
+            for handler in handlers:
+                handler(client, msg_decoded)
+            self._metrics.callback_done(client.dev_id, msg.topic, start)
+        elif self._on_message_cb:
+            start = time.perf_counter()
             self._on_message_cb(client, msg_decoded)
+            self._metrics.callback_done(client.dev_id, msg.topic, start)
 
     def __on_publish(self, client, userdata, mid):
-        self._log.debug(f"Message {mid} has been published. Device ID: {client.dev_id}, Topic: {client.pub_topic}")
+        self._metrics.acked(client.metrics, mid)
+        self._deliveries.acked(client.deliveries, mid)
+        self._log.debug("Message %s has been published. Device ID: %s, Topic: %s", mid, client.dev_id, client.pub_topic)
 
-    def __on_disconnect(self, client, userdata, rc):
+    def __on_disconnect(self, client, userdata, rc, properties=None):
         """
         The manually/Externally disconnected clients are not added to _client_list_disconnected for the reconnection.
-        Update _client_list_connected, _client_list_disconnected, _clients_status.
+        Update _client_list_connected, _client_list_disconnected, _states.
         Stop the loop to handle the reconnection manually instead of paho auto reconnection.
+        MQTT v5: rc is the reason code of the broker's DISCONNECT (ReasonCode, None if it had none) or the paho error code.
         """
-        self._log.critical(f"Disconnected... Device ID: {client.dev_id}, Is Manual/External disconnection: {client.manual_disconnect}")
+        self._log.critical("Disconnected... Device ID: %s, Is Manual/External disconnection: %s", client.dev_id, client.manual_disconnect)
         client.connection_flag = False
+        if client.liveness is not None:
+            self._liveness.remove(client.dev_id)
+        self._metrics.disconnected(client.metrics)
+        # No reconnect after a manual / idle disconnect or stop: paho won't send the QoS 1 / 2 messages again.
+        self._deliveries.disconnected(client.deliveries, final=client.manual_disconnect or client.idle or self._stop_event.is_set())
 
         if not self._stop_event.is_set():
-            self._client_list_connected.pop(client.dev_id, None)
+            # reload may have connected a new client for the dev_id already, the lists and the status are the new client's.
+            replaced = self._client_list_connected.get(client.dev_id) not in (None, client)
+            if not replaced:
+                self._client_list_connected.pop(client.dev_id, None)
 
-            if client.manual_disconnect == False:
+            if not replaced and client.gateway is not None:
+                # The devices of the gateway wait for it, reconnecting or removed.
+                for gateway_device in client.gateway.devices():
+                    self._states.set(gateway_device.dev_id, IDLE if client.manual_disconnect else BACKOFF)
+
+            if replaced or client.idle:
+                # The new client's / IDLE status.
+                pass
+            elif client.manual_disconnect == False:
                 # The manually disconnected clients are not added to the _client_list_disconnected for the reconnection.
                 self._client_list_disconnected[client.dev_id] = client
+                self._states.set(client.dev_id, BACKOFF)
+                self.__schedule_reconnect(client)
             else:
-                # Clear the record in _clients_status if the device is manually disconnected (ie, deleted)
-                self._clients_status.pop(client.dev_id, None)
+                # Clear the state if the device is manually disconnected (ie, deleted). Not the DISABLED / IDLE state set by reload in the meantime.
+                self._states.remove(client.dev_id, expected=(CONNECTING, CONNECTED, BACKOFF))
 
             # If paho handles the reconnection, don't use loop_stop()
-            client.loop_stop()
-            self._log.debug(f"__on_disconnect: self._client_list_connected is: {self._client_list_connected}")
-            self._log.debug(f"__on_disconnect: self._client_list_disconnected is: {self._client_list_disconnected}")
+            self._network_loop.stop(client)
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("__on_disconnect: self._client_list_connected is: %s", list(self._client_list_connected))
+                self._log.debug("__on_disconnect: self._client_list_disconnected is: %s", list(self._client_list_disconnected))
         if rc != 0:
-            self._log.critical(f"Unexpected disconnection with result code {rc}, attempting to reconnect. Device ID: {client.dev_id}")
+            self._log.critical("Unexpected disconnection with result code %s, attempting to reconnect. Device ID: %s", reason_text(rc, properties), client.dev_id)
 
-    def __on_subscribe(self, client, userdata, mid, granted_qos):
-        self._log.info(f"Subscribed to topic with mid: {mid}, granted QoS: {granted_qos}, Device ID: {client.dev_id}, Topic: {client.sub_topic}")
+    def __on_unsubscribe(self, client, userdata, mid, properties=None, reason_codes=None):
+        if client.liveness is not None:
+            self._liveness.answered(client.dev_id, mid)
 
-    def __subscribe(self, client):
-        if client.sub_topic:
-            result, _ = client.subscribe(client.sub_topic)
-            if result == mqtt_client.MQTT_ERR_SUCCESS:
-                self._log.info(f"Subscribed to topic: {client.sub_topic}")
+    def __on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
+        """
+        granted_qos -> the granted QoS (0x80 refused) for MQTT 3.1.1, the reason codes for MQTT v5.
+        """
+        self._log.info("Subscribed to topic with mid: %s, granted QoS: %s, Device ID: %s, Topic: %s", mid, granted_qos, client.dev_id, client.sub_topic)
+        refused = [code for code in granted_qos if (code.is_failure if hasattr(code, "is_failure") else code == 0x80)]
+        if refused:
+            self._log.error("Subscription refused, Device ID: %s, mid: %s, reason: %s", client.dev_id, mid,
+                            ", ".join(reason_text(code, properties) for code in refused))
+
+    def __subscriptions(self, dev_id, sub_topic):
+        """
+        SUBSCRIBE_TOPIC -> [(filter, qos)]
+        SUBSCRIBE_TOPIC can be a topic string, or a list of topic strings / {"FILTER": "", "QOS": 0}.
+        """
+        if not sub_topic:
+            return []
+        entries = sub_topic if isinstance(sub_topic, list) else [sub_topic]
+        subscriptions = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                topic_filter, qos = entry.get("FILTER"), entry.get("QOS", 0)
             else:
-                self._log.error(f"Failed to subscribe the topic: {client.sub_topic}")
-        else:
-            self._log.warning(f"No SUBSCRIBE_TOPIC in client. Check the device information.")
+                topic_filter, qos = entry, 0
+            try:
+                TopicRouter.validate(topic_filter)
+            except ValueError as e:
+                self._log.error("Dev ID: %s, Invalid SUBSCRIBE_TOPIC entry: %s, error: %s", dev_id, entry, e)
+                continue
+            subscriptions.append((topic_filter, qos))
+        return subscriptions
+
+    def __subscribe(self, client, session_present=False):
+        """
+        Subscribe the topics of the device and of its gateway devices.
+        session_present -> the broker kept the subscriptions of the persistent session, only the ones changed since are (un)subscribed.
+        """
+        subscriptions = dict(client.subscriptions)
+        if client.gateway is not None:
+            for topic_filter, qos in client.gateway.subscriptions():
+                subscriptions[topic_filter] = max(qos, subscriptions.get(topic_filter, 0))
+        if not subscriptions:
+            self._log.warning("No SUBSCRIBE_TOPIC in client. Check the device information.")
+        if session_present:
+            unsubscribe = [topic_filter for topic_filter in client.session_subscriptions if topic_filter not in subscriptions]
+            if unsubscribe:
+                self.__client_unsubscribe(client, unsubscribe)
+            subscriptions = {topic_filter: qos for topic_filter, qos in subscriptions.items() if client.session_subscriptions.get(topic_filter) != qos}
+            if not subscriptions:
+                self._log.info("Dev ID: %s, subscriptions kept by the session: %s", client.dev_id, list(client.session_subscriptions))
+                return
+        if subscriptions:
+            # All the subscriptions in one SUBSCRIBE packet.
+            if self.__client_subscribe(client, list(subscriptions.items())):
+                self._log.info("Subscribed to topics: %s", list(subscriptions.items()))
+            else:
+                self._log.error("Failed to subscribe the topics: %s", list(subscriptions.items()))
+
+    @staticmethod
+    def __client_subscribe(client, subscriptions):
+        """
+        client.subscribe, the subscriptions of a persistent session are kept in client.session_subscriptions.
+        """
+        result, _ = client.subscribe(subscriptions)
+        if result != mqtt_client.MQTT_ERR_SUCCESS:
+            return False
+        if client.persistent_session:
+            client.session_subscriptions.update(subscriptions)
+        return True
+
+    @staticmethod
+    def __client_unsubscribe(client, topic_filters):
+        result, _ = client.unsubscribe(topic_filters)
+        if result != mqtt_client.MQTT_ERR_SUCCESS:
+            return False
+        for topic_filter in topic_filters:
+            client.session_subscriptions.pop(topic_filter, None)
+        return True
 
 ####################################################################################################
 #########################                     External Calls               #########################
@@ -403,34 +1300,262 @@ class MQTTClient:
     def on_message_cb (self, cb):
         self._on_message_cb = cb
 
-    def publish(self, dev_id, message):
+    def route(self, topic_filter, handler):
+        """
+        topic_filter -> string, MQTT topic filter (+ and # wildcards supported)
+        handler -> function (client, message)
+        The messages with a topic matching the filter go to the handler instead of on_message_cb.
+        on_message_cb gets only the messages matching no route.
+        """
+        self._router.add(topic_filter, handler)
+
+    def unroute(self, topic_filter, handler=None):
+        """
+        Remove the handler (all the handlers if None) of the topic_filter.
+        """
+        return self._router.remove(topic_filter, handler)
+
+    def publish(self, dev_id, message, topic=None, qos=0, retain=False, timeout=None, priority=None, content_type=None, user_properties=None):
         """
         dev_id -> string
-        message -> string or dictionary
+        message -> string, bytes or dictionary / list
+        topic -> string, the device's PUBLISH_TOPIC if None
+        qos -> 0, 1 or 2
+        timeout -> seconds to wait for the acknowledgement, SETTINGS PUBLISH_TIMEOUT if None (0 -> no timeout)
+        priority -> "high" (never delayed by the rate limits, not batched) or "normal", None -> high if the topic matches PRIORITY_TOPICS
+        content_type, user_properties -> MQTT v5 (PROTOCOL 5) properties of the message, user_properties {"key": "value"} are added to
+        the device USER_PROPERTIES. The objects encoded with the SERIALIZER get its content type. Ignored for MQTT 3.1.1.
         Called externally with dev_id and message.
+        Strings and bytes are published as they are, the other objects are encoded with the device's SERIALIZER.
+        Devices with STORE_AND_FORWARD keep the message on disk while not connected, it's sent once connected.
+        Returns a concurrent.futures.Future resolved with the mid on PUBACK (QoS 1), PUBCOMP (QoS 2) or once written (QoS 0).
+        It fails with PublishError if the message is not sent and TimeoutError if not acknowledged in time.
+        A message kept on disk by STORE_AND_FORWARD resolves with None once stored.
+        A LAZY device is connected by its first publish, the messages are sent once connected.
+        A device with BATCH_INTERVAL collects the messages of its PUBLISH_TOPIC, the messages of a batch share the future of the batch.
+        Over the rate limits the message is delayed, dropped (PublishError) or spooled by RATE_LIMIT_POLICY.
         """
-        if dev_id in self._client_list_connected:
-            client = self._client_list_connected.get(dev_id)
-            if client:
-                if isinstance(message, str):
-                    message_str = message
-                else:
-                    message_str = json.dumps(message, indent=4)
-                result = client.publish(client.pub_topic, message_str)
-                if result.rc == mqtt_client.MQTT_ERR_SUCCESS:
-                    self._log.debug(f"External Message published successfully: Device ID: {dev_id} topic: {client.pub_topic} \n{message_str}")
-                else:
-                    self._log.error(f"Failed to publish external message:  Device ID: {dev_id} topic: {client.pub_topic} \n{message_str}")
-            else:
-                self._log.debug(f"No client available for dev_id: {dev_id}")
+        client = self._client_list_connected.get(dev_id) or self._client_list_disconnected.get(dev_id)
+        if not client:
+            gateway_device = self._gateway_devices.get(dev_id)
+            if gateway_device is not None:
+                return self.__publish_gateway(gateway_device, message, topic, qos, retain, timeout, priority, content_type, user_properties)
+            client = self.__wake(dev_id)
+        if not client:
+            self._log.debug("No client available for dev_id: %s", dev_id)
+            return self.__publish_failed(f"No client available for dev_id: {dev_id}")
+
+        if client.outbound_queue is None and dev_id not in self._client_list_connected:
+            self._log.debug("dev_id: %s is not in _client_list_connected", dev_id)
+            return self.__publish_failed(f"dev_id: {dev_id} is not connected")
+
+        topic = topic or client.pub_topic
+        timeout = self._publish_timeout if timeout is None else timeout
+        if priority is None:
+            priority = self.__priority(client, topic)
+        if client.batch is not None and priority == NORMAL and topic == client.pub_topic and not (content_type or user_properties) and client.batch.accepts(message):
+            client.metrics.messages_batched += 1
+            return self._batcher.add(dev_id, client.batch, message, qos, retain, timeout)
+
+        if isinstance(message, (str, bytes, bytearray)):
+            message_str = message
+        else:
+            try:
+                message_str = client.serializer.encode(message)
+            except Exception as e:
+                # Any registered codec, not only json.
+                self._metrics.publish_failed(client.metrics)
+                return self.__publish_failed(f"Can't encode the message with {client.serializer.name}, dev_id: {dev_id}, error: {e}")
+            content_type = content_type or client.serializer.content_type
+        properties = self.__publish_properties(client, content_type, user_properties)
+        return self.__send(client, topic, message_str, qos, retain, timeout, priority, properties)
+
+    @staticmethod
+    def __priority(device, topic):
+        """
+        HIGH if the topic matches the PRIORITY_TOPICS of the device (client or gateway device), NORMAL otherwise.
+        """
+        if device.priority_topics and any(mqtt_client.topic_matches_sub(topic_filter, topic) for topic_filter in device.priority_topics):
+            return HIGH
+        return NORMAL
+
+    @staticmethod
+    def __publish_properties(client, content_type=None, user_properties=None):
+        """
+        The MQTT v5 PUBLISH properties of a message: content type, the device USER_PROPERTIES and user_properties. None for MQTT 3.1.1.
+        """
+        if not client.protocol_v5:
+            return None
+        return publish_properties(content_type, client.user_properties + user_property_pairs(user_properties))
+
+    def __send_batch(self, dev_id, payload, qos, retain, timeout):
+        """
+        Batcher send: publish the encoded batch to the PUBLISH_TOPIC of the current client of the dev_id.
+        """
+        client = self._client_list_connected.get(dev_id) or self._client_list_disconnected.get(dev_id) or self.__wake(dev_id)
+        if not client:
+            return self.__publish_failed(f"No client available for dev_id: {dev_id}")
+        if client.outbound_queue is None and dev_id not in self._client_list_connected:
+            return self.__publish_failed(f"dev_id: {dev_id} is not connected")
+        content_type = "application/octet-stream" if client.batch is not None and client.batch.format == "binary" else client.serializer.content_type
+        return self.__send(client, client.pub_topic, payload, qos, retain, timeout, properties=self.__publish_properties(client, content_type))
+
+    def __send(self, client, topic, message_str, qos, retain, timeout, priority=NORMAL, properties=None, gateway_device=None):
+        """
+        Send the message now, later or not at all by the rate limits and the RATE_LIMIT_POLICY of the device.
+        gateway_device -> the message of a gateway device on the client of its gateway: its own bucket and policy, and the gateway's bucket.
+        """
+        if not self._rate_limiter.enabled:
+            return self.__send_now(client, topic, message_str, qos, retain, timeout, properties)
+        device = gateway_device or client
+        spool = device.rate_limit_policy == SPOOL and client.outbound_queue is not None
+        # spool without STORE_AND_FORWARD delays.
+        max_delay = 0 if spool or device.rate_limit_policy not in (DELAY, SPOOL) else self._rate_limit_max_delay
+        delay = self._rate_limiter.acquire(device.dev_id, (client.endpoint, client.port), priority, max_delay,
+                                           gateway_id=client.dev_id if gateway_device is not None else None)
+        if delay is None:
+            if spool:
+                return self.__store(client, topic, message_str, qos, retain)
+            self._metrics.publish_failed(client.metrics)
+            self._log.debug("Rate limit exceeded, message dropped: Device ID: %s topic: %s", device.dev_id, topic)
+            return self.__publish_failed(f"Rate limit exceeded, Device ID: {device.dev_id}")
+        if delay:
+            future = concurrent.futures.Future()
+            self._rate_limiter.call_later(delay, self.__send_delayed, client, topic, message_str, qos, retain, timeout, properties, future)
+            return future
+        return self.__send_now(client, topic, message_str, qos, retain, timeout, properties)
+
+    def __send_delayed(self, client, topic, message_str, qos, retain, timeout, properties, future):
+        """
+        Rate limiter timer thread: send the delayed message, the caller's future gets the outcome (also a failed send).
+        """
+        try:
+            self.__chain(self.__send_now(client, topic, message_str, qos, retain, timeout, properties), future)
+        except Exception as e:
+            self._metrics.publish_failed(client.metrics)
+            self._log.error("Delayed send failed: Device ID: %s topic: %s error: %s", client.dev_id, topic, e)
+            if not future.done():
+                future.set_exception(PublishError(f"Delayed send failed, Device ID: {client.dev_id}, error: {e}"))
+
+    def __send_now(self, client, topic, message_str, qos, retain, timeout, properties=None):
+        if not client.lazy:
+            return self.__publish(client, topic, message_str, qos, retain, timeout, properties)
+        with client.lazy_pending_lock:
+            if not client.idle:
+                client.last_activity = time.monotonic()
+                if client.lazy_pending is not None and client.outbound_queue is None:
+                    future = concurrent.futures.Future()
+                    client.lazy_pending.append((topic, message_str, qos, retain, timeout, properties, future))
+                    return future
+                return self.__publish(client, topic, message_str, qos, retain, timeout, properties)
+        # Disconnected by __lazy_idle since publish picked the client up: send on a new connection.
+        woken = self.__wake(client.dev_id)
+        if woken is None or woken is client:
+            return self.__publish_failed(f"dev_id: {client.dev_id} is not connected")
+        return self.__send_now(woken, topic, message_str, qos, retain, timeout, properties)
+
+    def __publish(self, client, topic, message_str, qos, retain, timeout, properties=None):
+        dev_id = client.dev_id
+        if client.outbound_queue is not None:
+            with client.outbound_queue.lock:
+                # Store while not connected, and also while the stored messages are draining to keep the order.
+                if not client.connection_flag or not client.outbound_queue.empty():
+                    return self.__store(client, topic, message_str, qos, retain)
+                start = time.perf_counter()
+                result = self.__client_publish(client, topic, message_str, qos, retain, properties)
+                if result.rc != mqtt_client.MQTT_ERR_SUCCESS:
+                    self._metrics.publish_failed(client.metrics)
+                    return self.__store(client, topic, message_str, qos, retain)
         else:
-            self._log.debug(f"dev_id: {dev_id} is not in _client_list_connected")
+            start = time.perf_counter()
+            result = self.__client_publish(client, topic, message_str, qos, retain, properties)
+
+        if result.rc == mqtt_client.MQTT_ERR_SUCCESS:
+            self._metrics.published(client.metrics, result.mid, len(message_str), start)
+            self._log.debug("External Message published successfully: Device ID: %s topic: %s \n%s", dev_id, topic, message_str)
+            return self._deliveries.track(client.deliveries, result.mid, qos, timeout)
+        self._metrics.publish_failed(client.metrics)
+        self._log.error("Failed to publish external message:  Device ID: %s topic: %s error: %s \n%s", dev_id, topic, mqtt_client.error_string(result.rc), message_str)
+        return self.__publish_failed(f"Failed to publish, Device ID: {dev_id}, error: {mqtt_client.error_string(result.rc)}", result.rc)
+
+    @staticmethod
+    def __client_publish(client, topic, payload, qos, retain, properties=None):
+        """
+        client.publish, with a topic alias for the QoS 0 messages of a MQTT v5 client when the broker allows them:
+        the first message of the topic carries the topic and the alias, the next ones an empty topic and the alias.
+        """
+        if client.topic_aliases is None or qos != 0:
+            return client.publish(topic, payload, qos, retain, properties)
+        with client.alias_lock:
+            topic_aliases = client.topic_aliases
+            if topic_aliases is None:
+                return client.publish(topic, payload, qos, retain, properties)
+            alias, established = topic_aliases.lookup(topic)
+            if alias is None:
+                return client.publish(topic, payload, qos, retain, properties)
+            # The properties may be shared (batch, gateway), the alias is set on a copy.
+            properties = with_topic_alias(copy.copy(properties), alias)
+            result = client.publish("" if established else topic, payload, qos, retain, properties)
+            if not established and result.rc == mqtt_client.MQTT_ERR_SUCCESS:
+                topic_aliases.established(topic)
+            return result
+
+    def __publish_failed(self, message, rc=None):
+        future = concurrent.futures.Future()
+        future.set_exception(PublishError(message, rc))
+        return future
+
+    def __store(self, client, topic, message_str, qos=0, retain=False):
+        client.outbound_queue.put(topic, message_str, qos, retain)
+        self._outbound_backlog.add(client.dev_id)
+        self._log.debug("Message stored for forwarding: Device ID: %s topic: %s \n%s", client.dev_id, topic, message_str)
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+
+    def dispatcher_metrics(self):
+        """
+        Inbound queue depths and the dispatched / dropped counters. None if DISPATCH_WORKERS is 0.
+        """
+        return self._dispatcher.metrics() if self._dispatcher else None
+
+    def metrics_snapshot(self):
+        """
+        Per device counters (messages / bytes in and out, publish failures, connect attempts, reconnects, in flight messages)
+        and the connect, publish_ack and on_message_cb latency histograms (seconds).
+        """
+        snapshot = self._metrics.snapshot()
+        snapshot["dispatcher"] = self.dispatcher_metrics()
+        snapshot["rate_limit"] = self.rate_limit_metrics()
+        snapshot["liveness"] = self.liveness_metrics()
+        return snapshot
+
+    def rate_limit_metrics(self):
+        """
+        The global, per endpoint and per device token buckets (rate, burst, tokens, admitted / delayed / rejected) and the delayed messages waiting.
+        """
+        return self._rate_limiter.state()
+
+    def liveness_metrics(self):
+        """
+        The dead connections found by the liveness probes and, per connected LIVENESS_PROBE device, the round trip time estimate
+        (srtt / rttvar / last rtt), the probe interval and timeout, probes / answers / timeouts of the connection.
+        """
+        return {"dead_connections": self._liveness.dead_connections, "devices": self._liveness.state()}
 
     def clients_info(self):
         """
-        Return the current client status. Both connected and disconnected.
+        Return the current state of all the devices (dev_id -> IDLE, CONNECTING, CONNECTED, BACKOFF or DISABLED).
+        A read only snapshot, copied only when a state changed since the previous call.
         """
-        return self._clients_status
+        return self._states.snapshot()
+
+    def on_state_change(self, cb):
+        """
+        cb -> function (dev_id, old_state, new_state), called on every state change from a background thread, in order.
+        old_state is None for a new device, new_state None for a removed device.
+        """
+        self._states.subscribe(cb)
 
     def start(self):
         pass
@@ -438,108 +1563,253 @@ class MQTTClient:
     def stop(self):
         """
         Call __disconnect to disconnect the clients in a thread.
+        The pending batches and the messages delayed by the rate limits are sent first.
         """
+        self._batcher.stop()
+        self._rate_limiter.stop()
+        self._liveness.stop()
         self._stop_event.set()
+        with self._reconnect_condition:
+            self._reconnect_condition.notify()
         self.__disconnect()
 
     def mqtt_connect(self, device):
         """
         device -> dictionary
         Called externally to connect the device to the broker if not connected.
-        Adds the device information to _mqtt_json_data
+        Adds the device information to _devices (overwrites if the DEV_ID already exists).
         """
-        self.__add_device(device)
+        if not self.__add_device(device):
+            return
+        self.__connect_added_device(device)
 
-        dev_id = device.get("DEV_ID")
-        matched_device = next(
-            (device for device in self._mqtt_json_data.get("DEVICE", []) if device.get("DEV_ID") == dev_id),
-            None
-        )
-        # matched_device_client_info = self._clients_status.get(dev_id)
-        is_in_client_list_connected = self._client_list_connected.get(dev_id)
-        is_in_client_list_disconnected = self._client_list_disconnected.get(dev_id)
+    def mqtt_connect_many(self, devices):
+        """
+        devices -> list of dictionary
+        Bulk mqtt_connect. The devices are added to _devices under one lock and queued to the connect workers.
+        """
+        added = self._devices.add_many(devices)
+        for device in added:
+            self.__connect_added_device(device)
+        self._log.info("mqtt_connect_many: %s of %s devices added", len(added), len(devices))
 
+    def __connect_added_device(self, device):
+        dev_id = device.get("DEV_ID")
         # The client associated with the dev_id should not be in _client_list_connected.
         # The client associated with the dev_id should not be in _client_list_disconnected too. Because it may be in reconnect state.
-        # The device should not be in _mqtt_json_data.
         # Example scenario:
-        # Assume if the device status is set to False during init then the _mqtt_json_data will have the device state as False.
+        # Assume if the device status is set to False during init then the device is not connected.
         # If the device state is changed during runtime to True
-        # The device will be deleted first, so the entry will be removed from _mqtt_json_data. Then it will be added by calling this function)
-
-        # if not matched_device or matched_device_client_info != "CONNECTED":
-        if not matched_device or (not is_in_client_list_connected and not is_in_client_list_disconnected):
-            if not is_in_client_list_connected and not is_in_client_list_disconnected:
-                self._log.info(f"Adding dev_id: {dev_id} to dev _mqtt_json_data")
-                self._mqtt_json_data.get("DEVICE").append(device)
-                if device.get("STATUS"):
-                    self.__mqtt_connect(device)
-                else:
-                    self._clients_status[dev_id] = "DISCONNECTED"
-                    self._log.warning("matched_device status set to FALSE. Not connecting to broker")
-            else:
-                self._log.critical("CRITICAL ERROR...")
-                self._log.critical(f"the device is not in _mqtt_json_data, but it is in either _client_list_connected or _client_list_disconnected")
+        # The device will be deleted first (mqtt_disconnect). Then it will be added by calling mqtt_connect)
+        if dev_id in self._client_list_connected or dev_id in self._client_list_disconnected:
+            self._log.info("dev_id %s is already connected or reconnecting, Not doing anything", dev_id)
+            return
+
+        if device.get("STATUS") and device.get("GATEWAY"):
+            self.__attach_gateway_device(device)
+        elif device.get("STATUS") and device.get("LAZY"):
+            self._states.set(dev_id, IDLE)
+        elif device.get("STATUS"):
+            self.__mqtt_connect(device)
         else:
-            self._log.info(f"dev_id {dev_id} is already exist in _mqtt_json_data, Not doing anything")
+            self._states.set(dev_id, DISABLED)
+            self._log.warning("matched_device status set to FALSE. Not connecting to broker")
+
+    def wake(self, dev_id):
+        """
+        Connect the LAZY device now (ex: to receive the messages of its SUBSCRIBE_TOPIC), it goes idle again after IDLE_TIMEOUT seconds without traffic.
+        Returns False if dev_id is not a lazy device.
+        """
+        client = self.__wake(dev_id)
+        if client is None:
+            return False
+        client.last_activity = time.monotonic()
+        return True
 
     def mqtt_disconnect(self, dev_id):
         """
         dev_id -> string
         Called externally to disconnect the client from the broker if connected.
-        Removes the entry from _mqtt_json_data.
+        Removes the entry from _devices.
         Sets the client.manual_disconnect to avoid reconnecting, as the client is about to disconnected externally.
         """
 
-        # Remove the device from _mqtt_json_data regardless of the device is connected to the broker or not.
+        # Remove the device from _devices regardless of the device is connected to the broker or not.
         self.__remove_device(dev_id)
+        self._batcher.flush(dev_id)
+        if self.__detach_gateway_device(dev_id):
+            return
         if dev_id in self._client_list_connected:
-            self._log.critical(f"Disconnecting request received for client with dev_id: {dev_id} from MQTT broker...")
+            self._log.critical("Disconnecting request received for client with dev_id: %s from MQTT broker...", dev_id)
             client = self._client_list_connected.get(dev_id)
             if client:
                 try:
                     client.manual_disconnect = True
                     client.connection_flag = False
-                    client.loop_stop()
                     client.disconnect()
+                    self._network_loop.stop(client)
                 except Exception as error:
-                    self._log.error(f"Error disconnecting dev_id: {dev_id}, type: {client.dev_type} error: {error}")
+                    self._log.error("Error disconnecting dev_id: %s, type: %s error: %s", dev_id, client.dev_type, error)
             else:
-                self._log.warning(f"The client object is None for dev_id: {dev_id}")
+                self._log.warning("The client object is None for dev_id: %s", dev_id)
         else:
-            self._log.warning(f"dev_id: {dev_id} is not in _client_list_connected. Not disconnecting...")
+            self._log.warning("dev_id: %s is not in _client_list_connected. Not disconnecting...", dev_id)
+            # Don't reconnect the removed device.
+            self.__cancel_reconnect(dev_id)
+            self._states.remove(dev_id)
+
+    def mqtt_disconnect_many(self, dev_ids):
+        """
+        dev_ids -> list of string
+        Bulk mqtt_disconnect.
+        """
+        for dev_id in dev_ids:
+            self.mqtt_disconnect(dev_id)
+
+    def reload(self, mqtt_json_data):
+        """
+        Apply the DEVICE list of mqtt_json_data, diffed with the current devices by DEV_ID (the SETTINGS are not reloaded):
+        new devices are connected, missing devices disconnected, unchanged devices left alone.
+        A device whose RELOAD_IN_PLACE fields only changed keeps its connection (the topics are unsubscribed / subscribed in place),
+        any other change reconnects that device only.
+        Returns the count of added, removed, reconnected, updated and unchanged devices.
+        """
+        devices = {}
+        for device in mqtt_json_data.get("DEVICE", []):
+            if device.get("DEV_ID") is None:
+                self._log.warning("reload: device does not contain DEV_ID. Skipping.")
+                continue
+            devices[device.get("DEV_ID")] = device
+
+        result = dict.fromkeys(("added", "removed", "reconnected", "updated", "unchanged"), 0)
+        with self._reload_lock:
+            removed = [device.get("DEV_ID") for device in self._devices if device.get("DEV_ID") not in devices]
+            for count, dev_id in enumerate(removed, 1):
+                self.mqtt_disconnect(dev_id)
+                self.__reload_yield(count)
+            result["removed"] = len(removed)
+
+            for count, (dev_id, device) in enumerate(devices.items(), 1):
+                current = self._devices.get(dev_id)
+                if current is None:
+                    self.mqtt_connect(device)
+                    result["added"] += 1
+                elif current == device:
+                    result["unchanged"] += 1
+                elif all(current.get(key) == device.get(key) for key in current.keys() | device.keys() if key not in self.RELOAD_IN_PLACE):
+                    self.__update_in_place(device)
+                    result["updated"] += 1
+                else:
+                    self.__replace_device(device)
+                    result["reconnected"] += 1
+                self.__reload_yield(count)
+        self._log.info("reload: %s", result)
+        return result
+
+    def watch(self, path, interval=1.0):
+        """
+        Reload the json file at path whenever it changes (mtime polled every interval seconds). The DEVICE list is parsed incrementally.
+        """
+        if self._config_watcher:
+            self._config_watcher.stop()
+        self._config_watcher = ConfigWatcher(path, self.reload, interval, log=self._log)
+
+    def __reload_yield(self, count):
+        # Let the network threads run during the reload of a large device list.
+        if count % self.RELOAD_CHUNK == 0:
+            time.sleep(0)
+
+    def __update_in_place(self, device):
+        """
+        Only PUBLISH_TOPIC / SUBSCRIBE_TOPIC / the payload options changed. The connected client unsubscribes the removed filters
+        and subscribes the new ones (or the ones with a new QoS), a disconnected client subscribes everything on its next connect.
+        """
+        dev_id = device.get("DEV_ID")
+        if dev_id in self._gateway_devices:
+            # No connection of its own, attached again with the new topics.
+            self.__replace_device(device)
+            return
+        self._devices.add(device)
+        client = self._client_list_connected.get(dev_id) or self._client_list_disconnected.get(dev_id)
+        if client is None:
+            return
+        client.serializer = self.__serializer(device)
+        client.batch = self.__batch_policy(device, client.serializer)
+        self.__apply_rate_limit(client, device)
+        client.deserialize = device.get("DESERIALIZE", False)
+        client.raw_message = device.get("RAW_MESSAGE", False)
+        client.user_properties = user_property_pairs(device.get("USER_PROPERTIES"))
+        client.pub_topic = device.get("PUBLISH_TOPIC")
+        client.sub_topic = device.get("SUBSCRIBE_TOPIC")
+
+        previous = dict(client.subscriptions)
+        client.subscriptions = self.__subscriptions(dev_id, client.sub_topic)
+        current = dict(client.subscriptions)
+        unsubscribe = [topic_filter for topic_filter in previous if topic_filter not in current]
+        subscribe = [(topic_filter, qos) for topic_filter, qos in current.items() if previous.get(topic_filter) != qos]
+        if client.connection_flag:
+            if unsubscribe:
+                self.__client_unsubscribe(client, unsubscribe)
+            if subscribe:
+                self.__client_subscribe(client, subscribe)
+        self._log.info("Dev ID: %s updated in place, unsubscribed: %s, subscribed: %s", dev_id, unsubscribe, subscribe)
+
+    def __replace_device(self, device):
+        """
+        A connection field of the device changed. Disconnect its client and connect a new one with the new device information.
+        """
+        dev_id = device.get("DEV_ID")
+        self.__detach_gateway_device(dev_id)
+        self._batcher.flush(dev_id)
+        client = self._client_list_connected.pop(dev_id, None) or self._client_list_disconnected.get(dev_id)
+        self.__cancel_reconnect(dev_id)
+        if client is not None:
+            try:
+                client.manual_disconnect = True
+                client.connection_flag = False
+                client.disconnect()
+                self._network_loop.stop(client)
+            except Exception as error:
+                self._log.error("Error disconnecting dev_id: %s, type: %s error: %s", dev_id, client.dev_type, error)
+        self._log.warning("Dev ID: %s changed, reconnecting", dev_id)
+        self._devices.add(device)
+        self.__connect_added_device(device)
+
+    def export_json(self):
+        """
+        Return the json (same schema as the input) with the current devices in DEVICE.
+        """
+        mqtt_json_data = dict(self._mqtt_json_data)
+        mqtt_json_data["DEVICE"] = self._devices.to_json()
+        return mqtt_json_data
 
     def __remove_device(self, dev_id):
         """
-        Remove the device from _mqtt_json_data when called externally by mqtt_disconnect.
+        Remove the device from _devices when called externally by mqtt_disconnect.
         Assume in runtime, the device info is deleted from the actual json file. (Maybe by some other modules).
         """
-        devices = self._mqtt_json_data.get("DEVICE", [])
-        for i, device in enumerate(devices):
-            if device.get("DEV_ID") == dev_id:
-                devices.pop(i)
-                self._log.warning(f"Removed the device with dev_id: {dev_id} from _mqtt_json_data")
-                break
+        if self._devices.remove(dev_id) is not None:
+            self._metrics.remove(dev_id)
+            self._rate_limiter.remove_device(dev_id)
+            self._log.warning("Removed the device with dev_id: %s from _devices", dev_id)
         else:
-            self._log.warning("dev_id is not in _mqtt_json_data, not removing")
+            self._log.warning("dev_id is not in _devices, not removing")
 
     def __add_device(self, device_to_add):
         """
-        Add or update the device info in _mqtt_json_data.
+        Add or update the device info in _devices.
         Called externally by mqtt_connect during runtime.
         Assume in runtime, the device info is alredy stored in the actual json file. (Maybe by some other modules).
+        Returns False if the device can't be added.
         """
         dev_id = device_to_add.get("DEV_ID", None)
         if dev_id is None:
-            self._log.warning(f"device_to_add does not contain DEV_ID. dev_id: {dev_id}. Skipping.")
-            return
+            self._log.warning("device_to_add does not contain DEV_ID. dev_id: %s. Skipping.", dev_id)
+            return False
 
-        devices = self._mqtt_json_data.get("DEVICE", [])
         # Overwrite the device if existed. Else add.
-        for i, device in enumerate(devices):
-            if device.get("DEV_ID") == dev_id:
-                devices[i] = device_to_add
-                self._log.info(f"dev_id: {dev_id} is already present in _mqtt_json_data. Overwriting the device info")
-                return
-        devices.append(device_to_add)
-        self._log.info(f"dev_id: {dev_id} is not present in _mqtt_json_data. Added as new device")
+        if self._devices.add(device_to_add) is not None:
+            self._log.info("dev_id: %s is already present in _devices. Overwriting the device info", dev_id)
+        else:
+            self._log.info("dev_id: %s is not present in _devices. Added as new device", dev_id)
+        return True
@@ -0,0 +1,95 @@
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+MQTT_V311 = 4
+MQTT_V5 = 5
+
+class TopicAliases:
+    """
+    The topic aliases of one MQTT v5 connection (at most maximum, the broker's Topic Alias Maximum), created on CONNACK.
+    The first message of a topic carries the topic and its alias, the next ones only the alias (empty topic) once it was queued.
+    Only for QoS 0: paho may resend the QoS 1 / 2 messages on the next connection, where the aliases are not set.
+    The client's alias_lock is held by the publisher from the lookup to client.publish, so a message with only the alias can't be
+    queued before the one setting it, and by the connect dropping the table before the socket is replaced.
+    """
+    __slots__ = ("maximum", "_aliases", "_established")
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        # topic -> alias, _established -> the topics whose alias was sent.
+        self._aliases = {}
+        self._established = set()
+
+    def __len__(self):
+        return len(self._aliases)
+
+    def lookup(self, topic):
+        """
+        (alias, established) of the topic, (None, False) if the table is full.
+        """
+        alias = self._aliases.get(topic)
+        if alias is None:
+            if len(self._aliases) >= self.maximum:
+                return None, False
+            alias = self._aliases[topic] = len(self._aliases) + 1
+        return alias, topic in self._established
+
+    def established(self, topic):
+        self._established.add(topic)
+
+def user_property_pairs(user_properties):
+    """
+    {"key": "value"} or [("key", "value")] -> [("key", "value")]
+    """
+    if not user_properties:
+        return []
+    items = user_properties.items() if isinstance(user_properties, dict) else user_properties
+    return [(str(key), str(value)) for key, value in items]
+
+def publish_properties(content_type=None, user_properties=None):
+    """
+    The PUBLISH properties, None if there's nothing to send.
+    """
+    if not content_type and not user_properties:
+        return None
+    properties = Properties(PacketTypes.PUBLISH)
+    if content_type:
+        properties.ContentType = content_type
+    for pair in user_properties or ():
+        properties.UserProperty = pair
+    return properties
+
+def with_topic_alias(properties, alias):
+    """
+    The PUBLISH properties (a new one if None) with the TopicAlias.
+    """
+    if properties is None:
+        properties = Properties(PacketTypes.PUBLISH)
+    properties.TopicAlias = alias
+    return properties
+
+def connect_properties(receive_maximum=0, session_expiry=0):
+    """
+    The CONNECT properties. receive_maximum -> QoS 1 / 2 messages the broker may send before our acknowledgement (0 -> 65535, the default),
+    session_expiry -> seconds the broker keeps the session after the disconnect.
+    """
+    properties = Properties(PacketTypes.CONNECT)
+    if receive_maximum:
+        properties.ReceiveMaximum = receive_maximum
+    if session_expiry:
+        properties.SessionExpiryInterval = session_expiry
+    return properties
+
+def property_value(properties, name, default=None):
+    """
+    The value of a received property (CONNACK, DISCONNECT, PUBLISH, ...), default if absent or if properties is None (MQTT 3.1.1).
+    """
+    return getattr(properties, name, default) if properties is not None else default
+
+def reason_text(rc, properties=None):
+    """
+    Log text of a MQTT v5 reason code with the broker's Reason String, or the MQTT 3.1.1 return code.
+    """
+    reason_string = property_value(properties, "ReasonString")
+    text = f"{rc} ({rc.value})" if hasattr(rc, "value") else str(rc)
+    return f"{text}: {reason_string}" if reason_string else text
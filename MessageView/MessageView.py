@@ -0,0 +1,78 @@
+class MessageView:
+    """
+    Read only view of an incoming paho message, given to on_message_cb for the devices with RAW_MESSAGE.
+    payload is the received bytes object (no copy), memoryview slices it without copying.
+    text is decoded on the first access only.
+    """
+    __slots__ = ("_msg", "_text")
+
+    def __init__(self, msg):
+        self._msg = msg
+        self._text = None
+
+    @property
+    def topic(self):
+        return self._msg.topic
+
+    @property
+    def qos(self):
+        return self._msg.qos
+
+    @property
+    def retain(self):
+        return self._msg.retain
+
+    @property
+    def dup(self):
+        return self._msg.dup
+
+    @property
+    def mid(self):
+        return self._msg.mid
+
+    @property
+    def properties(self):
+        """
+        The MQTT v5 PUBLISH properties, None for MQTT 3.1.1.
+        """
+        return getattr(self._msg, "properties", None)
+
+    @property
+    def content_type(self):
+        return getattr(self.properties, "ContentType", None)
+
+    @property
+    def user_properties(self):
+        """
+        The MQTT v5 user properties [(key, value)], in the order they were sent.
+        """
+        return getattr(self.properties, "UserProperty", [])
+
+    @property
+    def payload(self):
+        return self._msg.payload
+
+    @property
+    def memoryview(self):
+        return memoryview(self._msg.payload)
+
+    @property
+    def text(self):
+        """
+        The payload decoded as utf-8, decoded once on the first access.
+        """
+        if self._text is None:
+            self._text = self._msg.payload.decode()
+        return self._text
+
+    def decode(self, encoding="utf-8", errors="strict"):
+        return self._msg.payload.decode(encoding, errors)
+
+    def __len__(self):
+        return len(self._msg.payload)
+
+    def __bytes__(self):
+        return self._msg.payload
+
+    def __repr__(self):
+        return f"MessageView(topic={self.topic!r}, qos={self.qos}, retain={self.retain}, bytes={len(self)})"
@@ -0,0 +1,246 @@
+import bisect
+import http.server
+import math
+import threading
+import time
+
+# Seconds, the last bucket (+Inf) is implicit.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    """
+    Fixed bucket latency histogram. observe is a bisect and three additions, no allocation.
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._count += 1
+            self._sum += value
+
+    def quantile(self, q):
+        """
+        Estimated from the buckets (upper bound of the bucket holding the q-th value). None if empty.
+        """
+        with self._lock:
+            counts, count = list(self._counts), self._count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self._bounds[i] if i < len(self._bounds) else math.inf
+        return math.inf
+
+    def snapshot(self):
+        with self._lock:
+            counts, count, total = list(self._counts), self._count, self._sum
+        cumulative = []
+        seen = 0
+        for bucket_count in counts:
+            seen += bucket_count
+            cumulative.append(seen)
+        return {
+            "buckets": dict(zip([str(bound) for bound in self._bounds] + ["+Inf"], cumulative)),
+            "count": count,
+            "sum": total,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+class DeviceMetrics:
+    """
+    Counters of one device. Kept on the paho client (client.metrics), so the hot path doesn't look it up.
+    No locks: the inbound counters are updated only by the device's network thread, the outbound ones by the publishing thread.
+    If several threads publish to the same device at the same time an increment may be lost, the counters are for monitoring.
+    """
+    __slots__ = ("messages_in", "bytes_in", "messages_out", "bytes_out", "messages_batched", "publish_failures", "connect_attempts", "reconnects",
+                 "sessions_resumed", "_pending")
+
+    COUNTERS = ("messages_in", "bytes_in", "messages_out", "bytes_out", "messages_batched", "publish_failures", "connect_attempts", "reconnects",
+                "sessions_resumed")
+
+    def __init__(self):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        # Messages published in batches (BATCH_INTERVAL), messages_out counts the batches.
+        self.messages_batched = 0
+        self.publish_failures = 0
+        self.connect_attempts = 0
+        self.reconnects = 0
+        # Connects where the broker still had the persistent session (PERSISTENT_SESSION).
+        self.sessions_resumed = 0
+        # mid -> publish time, or -ack time if on_publish came first.
+        self._pending = {}
+
+    def to_dict(self):
+        counters = {name: getattr(self, name) for name in self.COUNTERS}
+        counters["in_flight"] = len(self._pending)
+        return counters
+
+class Metrics:
+    """
+    Per device counters (messages / bytes in and out, publish failures, connect attempts, reconnects) and latency histograms:
+    connect (connect call -> CONNACK), publish_ack (publish -> on_publish, matched by mid) and on_message_cb execution time.
+    snapshot returns all of it as a dictionary, prometheus as the Prometheus text format, serve exposes it on /metrics.
+    """
+    def __init__(self, slow_callback=0.5, log=None):
+        self._slow_callback = slow_callback
+        self._log = log
+        self._devices = {}
+        self._devices_lock = threading.Lock()
+        self.connect_seconds = Histogram()
+        self.publish_ack_seconds = Histogram()
+        self.on_message_cb_seconds = Histogram()
+        self._server = None
+
+    def device(self, dev_id):
+        """
+        The DeviceMetrics of the dev_id, created on the first call. The counters survive the reconnects.
+        """
+        device_metrics = self._devices.get(dev_id)
+        if device_metrics is None:
+            with self._devices_lock:
+                device_metrics = self._devices.setdefault(dev_id, DeviceMetrics())
+        return device_metrics
+
+    def remove(self, dev_id):
+        with self._devices_lock:
+            self._devices.pop(dev_id, None)
+
+    def published(self, device_metrics, mid, size, start):
+        """
+        paho accepted the message (mid) at start (time.perf_counter).
+        """
+        device_metrics.messages_out += 1
+        device_metrics.bytes_out += size
+        # Usually the ack comes later, store the start time without the __meet call.
+        if mid not in device_metrics._pending and device_metrics._pending.setdefault(mid, start) is start:
+            return
+        acked = self.__meet(device_metrics._pending, mid, start)
+        if acked is not None:
+            # on_publish was called before publish returned.
+            self.publish_ack_seconds.observe(max(0.0, -acked - start))
+
+    def publish_failed(self, device_metrics):
+        device_metrics.publish_failures += 1
+
+    def acked(self, device_metrics, mid):
+        """
+        on_publish of the mid (PUBACK / PUBCOMP, or written to the socket for QoS 0).
+        """
+        now = time.perf_counter()
+        start = self.__meet(device_metrics._pending, mid, -now)
+        if start is not None:
+            self.publish_ack_seconds.observe(now - start)
+
+    def disconnected(self, device_metrics):
+        """
+        The mids of the lost connection won't be acked, forget them.
+        """
+        device_metrics._pending.clear()
+
+    def callback_done(self, dev_id, topic, start):
+        """
+        on_message_cb / route handlers of a message returned. Warn if they took more than slow_callback seconds.
+        """
+        elapsed = time.perf_counter() - start
+        self.on_message_cb_seconds.observe(elapsed)
+        if self._slow_callback and elapsed > self._slow_callback and self._log:
+            self._log.warning("Slow on_message_cb: %.3f seconds, Device ID: %s, Topic: %s", elapsed, dev_id, topic)
+
+    def snapshot(self):
+        with self._devices_lock:
+            devices = list(self._devices.items())
+        return {
+            "devices": {dev_id: device_metrics.to_dict() for dev_id, device_metrics in devices},
+            "connect_seconds": self.connect_seconds.snapshot(),
+            "publish_ack_seconds": self.publish_ack_seconds.snapshot(),
+            "on_message_cb_seconds": self.on_message_cb_seconds.snapshot(),
+        }
+
+    def prometheus(self):
+        """
+        The snapshot in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for counter in DeviceMetrics.COUNTERS + ("in_flight",):
+            metric_type = "gauge" if counter == "in_flight" else "counter"
+            name = f"mqttclient_{counter}" + ("_total" if metric_type == "counter" else "")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for dev_id, counters in snapshot["devices"].items():
+                lines.append(f'{name}{{dev_id="{self.__escape(dev_id)}"}} {counters[counter]}')
+        for histogram in ("connect_seconds", "publish_ack_seconds", "on_message_cb_seconds"):
+            name = f"mqttclient_{histogram}"
+            lines.append(f"# TYPE {name} histogram")
+            for bound, count in snapshot[histogram]["buckets"].items():
+                lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{name}_sum {snapshot[histogram]['sum']}")
+            lines.append(f"{name}_count {snapshot[histogram]['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        """
+        Serve prometheus() on http://host:port/metrics from a background thread.
+        """
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics_http", daemon=True).start()
+        if self._log:
+            self._log.info("Metrics served on http://%s:%s/metrics", host, port)
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @staticmethod
+    def __meet(pending, mid, value):
+        """
+        publish and on_publish of a mid run on different threads in any order. The first one leaves its value in pending,
+        the second one takes it. Returns the value of the other side, None for the first one.
+        dict pop / setdefault are atomic, no lock needed.
+        """
+        other = pending.pop(mid, None)
+        if other is not None:
+            return other
+        other = pending.setdefault(mid, value)
+        if other is value:
+            return None
+        # The other side came in between.
+        pending.pop(mid, None)
+        return other
+
+    @staticmethod
+    def __escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,266 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+import zlib
+
+from paho.mqtt import client as mqtt_client
+
+class ThreadedNetworkLoop:
+    """
+    Default network loop of MQTTClient. Every connected client gets its own paho network thread (loop_start).
+    register -> called when the client is created, before connect.
+    start -> called once the client is connected.
+    stop -> called when the client is disconnected.
+    shutdown -> called when MQTTClient is stopped.
+    """
+    def register(self, client):
+        pass
+
+    START_TIMEOUT = 1
+
+    def start(self, client):
+        # A reused client's previous network thread may still be finishing after the loop_stop from on_disconnect.
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while client.loop_start() == mqtt_client.MQTT_ERR_INVAL and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stop(self, client):
+        client.loop_stop()
+
+    def shutdown(self):
+        pass
+
+class AsyncioNetworkLoop:
+    """
+    Drives the sockets of all the clients from one asyncio event loop through the paho external loop callbacks.
+    on_socket_open / on_socket_close add / remove the reader, on_socket_register_write / on_socket_unregister_write add / remove the writer.
+    A single timer calls loop_misc of every started client for the keepalive handling.
+    The paho callbacks may come from any thread (connect workers, publish callers), so the loop is only touched through call_soon_threadsafe.
+    """
+    MISC_INTERVAL = 1
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._clients = set()
+        self._socket_fds = {}
+        self._closed = False
+        self._loop.call_soon_threadsafe(self.__misc)
+
+    def register(self, client):
+        client.on_socket_open = self.__on_socket_open
+        client.on_socket_close = self.__on_socket_close
+        client.on_socket_register_write = self.__on_socket_register_write
+        client.on_socket_unregister_write = self.__on_socket_unregister_write
+
+    def start(self, client):
+        self._loop.call_soon_threadsafe(self._clients.add, client)
+
+    def stop(self, client):
+        self._loop.call_soon_threadsafe(self._clients.discard, client)
+
+    def shutdown(self):
+        self._closed = True
+
+    def __misc(self):
+        for client in list(self._clients):
+            if client.loop_misc() == mqtt_client.MQTT_ERR_NO_CONN:
+                self._clients.discard(client)
+        if not self._closed:
+            self._loop.call_later(self.MISC_INTERVAL, self.__misc)
+
+    def __on_socket_open(self, client, userdata, sock):
+        # Keep the fd, the socket is already closed (fileno -1) when on_socket_close is called.
+        fd = sock.fileno()
+        self._socket_fds[client] = fd
+        self._loop.call_soon_threadsafe(self.__selector_call, self._loop.add_reader, fd, client.loop_read)
+
+    def __on_socket_close(self, client, userdata, sock):
+        fd = self._socket_fds.pop(client, None)
+        if fd is not None:
+            self._loop.call_soon_threadsafe(self.__selector_call, self._loop.remove_writer, fd)
+            self._loop.call_soon_threadsafe(self.__selector_call, self._loop.remove_reader, fd)
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        fd = self._socket_fds.get(client)
+        if fd is not None:
+            self._loop.call_soon_threadsafe(self.__selector_call, self._loop.add_writer, fd, client.loop_write)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        fd = self._socket_fds.get(client)
+        if fd is not None:
+            self._loop.call_soon_threadsafe(self.__selector_call, self._loop.remove_writer, fd)
+
+    def __selector_call(self, method, *args):
+        try:
+            method(*args)
+        except OSError:
+            # paho closes the socket right after on_socket_close, the selector already dropped the closed fd.
+            pass
+
+class SelectorNetworkLoop:
+    """
+    Drives the sockets of all the clients from a few I/O threads with selectors (epoll on linux) through the paho external loop callbacks.
+    The clients are sharded across the threads by DEV_ID, each thread owns its selector and calls loop_read / loop_write / loop_misc of its clients.
+    The paho callbacks may come from any thread, the selector changes are handed over to the owning thread and the thread is woken up.
+    """
+    def __init__(self, threads=1, log=None):
+        self._shards = [SelectorShard(f"network_loop_{i}", log) for i in range(max(1, threads))]
+
+    def __shard(self, client):
+        return self._shards[zlib.crc32(str(client.dev_id).encode()) % len(self._shards)]
+
+    def register(self, client):
+        self.__shard(client).register(client)
+
+    def start(self, client):
+        shard = self.__shard(client)
+        shard.call(shard.start_misc, client)
+
+    def stop(self, client):
+        shard = self.__shard(client)
+        shard.call(shard.stop_misc, client)
+
+    def shutdown(self):
+        for shard in self._shards:
+            shard.shutdown()
+
+class SelectorShard:
+    """
+    One I/O thread of SelectorNetworkLoop. Owns a selector, the fds of its clients (fd -> [client, events]) and the loop_misc timer.
+    """
+    MISC_INTERVAL = 1
+
+    def __init__(self, name, log=None):
+        self._log = log
+        self._selector = selectors.DefaultSelector()
+        self._fds = {}
+        self._socket_fds = {}
+        self._misc_clients = set()
+        self._calls = collections.deque()
+        self._closed = False
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self._thread.start()
+
+    def register(self, client):
+        client.on_socket_open = self.__on_socket_open
+        client.on_socket_close = self.__on_socket_close
+        client.on_socket_register_write = self.__on_socket_register_write
+        client.on_socket_unregister_write = self.__on_socket_unregister_write
+
+    def call(self, method, *args):
+        """
+        Run the method on the shard thread. Immediately if already on it.
+        """
+        if threading.current_thread() is self._thread:
+            method(*args)
+            return
+        self._calls.append((method, args))
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            # The wakeup socket is already full (the thread will wake up anyway) or closed on shutdown.
+            pass
+
+    def start_misc(self, client):
+        self._misc_clients.add(client)
+
+    def stop_misc(self, client):
+        self._misc_clients.discard(client)
+
+    def shutdown(self):
+        self._closed = True
+        self.call(lambda: None)
+
+    def __run(self):
+        next_misc = time.monotonic() + self.MISC_INTERVAL
+        while not self._closed:
+            for key, mask in self._selector.select(timeout=max(0, next_misc - time.monotonic())):
+                if key.data is None:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                client = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        client.loop_read()
+                    if mask & selectors.EVENT_WRITE:
+                        client.loop_write()
+                except Exception as e:
+                    # The thread is shared by many clients, one failing callback must not stop the others.
+                    if self._log:
+                        self._log.exception("Network loop error Dev ID: %s, error: %s", client.dev_id, e)
+
+            while self._calls:
+                method, args = self._calls.popleft()
+                method(*args)
+
+            if time.monotonic() >= next_misc:
+                for client in list(self._misc_clients):
+                    if client.loop_misc() == mqtt_client.MQTT_ERR_NO_CONN:
+                        self._misc_clients.discard(client)
+                next_misc = time.monotonic() + self.MISC_INTERVAL
+
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def __set_events(self, fd, client, events):
+        try:
+            if fd in self._fds:
+                if events:
+                    self._selector.modify(fd, events, client)
+                else:
+                    self._selector.unregister(fd)
+            elif events:
+                self._selector.register(fd, events, client)
+        except (OSError, ValueError, KeyError):
+            # paho closes the socket right after on_socket_close, the selector drops the closed fd.
+            events = 0
+            try:
+                self._selector.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+        if events:
+            self._fds[fd] = [client, events]
+        else:
+            self._fds.pop(fd, None)
+
+    def __add_events(self, fd, client, events):
+        entry = self._fds.get(fd)
+        # An entry of another client is a stale fd number which is reused by the new socket.
+        current_events = entry[1] if entry and entry[0] is client else 0
+        self.__set_events(fd, client, current_events | events)
+
+    def __remove_events(self, fd, client, events):
+        entry = self._fds.get(fd)
+        if entry and entry[0] is client:
+            self.__set_events(fd, client, entry[1] & ~events)
+
+    def __on_socket_open(self, client, userdata, sock):
+        fd = sock.fileno()
+        self._socket_fds[client] = fd
+        self.call(self.__add_events, fd, client, selectors.EVENT_READ)
+
+    def __on_socket_close(self, client, userdata, sock):
+        fd = self._socket_fds.pop(client, None)
+        if fd is not None:
+            self.call(self.__remove_events, fd, client, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        fd = self._socket_fds.get(client)
+        if fd is not None:
+            self.call(self.__add_events, fd, client, selectors.EVENT_WRITE)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        fd = self._socket_fds.get(client)
+        if fd is not None:
+            self.call(self.__remove_events, fd, client, selectors.EVENT_WRITE)
@@ -0,0 +1,296 @@
+import os
+import struct
+import threading
+import zlib
+
+class OutboundQueue:
+    """
+    Disk backed FIFO of the outbound messages of one device. Append-only segment log in its own directory.
+    Record -> header (crc32, payload length, topic length, flags) + topic + payload. The crc covers everything after the crc field.
+    The segment file is rolled over at segment_bytes. When the queue is above max_bytes the oldest segments are dropped (oldest-first eviction).
+    The read position (segment, offset) is kept in the position file, so the unsent messages survive a restart.
+    Writes are buffered, flush (with fsync) is called in batches by OutboundStore.
+    """
+    HEADER = struct.Struct("!IIHB")
+    SEGMENT_SUFFIX = ".seg"
+    POSITION_FILE = "position"
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, segment_bytes=4 * 1024 * 1024):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self.lock = threading.RLock()
+        self._dirty = False
+        self._evicted = 0
+        self._reader = None
+
+        os.makedirs(directory, exist_ok=True)
+        # _segments -> {seq: [bytes, records]} of the segments on disk, oldest first.
+        self._segments = {}
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(self.SEGMENT_SUFFIX):
+                seq = int(file_name[:-len(self.SEGMENT_SUFFIX)])
+                self._segments[seq] = self.__scan(seq)
+
+        self._read_seq, self._read_offset = self.__load_position()
+        if self._segments and self._read_seq not in self._segments:
+            self._read_seq, self._read_offset = min(self._segments), 0
+        for seq in [seq for seq in self._segments if seq < self._read_seq]:
+            self.__delete_segment(seq)
+        self._read_consumed = self.__count_records(self._read_seq, self._read_offset) if self._read_seq in self._segments else 0
+        self._count = sum(records for _, records in self._segments.values()) - self._read_consumed
+        # Bytes of all the segments, kept up to date instead of summed on every put.
+        self._bytes = sum(size for size, _ in self._segments.values())
+
+        self._write_seq = max(self._segments) if self._segments else self._read_seq
+        self._segments.setdefault(self._write_seq, [0, 0])
+        self._writer = open(self.__segment_path(self._write_seq), 'ab')
+
+    def __len__(self):
+        return self._count
+
+    def empty(self):
+        return self._count == 0
+
+    def size(self):
+        """
+        Bytes on disk.
+        """
+        return self._bytes
+
+    def evicted(self):
+        """
+        Number of messages dropped by the eviction.
+        """
+        return self._evicted
+
+    def put(self, topic, payload, qos=0, retain=False):
+        """
+        Append the message. payload -> bytes or string.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic = topic.encode()
+        body = struct.pack("!IHB", len(payload), len(topic), (qos & 0x3) | (0x4 if retain else 0)) + topic + bytes(payload)
+        record = struct.pack("!I", zlib.crc32(body)) + body
+
+        with self.lock:
+            if self._segments[self._write_seq][0] + len(record) > self._segment_bytes and self._segments[self._write_seq][1]:
+                self.__roll()
+            self._writer.write(record)
+            segment = self._segments[self._write_seq]
+            segment[0] += len(record)
+            segment[1] += 1
+            self._bytes += len(record)
+            self._count += 1
+            self._dirty = True
+            if self._bytes > self._max_bytes:
+                self.__evict()
+
+    def peek(self, max_count):
+        """
+        Return up to max_count of the oldest messages without removing them.
+        [(topic, payload, qos, retain, position)], pass the position of the last handled message to commit.
+        """
+        messages = []
+        with self.lock:
+            if self._count == 0:
+                return messages
+            self._writer.flush()
+            seq, offset, consumed = self._read_seq, self._read_offset, self._read_consumed
+            while len(messages) < max_count and seq in self._segments:
+                record = self.__read_record(seq, offset)
+                if record is None:
+                    next_seqs = [next_seq for next_seq in self._segments if next_seq > seq]
+                    if not next_seqs:
+                        break
+                    seq, offset, consumed = min(next_seqs), 0, 0
+                    continue
+                topic, payload, qos, retain, length = record
+                offset += length
+                consumed += 1
+                messages.append((topic, payload, qos, retain, (seq, offset, consumed)))
+        return messages
+
+    def commit(self, position):
+        """
+        Remove the messages up to (and including) the position returned by peek.
+        """
+        seq, offset, consumed = position
+        with self.lock:
+            if seq not in self._segments or (seq, offset) <= (self._read_seq, self._read_offset):
+                # Already evicted / committed.
+                return
+            removed = 0
+            for old_seq in [old_seq for old_seq in self._segments if old_seq < seq]:
+                removed += self._segments[old_seq][1] - (self._read_consumed if old_seq == self._read_seq else 0)
+                self.__delete_segment(old_seq)
+            removed += consumed - (self._read_consumed if seq == self._read_seq else 0)
+            self._count -= removed
+            self._read_seq, self._read_offset, self._read_consumed = seq, offset, consumed
+            self.__save_position()
+
+    def flush(self, fsync=True):
+        with self.lock:
+            if not self._dirty:
+                return
+            self._writer.flush()
+            if fsync:
+                os.fsync(self._writer.fileno())
+            self._dirty = False
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self._writer.close()
+            if self._reader:
+                self._reader[1].close()
+                self._reader = None
+
+    def __segment_path(self, seq):
+        return os.path.join(self._directory, f"{seq:020d}{self.SEGMENT_SUFFIX}")
+
+    def __roll(self):
+        self.flush()
+        self._writer.close()
+        self._write_seq += 1
+        self._segments[self._write_seq] = [0, 0]
+        self._writer = open(self.__segment_path(self._write_seq), 'ab')
+
+    def __evict(self):
+        # Drop whole segments, oldest first. The segment being written is never dropped.
+        while self._bytes > self._max_bytes and len(self._segments) > 1:
+            seq = min(self._segments)
+            dropped = self._segments[seq][1] - (self._read_consumed if seq == self._read_seq else 0)
+            self._count -= dropped
+            self._evicted += dropped
+            self.__delete_segment(seq)
+            if seq == self._read_seq:
+                self._read_seq, self._read_offset, self._read_consumed = min(self._segments), 0, 0
+                self.__save_position()
+
+    def __delete_segment(self, seq):
+        if self._reader and self._reader[0] == seq:
+            self._reader[1].close()
+            self._reader = None
+        segment = self._segments.pop(seq, None)
+        if segment is not None:
+            self._bytes -= segment[0]
+        try:
+            os.remove(self.__segment_path(seq))
+        except FileNotFoundError:
+            pass
+
+    def __read_record(self, seq, offset):
+        """
+        Return (topic, payload, qos, retain, record length) at the offset, None at the end of the segment or at a torn / corrupt record.
+        """
+        if not self._reader or self._reader[0] != seq:
+            if self._reader:
+                self._reader[1].close()
+            self._reader = (seq, open(self.__segment_path(seq), 'rb'))
+        reader = self._reader[1]
+        reader.seek(offset)
+        header = reader.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            return None
+        crc, payload_length, topic_length, flags = self.HEADER.unpack(header)
+        data = reader.read(topic_length + payload_length)
+        if len(data) < topic_length + payload_length or zlib.crc32(header[4:] + data) != crc:
+            return None
+        return data[:topic_length].decode(), data[topic_length:], flags & 0x3, bool(flags & 0x4), self.HEADER.size + topic_length + payload_length
+
+    def __scan(self, seq):
+        """
+        Return [bytes, records] of the segment. A torn record at the end (crash while writing) is truncated.
+        """
+        offset, records = 0, 0
+        while True:
+            record = self.__read_record(seq, offset)
+            if record is None:
+                break
+            offset += record[4]
+            records += 1
+        if self._reader:
+            self._reader[1].close()
+            self._reader = None
+        if os.path.getsize(self.__segment_path(seq)) != offset:
+            with open(self.__segment_path(seq), 'r+b') as segment_file:
+                segment_file.truncate(offset)
+        return [offset, records]
+
+    def __count_records(self, seq, end_offset):
+        offset, records = 0, 0
+        while offset < end_offset:
+            record = self.__read_record(seq, offset)
+            if record is None:
+                break
+            offset += record[4]
+            records += 1
+        return records
+
+    def __load_position(self):
+        try:
+            with open(os.path.join(self._directory, self.POSITION_FILE), 'r') as position_file:
+                seq, offset = position_file.read().split()
+                return int(seq), int(offset)
+        except (FileNotFoundError, ValueError):
+            return (min(self._segments) if self._segments else 0), 0
+
+    def __save_position(self):
+        position_path = os.path.join(self._directory, self.POSITION_FILE)
+        with open(position_path + ".tmp", 'w') as position_file:
+            position_file.write(f"{self._read_seq} {self._read_offset}")
+        os.replace(position_path + ".tmp", position_path)
+
+SAFE_BYTES = frozenset(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_")
+
+def store_directory_name(dev_id):
+    """
+    Directory name of the device queue: the utf-8 bytes of the dev_id, %XX escaped except [A-Za-z0-9-_].
+    Reversible, so two devices never share a directory ("a/b" -> a%2Fb, "a_b" -> a_b), and "." / ".." stay under store_dir.
+    """
+    return "".join(chr(byte) if byte in SAFE_BYTES else f"%{byte:02X}" for byte in str(dev_id).encode())
+
+class OutboundStore:
+    """
+    The OutboundQueue of every device under store_dir/<dev_id>.
+    A background thread flushes and fsyncs the written queues every fsync_interval seconds (fsync batching).
+    """
+    def __init__(self, store_dir, max_bytes=64 * 1024 * 1024, segment_bytes=4 * 1024 * 1024, fsync_interval=0.2):
+        self._store_dir = store_dir
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._fsync_interval = fsync_interval
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._flush_thread = threading.Thread(target=self.__flush, name="outbound_store_flush", daemon=True)
+        self._flush_thread.start()
+
+    def queue(self, dev_id):
+        """
+        Return the queue of the device, opened (and recovered from the disk) on the first call.
+        """
+        with self._lock:
+            outbound_queue = self._queues.get(dev_id)
+            if outbound_queue is None:
+                directory = os.path.join(self._store_dir, store_directory_name(dev_id))
+                outbound_queue = OutboundQueue(directory, self._max_bytes, self._segment_bytes)
+                self._queues[dev_id] = outbound_queue
+            return outbound_queue
+
+    def queues(self):
+        with self._lock:
+            return dict(self._queues)
+
+    def close(self):
+        self._stop_event.set()
+        self._flush_thread.join()
+        for outbound_queue in self.queues().values():
+            outbound_queue.close()
+
+    def __flush(self):
+        while not self._stop_event.wait(self._fsync_interval):
+            for outbound_queue in self.queues().values():
+                outbound_queue.flush()
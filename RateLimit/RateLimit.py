@@ -0,0 +1,190 @@
+import heapq
+import threading
+import time
+
+HIGH = "high"
+NORMAL = "normal"
+
+DELAY = "delay"
+DROP = "drop"
+SPOOL = "spool"
+POLICIES = (DELAY, DROP, SPOOL)
+
+class TokenBucket:
+    """
+    rate messages per second, up to burst messages at once. Kept as the theoretical arrival time (GCRA):
+    a message reserves its slot, so the messages delayed by the bucket are sent in order at the rate.
+    """
+    __slots__ = ("rate", "burst", "interval", "tat", "admitted", "delayed", "rejected")
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(1, burst if burst else rate)
+        self.interval = 1.0 / rate
+        self.tat = 0.0
+        self.admitted = 0
+        self.delayed = 0
+        # Over the limit and not sent (dropped / spooled).
+        self.rejected = 0
+
+    def ready(self, now):
+        """
+        The time the next message can be sent.
+        """
+        return max(self.tat, now) + self.interval - self.burst * self.interval
+
+    def reserve(self, now):
+        self.tat = max(self.tat, now) + self.interval
+
+    def tokens(self, now):
+        """
+        Messages that can be sent now, negative while the delayed messages are waiting.
+        """
+        return min(self.burst, self.burst - (max(self.tat, now) - now) / self.interval)
+
+    def to_dict(self, now):
+        return {"rate": self.rate, "burst": self.burst, "tokens": round(self.tokens(now), 3),
+                "admitted": self.admitted, "delayed": self.delayed, "rejected": self.rejected}
+
+class RateLimiter:
+    """
+    Token buckets per device, per endpoint (host, port) and global. A message is sent when all its buckets allow it.
+    acquire reserves the slot of the message in all the buckets and returns the seconds to wait,
+    HIGH priority messages are never delayed but take their tokens, so the NORMAL traffic after them waits instead.
+    call_later runs the delayed sends from one thread, in the order of their slots.
+    """
+    def __init__(self, global_rate=0, global_burst=None, endpoint_rate=0, endpoint_burst=None, log=None):
+        self._global = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self._endpoint_rate = endpoint_rate
+        self._endpoint_burst = endpoint_burst
+        self._endpoints = {}
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._log = log
+        # (time, seq, fn, args) of the delayed sends.
+        self._heap = []
+        self._seq = 0
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self._global is not None or self._endpoint_rate > 0 or bool(self._devices)
+
+    def set_device(self, dev_id, rate, burst=None):
+        """
+        rate 0 -> no limit for the device.
+        """
+        with self._lock:
+            if rate and rate > 0:
+                bucket = self._devices.get(dev_id)
+                if bucket is None or bucket.rate != rate or bucket.burst != max(1, burst if burst else rate):
+                    self._devices[dev_id] = TokenBucket(rate, burst)
+            else:
+                self._devices.pop(dev_id, None)
+
+    def remove_device(self, dev_id):
+        with self._lock:
+            self._devices.pop(dev_id, None)
+
+    def acquire(self, dev_id, endpoint, priority=NORMAL, max_delay=None, retry=False, gateway_id=None):
+        """
+        Returns the seconds to wait before sending (0 -> now), the slot is reserved.
+        None if the wait would be more than max_delay seconds (None -> no maximum), nothing is reserved then.
+        retry -> the message was rejected already (spooled), not counted again.
+        gateway_id -> dev_id is a gateway device, the bucket of its gateway applies too.
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = self.__buckets(dev_id, endpoint, gateway_id)
+            if not buckets:
+                return 0
+            waits = [0 if priority == HIGH else max(0, bucket.ready(now) - now) for bucket in buckets]
+            delay = max(waits)
+            if max_delay is not None and delay > max_delay:
+                for bucket, wait in zip(buckets, waits):
+                    if wait > max_delay and not retry:
+                        bucket.rejected += 1
+                return None
+            # The counters of a bucket count the messages it admitted / delayed itself.
+            for bucket, wait in zip(buckets, waits):
+                bucket.reserve(now)
+                if wait:
+                    bucket.delayed += 1
+                else:
+                    bucket.admitted += 1
+        return delay
+
+    def __buckets(self, dev_id, endpoint, gateway_id=None):
+        buckets = []
+        for bucket_id in (dev_id, gateway_id):
+            device = self._devices.get(bucket_id) if bucket_id is not None else None
+            if device is not None:
+                buckets.append(device)
+        if self._endpoint_rate > 0:
+            bucket = self._endpoints.get(endpoint)
+            if bucket is None:
+                bucket = self._endpoints[endpoint] = TokenBucket(self._endpoint_rate, self._endpoint_burst)
+            buckets.append(bucket)
+        if self._global is not None:
+            buckets.append(self._global)
+        return buckets
+
+    def call_later(self, delay, fn, *args):
+        """
+        Run fn(*args) after delay seconds from the rate_limit thread, right away once stopped.
+        """
+        with self._condition:
+            if not self._stopped:
+                self._seq += 1
+                heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, fn, args))
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.__run_delayed, name="rate_limit", daemon=True)
+                    self._thread.start()
+                self._condition.notify()
+                return
+        fn(*args)
+
+    def state(self):
+        """
+        The buckets (rate, burst, tokens now, admitted / delayed / rejected counters) and the delayed messages waiting.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = {
+                "global": self._global.to_dict(now) if self._global is not None else None,
+                "endpoints": {f"{host}:{port}": bucket.to_dict(now) for (host, port), bucket in self._endpoints.items()},
+                "devices": {dev_id: bucket.to_dict(now) for dev_id, bucket in self._devices.items()},
+            }
+        with self._condition:
+            state["waiting"] = len(self._heap)
+        return state
+
+    def stop(self):
+        """
+        Run the waiting sends now.
+        """
+        with self._condition:
+            self._stopped = True
+            waiting = [heapq.heappop(self._heap) for _ in range(len(self._heap))]
+            self._condition.notify()
+        for _, _, fn, args in waiting:
+            self.__call(fn, args)
+
+    def __run_delayed(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._stopped:
+                    return
+                _, _, fn, args = heapq.heappop(self._heap)
+            self.__call(fn, args)
+
+    def __call(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            if self._log:
+                self._log.exception("Delayed send failed: %s", e)
@@ -0,0 +1,75 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+class Serializer:
+    """
+    A payload codec. encode -> object to bytes / string, decode -> bytes to object.
+    content_type describes the payload (used by the MQTT v5 content type).
+    """
+    def __init__(self, name, encode, decode, content_type):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.content_type = content_type
+
+    def __repr__(self):
+        return f"Serializer({self.name})"
+
+SERIALIZERS = {}
+
+def register_serializer(name, encode, decode, content_type="application/octet-stream"):
+    """
+    Add (or replace) a codec. The device selects it with SERIALIZER: name.
+    """
+    SERIALIZERS[name] = Serializer(name, encode, decode, content_type)
+    return SERIALIZERS[name]
+
+def get_serializer(name):
+    """
+    Return the codec registered with the name, None if it's not available (unknown or the package is not installed).
+    """
+    return SERIALIZERS.get(name)
+
+def serializer_for_content_type(content_type):
+    """
+    Return the first registered codec of the content type, None if there's none.
+    """
+    for serializer in SERIALIZERS.values():
+        if serializer.content_type == content_type:
+            return serializer
+    return None
+
+def available_serializers():
+    return list(SERIALIZERS)
+
+def _json_compact_encode(message):
+    return json.dumps(message, separators=(",", ":"))
+
+def _json_pretty_encode(message):
+    return json.dumps(message, indent=4)
+
+# json_pretty is the old payload format (indent=4), json the compact one. orjson is opt-in: it refuses the non-str dict keys
+# and encodes NaN / Infinity as null, json.dumps accepts / keeps them.
+register_serializer("json_pretty", _json_pretty_encode, json.loads, "application/json")
+register_serializer("json_compact", _json_compact_encode, json.loads, "application/json")
+register_serializer("json", _json_compact_encode, json.loads, "application/json")
+if orjson:
+    register_serializer("orjson", orjson.dumps, orjson.loads, "application/json")
+if msgpack:
+    register_serializer("msgpack", msgpack.packb, msgpack.unpackb, "application/msgpack")
+if cbor2:
+    register_serializer("cbor", cbor2.dumps, cbor2.loads, "application/cbor")
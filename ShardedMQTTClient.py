@@ -0,0 +1,391 @@
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+import types
+
+from Logger.Logger import Logger
+from MessageView.MessageView import MessageView
+from Delivery.Delivery import PublishError
+
+class HashRing:
+    """
+    Consistent hash of DEV_ID -> shard. Every shard has VIRTUAL_NODES points on the ring,
+    so the devices are spread evenly and changing the shard count moves only ~1/N of them.
+    """
+    VIRTUAL_NODES = 100
+
+    def __init__(self, shards):
+        ring = sorted((self.__hash(f"{shard}:{node}"), shard) for shard in range(shards) for node in range(self.VIRTUAL_NODES))
+        self._points = [point for point, _ in ring]
+        self._shards = [shard for _, shard in ring]
+        self._cache = {}
+
+    def shard(self, dev_id):
+        shard = self._cache.get(dev_id)
+        if shard is None:
+            i = bisect.bisect(self._points, self.__hash(str(dev_id))) % len(self._points)
+            shard = self._shards[i]
+            self._cache[dev_id] = shard
+        return shard
+
+    @staticmethod
+    def __hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class ShardClient:
+    """
+    What on_message_cb gets as the client in the parent process (the paho client lives in the shard).
+    """
+    __slots__ = ("dev_id", "dev_type", "shard")
+
+    def __init__(self, dev_id, dev_type, shard):
+        self.dev_id = dev_id
+        self.dev_type = dev_type
+        self.shard = shard
+
+class BatchSender:
+    """
+    Sends the queued items over the pipe from its own thread. Everything queued while the previous send was running goes in one batch.
+    on_idle is called every idle_interval seconds (the shard status).
+    """
+    def __init__(self, conn, name, on_idle=None, idle_interval=0.2):
+        self._conn = conn
+        self._items = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._on_idle = on_idle
+        self._idle_interval = idle_interval
+        self._thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self._thread.start()
+
+    def send(self, item):
+        with self._condition:
+            self._items.append(item)
+            if len(self._items) == 1:
+                self._condition.notify()
+
+    def close(self, join=False):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if join:
+            self._thread.join()
+
+    def __run(self):
+        while True:
+            with self._condition:
+                if not self._items and not self._closed:
+                    self._condition.wait(self._idle_interval if self._on_idle else None)
+                batch, self._items = self._items, []
+                closed = self._closed
+            if self._on_idle:
+                self._on_idle()
+                with self._condition:
+                    batch, self._items = batch + self._items, []
+            if batch:
+                try:
+                    self._conn.send(batch)
+                except (OSError, EOFError, ValueError):
+                    return
+            if closed:
+                return
+
+def shard_main(index, mqtt_json_data, conn):
+    """
+    Shard process: one MQTTClient with the devices of the shard. Runs the commands of the parent,
+    sends back the received messages, the publish results and the status of the devices.
+    """
+    from MQTTClient import MQTTClient
+
+    mqtt_json_data = dict(mqtt_json_data)
+    settings = dict(mqtt_json_data.get("SETTINGS", {}))
+    settings.setdefault("LOG_MODULE_NAME", f"MQTTClient_shard_{index}")
+    mqtt_json_data["SETTINGS"] = settings
+    mqtt_client = MQTTClient(mqtt_json_data)
+    last_status = {}
+
+    def send_status():
+        nonlocal last_status
+        status = dict(mqtt_client.clients_info())
+        if status != last_status:
+            last_status = status
+            sender.send(("status", status))
+
+    sender = BatchSender(conn, f"shard_{index}_sender", on_idle=send_status)
+
+    def on_message(client, message):
+        if isinstance(message, MessageView):
+            message = ("raw", message.topic, message.qos, message.retain, message.payload, message.properties)
+        sender.send(("message", client.dev_id, client.dev_type, message))
+
+    def publish_done(request_id, future):
+        error = future.exception()
+        if error is None:
+            sender.send(("result", request_id, future.result(), None, None))
+        else:
+            sender.send(("result", request_id, None, type(error).__name__, str(error)))
+
+    mqtt_client.on_message_cb(on_message)
+    while True:
+        try:
+            batch = conn.recv()
+        except (EOFError, OSError):
+            # The parent is gone.
+            batch = [("stop",)]
+        for command in batch:
+            name = command[0]
+            if name == "publish":
+                _, request_id, dev_id, message, topic, qos, retain, timeout, priority, content_type, user_properties = command
+                try:
+                    future = mqtt_client.publish(dev_id, message, topic, qos, retain, timeout, priority, content_type, user_properties)
+                except Exception as e:
+                    # Only this publish fails, not the shard with all its pending publishes.
+                    sender.send(("result", request_id, None, type(e).__name__, str(e)))
+                    continue
+                future.add_done_callback(lambda future, request_id=request_id: publish_done(request_id, future))
+            elif name == "connect":
+                mqtt_client.mqtt_connect_many(command[1])
+            elif name == "disconnect":
+                mqtt_client.mqtt_disconnect_many(command[1])
+            elif name == "stop":
+                mqtt_client.stop()
+                mqtt_client._disconnect_thread.join()
+                send_status()
+                sender.close(join=True)
+                conn.close()
+                return
+
+class Shard:
+    """
+    Parent side of one shard process: the pipe, the batch sender, the receiver thread and the futures of the pending publishes.
+    """
+    def __init__(self, index, context, mqtt_json_data, on_event):
+        self.index = index
+        self.status = {}
+        self.pending = {}
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=shard_main, args=(index, mqtt_json_data, child_conn), name=f"mqtt_shard_{index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.sender = BatchSender(parent_conn, f"shard_{index}_commands")
+        self._on_event = on_event
+        self._receiver = threading.Thread(target=self.__receive, name=f"shard_{index}_receiver", daemon=True)
+        self._receiver.start()
+
+    def __receive(self):
+        while True:
+            try:
+                batch = self.conn.recv()
+            except (EOFError, OSError):
+                return
+            for event in batch:
+                self._on_event(self, event)
+
+    def close(self):
+        self.sender.close()
+        self.conn.close()
+
+class ShardedMQTTClient:
+    """
+    Splits the DEVICE list across SHARDS worker processes (consistent hash of DEV_ID), each running its own MQTTClient,
+    so the encoding, decoding and network handling of the devices use all the cores instead of one interpreter.
+    Same facade as MQTTClient: publish, mqtt_connect(_many), mqtt_disconnect(_many), clients_info, on_message_cb, stop.
+    The commands and the events cross the process boundary over pipes, batched (everything queued during a send goes in the next one).
+    on_message_cb runs in this process with a ShardClient (dev_id, dev_type, shard). RAW_MESSAGE devices get a MessageView.
+    A shard process which dies is restarted with its devices, its pending publishes fail with PublishError.
+    The devices of a gateway (GATEWAY) run in the shard of their gateway device.
+    """
+    MONITOR_INTERVAL = 0.5
+
+    def __init__(self, mqtt_json_data, shards=None):
+        settings = mqtt_json_data.get("SETTINGS", {})
+        self._log = Logger(
+            name="MQTT Client",
+            module_name="ShardedMQTTClient",
+            level=str(settings.get("LOG_LEVEL", "INFO")),
+            async_logging=settings.get("LOG_ASYNC", True),
+        )
+        self._mqtt_json_data = mqtt_json_data
+        self._shard_count = max(1, shards or settings.get("SHARDS", 0) or os.cpu_count() or 1)
+        self._ring = HashRing(self._shard_count)
+        self._on_message_cb = None
+        self._clients = {}
+        self._request_ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        # spawn, the shard must not inherit the threads (and their locks) of this process.
+        self._context = multiprocessing.get_context("spawn")
+
+        # The devices of a gateway (GATEWAY) go to the shard of the gateway device, _gateway_of -> DEV_ID: gateway DEV_ID.
+        self._gateway_of = {}
+        self._shard_devices = [collections.OrderedDict() for _ in range(self._shard_count)]
+        for device in mqtt_json_data.get("DEVICE", []):
+            if device.get("DEV_ID") is not None:
+                self._shard_devices[self.__shard_index(device)][device.get("DEV_ID")] = device
+        self._shards = [self.__start_shard(i) for i in range(self._shard_count)]
+
+        self._monitor_thread = threading.Thread(target=self.__monitor, name="shard_monitor", daemon=True)
+        self._monitor_thread.start()
+        self._log.info("ShardedMQTTClient init done, %s shards", self._shard_count)
+
+    def __start_shard(self, index):
+        mqtt_json_data = dict(self._mqtt_json_data)
+        mqtt_json_data["DEVICE"] = list(self._shard_devices[index].values())
+        return Shard(index, self._context, mqtt_json_data, self.__on_event)
+
+    def __shard_index(self, device):
+        dev_id = device.get("DEV_ID")
+        if device.get("GATEWAY"):
+            self._gateway_of[dev_id] = device.get("GATEWAY")
+        else:
+            self._gateway_of.pop(dev_id, None)
+        return self.shard_of(dev_id)
+
+    def __monitor(self):
+        """
+        Restart the shard processes which died.
+        """
+        while not self._stop_event.wait(self.MONITOR_INTERVAL):
+            for index, shard in enumerate(self._shards):
+                if shard.process.is_alive() or self._stop_event.is_set():
+                    continue
+                self._log.critical("Shard %s died (exit code %s), restarting with %s devices", index, shard.process.exitcode, len(self._shard_devices[index]))
+                shard.close()
+                new_shard = self.__start_shard(index)
+                with self._lock:
+                    self._shards[index] = new_shard
+                    pending, shard.pending = shard.pending, {}
+                for future in pending.values():
+                    self.__resolve(future, exception=PublishError(f"Shard {index} died before the acknowledgement"))
+
+    def __on_event(self, shard, event):
+        name = event[0]
+        if name == "message":
+            _, dev_id, dev_type, message = event
+            if isinstance(message, tuple) and message and message[0] == "raw":
+                _, topic, qos, retain, payload, properties = message
+                message = MessageView(types.SimpleNamespace(topic=topic, qos=qos, retain=retain, dup=False, mid=0, payload=payload,
+                                                            properties=properties))
+            client = self._clients.get(dev_id)
+            if client is None or client.shard != shard.index:
+                client = self._clients[dev_id] = ShardClient(dev_id, dev_type, shard.index)
+            if self._on_message_cb:
+                try:
+                    self._on_message_cb(client, message)
+                except Exception as e:
+                    self._log.exception("on_message_cb error, Device ID: %s, error: %s", dev_id, e)
+        elif name == "result":
+            _, request_id, mid, error_type, error = event
+            with self._lock:
+                future = shard.pending.pop(request_id, None)
+            if future is None:
+                return
+            if error_type is None:
+                self.__resolve(future, result=mid)
+            elif error_type == "TimeoutError":
+                self.__resolve(future, exception=TimeoutError(error))
+            else:
+                self.__resolve(future, exception=PublishError(error))
+        elif name == "status":
+            shard.status = event[1]
+
+    @staticmethod
+    def __resolve(future, result=None, exception=None):
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+####################################################################################################
+#########################                     External Calls               #########################
+####################################################################################################
+    def on_message_cb(self, cb):
+        self._on_message_cb = cb
+
+    def shard_of(self, dev_id):
+        return self._ring.shard(self._gateway_of.get(dev_id, dev_id))
+
+    def publish(self, dev_id, message, topic=None, qos=0, retain=False, timeout=None, priority=None, content_type=None, user_properties=None):
+        """
+        Same as MQTTClient.publish, the message is published by the shard of the dev_id.
+        message must be picklable (string, bytes, dictionary / list).
+        """
+        future = concurrent.futures.Future()
+        request_id = next(self._request_ids)
+        with self._lock:
+            shard = self._shards[self.shard_of(dev_id)]
+            shard.pending[request_id] = future
+        shard.sender.send(("publish", request_id, dev_id, message, topic, qos, retain, timeout, priority, content_type, user_properties))
+        return future
+
+    def mqtt_connect(self, device):
+        self.mqtt_connect_many([device])
+
+    def mqtt_connect_many(self, devices):
+        """
+        devices -> list of dictionary
+        Grouped by shard, one command per shard.
+        """
+        by_shard = collections.defaultdict(list)
+        for device in devices:
+            dev_id = device.get("DEV_ID")
+            if dev_id is None:
+                self._log.warning("device_to_add does not contain DEV_ID. Skipping.")
+                continue
+            index = self.__shard_index(device)
+            self._shard_devices[index][dev_id] = device
+            by_shard[index].append(device)
+        for index, shard_devices in by_shard.items():
+            self._shards[index].sender.send(("connect", shard_devices))
+
+    def mqtt_disconnect(self, dev_id):
+        self.mqtt_disconnect_many([dev_id])
+
+    def mqtt_disconnect_many(self, dev_ids):
+        by_shard = collections.defaultdict(list)
+        for dev_id in dev_ids:
+            index = self.shard_of(dev_id)
+            self._shard_devices[index].pop(dev_id, None)
+            self._gateway_of.pop(dev_id, None)
+            by_shard[index].append(dev_id)
+        for index, shard_dev_ids in by_shard.items():
+            self._shards[index].sender.send(("disconnect", shard_dev_ids))
+
+    def clients_info(self):
+        """
+        The status of the devices of all the shards, refreshed by the shards every 0.2 seconds.
+        """
+        clients_status = {}
+        for shard in self._shards:
+            clients_status.update(shard.status)
+        return clients_status
+
+    def export_json(self):
+        mqtt_json_data = dict(self._mqtt_json_data)
+        mqtt_json_data["DEVICE"] = [device for shard_devices in self._shard_devices for device in shard_devices.values()]
+        return mqtt_json_data
+
+    def stop(self, timeout=30):
+        """
+        Stop all the shards (each disconnects its clients). Blocks until the processes exit, killed after timeout seconds.
+        """
+        self._stop_event.set()
+        for shard in self._shards:
+            shard.sender.send(("stop",))
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            shard.process.join(max(0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                self._log.error("Shard %s did not stop, killing it", shard.index)
+                shard.process.kill()
+            shard.close()
+        self._log.critical("All shards stopped...")
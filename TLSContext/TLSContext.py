@@ -0,0 +1,84 @@
+import os
+import ssl
+import threading
+
+class ResumableSSLContext(ssl.SSLContext):
+    """
+    SSLContext shared by the clients with the same certificates. Keeps the last TLS session of every broker (server_hostname)
+    and offers it in the next handshakes (abbreviated handshake, no certificate exchange), paho's wrap_socket doesn't pass a session.
+    """
+    def __init__(self, protocol, session_reuse=True):
+        super().__init__()
+        self.session_reuse = session_reuse
+        self._sessions = {}
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True, server_hostname=None, session=None):
+        if session is None and self.session_reuse and server_hostname:
+            session = self._sessions.get(server_hostname)
+        return super().wrap_socket(
+            sock,
+            server_side=server_side,
+            do_handshake_on_connect=do_handshake_on_connect,
+            suppress_ragged_eofs=suppress_ragged_eofs,
+            server_hostname=server_hostname,
+            session=session
+        )
+
+    def save_session(self, server_hostname, sock):
+        """
+        Called once the connection is up (CONNACK received, the TLS 1.3 tickets come after the handshake).
+        Return True if the handshake of sock resumed a session.
+        """
+        if not isinstance(sock, ssl.SSLSocket):
+            return False
+        if self.session_reuse and server_hostname and sock.session is not None:
+            self._sessions[server_hostname] = sock.session
+        return sock.session_reused
+
+class TLSContextCache:
+    """
+    One ResumableSSLContext per (CA, client cert, client key, TLS version), instead of tls_set re-reading and parsing the files for every client.
+    The files are checked (stat) on every get, a changed file builds a new context for the next connects.
+    """
+    def __init__(self, session_reuse=True):
+        self._session_reuse = session_reuse
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def get(self, ca_certs, certfile=None, keyfile=None, tls_version=ssl.PROTOCOL_TLS_CLIENT):
+        key = (ca_certs, certfile, keyfile, tls_version)
+        signature = self.__signature(key[:3])
+        cached = self._contexts.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with self._lock:
+            cached = self._contexts.get(key)
+            if cached is None or cached[0] != signature:
+                cached = (signature, self.__create(ca_certs, certfile, keyfile, tls_version))
+                self._contexts[key] = cached
+        return cached[1]
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+
+    def __create(self, ca_certs, certfile, keyfile, tls_version):
+        """
+        Same settings as paho tls_set with cert_reqs=CERT_REQUIRED and tls_insecure_set(False).
+        """
+        context = ResumableSSLContext(tls_version, self._session_reuse)
+        if certfile:
+            context.load_cert_chain(certfile, keyfile)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True
+        context.load_verify_locations(ca_certs)
+        return context
+
+    @staticmethod
+    def __signature(paths):
+        signature = []
+        for path in paths:
+            if path:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        return tuple(signature)
@@ -0,0 +1,102 @@
+import threading
+
+class TopicNode:
+    """
+    One topic level of the TopicRouter trie.
+    """
+    __slots__ = ("children", "handlers")
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+class TopicRouter:
+    """
+    Topic filter -> handlers, kept in a trie of the topic levels. Supports the + (one level) and # (remaining levels) wildcards.
+    match walks the trie level by level, so the cost depends on the topic depth and not on the number of the registered filters.
+    Following the MQTT spec the wildcards at the first level don't match the topics starting with $.
+    """
+    def __init__(self):
+        self._root = TopicNode()
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def validate(topic_filter):
+        """
+        Raise ValueError if the filter is not a valid MQTT topic filter.
+        """
+        if not topic_filter:
+            raise ValueError("Empty topic filter")
+        levels = topic_filter.split("/")
+        for i, level in enumerate(levels):
+            if "#" in level and (level != "#" or i != len(levels) - 1):
+                raise ValueError(f"# must be the last level of the topic filter: {topic_filter}")
+            if "+" in level and level != "+":
+                raise ValueError(f"+ must occupy the whole level of the topic filter: {topic_filter}")
+
+    def add(self, topic_filter, handler):
+        self.validate(topic_filter)
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, TopicNode())
+            # Copy on write, match reads the handlers without the lock.
+            node.handlers = node.handlers + [handler]
+            self._count += 1
+
+    def remove(self, topic_filter, handler=None):
+        """
+        Remove the handler from the filter, all the handlers of the filter if handler is None.
+        Returns the number of the removed handlers.
+        """
+        with self._lock:
+            path = [self._root]
+            for level in topic_filter.split("/"):
+                node = path[-1].children.get(level)
+                if node is None:
+                    return 0
+                path.append(node)
+            node = path[-1]
+            remaining = [h for h in node.handlers if handler is not None and h != handler]
+            removed = len(node.handlers) - len(remaining)
+            node.handlers = remaining
+            self._count -= removed
+            # Prune the empty branches.
+            levels = topic_filter.split("/")
+            for i in range(len(levels), 0, -1):
+                node = path[i]
+                if node.handlers or node.children:
+                    break
+                del path[i - 1].children[levels[i - 1]]
+            return removed
+
+    def match(self, topic):
+        """
+        Return the handlers of all the filters matching the topic.
+        """
+        handlers = []
+        levels = topic.split("/")
+        self.__match(self._root, levels, 0, handlers, topic.startswith("$"))
+        return handlers
+
+    def __match(self, node, levels, i, handlers, system_topic):
+        wildcards_allowed = not (i == 0 and system_topic)
+        if wildcards_allowed:
+            multi = node.children.get("#")
+            if multi is not None:
+                # a/# matches a, a/b, a/b/c ...
+                handlers.extend(multi.handlers)
+        if i == len(levels):
+            handlers.extend(node.handlers)
+            return
+        child = node.children.get(levels[i])
+        if child is not None:
+            self.__match(child, levels, i + 1, handlers, system_topic)
+        if wildcards_allowed:
+            single = node.children.get("+")
+            if single is not None:
+                self.__match(single, levels, i + 1, handlers, system_topic)